@@ -6,3 +6,4 @@ class LibConfig(AppConfig):
 
     def ready(self) -> None:
         import apps.lib.serializers
+        import apps.lib.checks
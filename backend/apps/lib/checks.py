@@ -0,0 +1,13 @@
+from django.core.checks import register, Error
+
+
+@register()
+def notification_templates_check(app_configs, **kwargs):
+    """
+    Compiles the notification template registry, failing if any event type we send out is missing a template.
+    """
+    from apps.lib.utils import NOTIFICATION_TEMPLATES
+    return [
+        Error(message, id='lib.E001')
+        for message in NOTIFICATION_TEMPLATES.load()
+    ]
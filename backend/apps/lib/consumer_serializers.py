@@ -27,6 +27,21 @@ class WatchSpecSerializer(serializers.Serializer):
     model_name = serializers.CharField(validators=[dotless])
     serializer = serializers.CharField(validators=[dotless])
     pk = serializers.CharField(validators=[dotless])
+    # Whether updates may be sent as a patch against the last payload rather than in full.
+    deltas = serializers.BooleanField(required=False, default=False)
+
+
+# Most objects which can be watched or cleared in a single watch_many or clear_watch_many command.
+MAX_WATCH_SPECS = 200
+
+
+class WatchManySerializer(serializers.Serializer):
+    specs = WatchSpecSerializer(many=True, allow_empty=False)
+
+    def validate_specs(self, val):
+        if len(val) > MAX_WATCH_SPECS:
+            raise ValidationError(f'Cannot watch more than {MAX_WATCH_SPECS} objects at once.')
+        return val
 
 
 class ViewerParamsSerializer(serializers.Serializer):
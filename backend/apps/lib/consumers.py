@@ -1,38 +1,80 @@
 import asyncio
-from collections import defaultdict
+import logging
+from collections import defaultdict, Counter, OrderedDict
+from threading import local
+from time import monotonic
 from pprint import pprint
-from typing import Any, Type, Dict, DefaultDict, Optional
+from weakref import ref
+from typing import Any, Type, Dict, DefaultDict, Optional, Callable, List, Tuple
 
-from asgiref.sync import sync_to_async, async_to_sync
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from aiofile import async_open
-from channels.layers import get_channel_layer
 from django.apps import apps
-from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured
+from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured, ValidationError
 from django.db import transaction
 from django.db.models import Model
 from django.db.models.signals import post_save, post_delete
 from rest_framework.serializers import ModelSerializer, Serializer
+from rest_framework.utils import json
+from rest_framework.utils.encoders import JSONEncoder
 
 from apps.lib.consumer_serializers import WatchSpecSerializer, ViewerParamsSerializer, EmptySerializer, \
-    WatchNewSpecSerializer
+    WatchNewSpecSerializer, WatchManySerializer
 from apps.lib.middleware import get_request
+from apps.lib.publisher import group_send
 from apps.lib.utils import FakeRequest, exclude_request
-from apps.profiles.models import User
+from apps.lib.version import current_version, version_command, VERSION_GROUP, cached_version
+from apps.profiles.models import User, ArtconomyAnonymousUser
 from apps.profiles.utils import empty_user
 
 BROADCAST_SERIALIZERS: DefaultDict[Type[Model], Dict[str, Type[ModelSerializer]]] = defaultdict(dict)
 
+logger = logging.getLogger(__name__)
+
 SA = sync_to_async
 
+# How long, in seconds, a connection remembers whether its user may watch an instance, and how many of those decisions
+# it keeps. Decisions are also forgotten whenever the connection hears the instance was updated or deleted.
+PERMISSION_CACHE_TTL = 60
+PERMISSION_CACHE_SIZE = 500
+# How many payloads a connection remembers so it can send later updates to them as patches.
+DELTA_CACHE_SIZE = 200
+# How many connections in this process belong to each channel layer group.
+GROUP_MEMBERS: Counter = Counter()
+# How many messages may wait to be sent to a single client. Past this, the backlog is thrown out and the client is
+# told to resync instead.
+OUTBOX_SIZE = 100
+# Totals across this process's connections of messages coalesced into a newer one, dropped on overflow, and resyncs.
+OUTBOX_COUNTS: Counter = Counter()
+# Batches of broadcasts waiting on the current thread's transaction. See defer_broadcast.
+PENDING_BROADCASTS = local()
+
+
+def shared_payload(
+        model: Type[Model], instance: Model, serializer_name: str, groups: List[str],
+) -> Optional[dict]:
+    """
+    Serializes an instance for broadcast, if the serializer is marked viewer_independent. The result can then be
+    sent to every listener as-is, rather than each one fetching and serializing the instance for itself.
+
+    Nothing is serialized unless this process has a connection in one of the groups. Listeners in other processes
+    fetch and serialize the instance themselves when a broadcast arrives without a payload.
+    """
+    if not any(GROUP_MEMBERS[group] for group in groups):
+        return None
+    serializer_class = BROADCAST_SERIALIZERS.get(model, {}).get(serializer_name)
+    if not getattr(serializer_class, 'viewer_independent', False):
+        return None
+    data = serializer_class(instance=instance, context={'request': FakeRequest(user=ArtconomyAnonymousUser())}).data
+    # Make sure the payload survives the trip through the channel layer.
+    return json.loads(json.dumps(data, cls=JSONEncoder))
+
 
 def send_new(model: Type[Model], instance: Model):
     """
     Constructs and sends a 'created' message to send out for a new instance to relevant lists.
     """
-    layer = get_channel_layer()
     app_label = model._meta.app_label
     model_name = model.__name__
     if not hasattr(instance, 'announce_channels'):
@@ -42,9 +84,12 @@ def send_new(model: Type[Model], instance: Model):
         # Not great that we're in nested for loops here, but in practice we shouldn't have that many entries.
         # Might find a way to optimize this if it ends up causing performance problems. It probably won't since
         # most won't have listeners.
+        payload = shared_payload(
+            model, instance, serializer_name, [f'{channel}.{serializer_name}' for channel in channels],
+        )
         for channel in channels:
             group_name = f'{channel}.{serializer_name}'
-            async_to_sync(layer.group_send)(
+            group_send(
                 f'{channel}.{serializer_name}',
                 {
                     'type': 'new_item',
@@ -55,6 +100,7 @@ def send_new(model: Type[Model], instance: Model):
                         'serializer': serializer_name,
                         'pk': instance.pk,
                         'list_name': group_name,
+                        'payload': payload,
                     }}
             )
 
@@ -63,13 +109,13 @@ def send_updated(model, instance):
     """
     Constructs and sends an 'updated' message to send out for an instance.
     """
-    layer = get_channel_layer()
     app_label = model._meta.app_label
     model_name = model.__name__
     exclude = exclude_request(get_request()),
     for serializer_name in [key for key in model.watch_permissions.keys() if key]:
-        async_to_sync(layer.group_send)(
-            f'{app_label}.{model_name}.update.{serializer_name}.{instance.pk}',
+        group_name = f'{app_label}.{model_name}.update.{serializer_name}.{instance.pk}'
+        group_send(
+            group_name,
             {
                 'type': 'update_model',
                 'exclude': exclude,
@@ -78,6 +124,7 @@ def send_updated(model, instance):
                     'app_label': app_label,
                     'serializer': serializer_name,
                     'pk': instance.pk,
+                    'payload': shared_payload(model, instance, serializer_name, [group_name]),
                 }}
         )
 
@@ -86,11 +133,10 @@ def send_deleted(model, instance):
     """
     Constructs and sends an 'updated' message to send out for an instance.
     """
-    layer = get_channel_layer()
     app_label = model._meta.app_label
     model_name = model.__name__
     exclude = exclude_request(get_request()),
-    async_to_sync(layer.group_send)(
+    group_send(
         f'{app_label}.{model_name}.delete.{instance.pk}',
         {
             'type': 'delete_model',
@@ -103,27 +149,76 @@ def send_deleted(model, instance):
     )
 
 
+class BroadcastBatch:
+    """
+    Broadcasts queued within one savepoint of a transaction, sent by a single commit hook registered when the first of
+    them is queued. Django throws the hook away if the savepoint or transaction is rolled back. Nothing else holds on
+    to the batch strongly, so it's thrown away along with it.
+    """
+    def __init__(self, savepoint_ids: Tuple[str, ...]):
+        self.savepoint_ids = savepoint_ids
+        self.entries: Dict[Tuple[str, Type[Model], Any], Tuple[Model, Callable[[Type[Model], Model], None]]] = {}
+        self.sent = False
+        transaction.on_commit(self.flush)
+
+    def flush(self):
+        self.sent = True
+        entries, self.entries = self.entries, {}
+        for (kind, model, pk), (instance, send) in entries.items():
+            send(model, instance)
+
+
+def pending_batches() -> List[BroadcastBatch]:
+    """
+    Lists the batches still waiting to be sent for the current thread's transaction, outermost first.
+    """
+    batches = [batch for batch in (batch_ref() for batch_ref in getattr(PENDING_BROADCASTS, 'batches', [])) if batch]
+    batches = [batch for batch in batches if not batch.sent]
+    PENDING_BROADCASTS.batches = [ref(batch) for batch in batches]
+    return batches
+
+
+def defer_broadcast(kind: str, model: Type[Model], instance: Model, send: Callable[[Type[Model], Model], None]):
+    """
+    Sends a broadcast about an instance once the current transaction commits, or right away outside of one. However
+    many times an instance is saved in a transaction, each kind of broadcast goes out for it only once, using the
+    instance as it was last saved. An update is also skipped when the instance was created in the same transaction,
+    since listeners are already going to fetch it fresh.
+    """
+    if transaction.get_autocommit():
+        send(model, instance)
+        return
+    batches = pending_batches()
+    key = (kind, model, instance.pk)
+    for batch in batches:
+        if key in batch.entries:
+            batch.entries[key] = (instance, send)
+            return
+        if kind == 'update' and ('new', model, instance.pk) in batch.entries:
+            return
+    # Broadcasts are batched per savepoint, so that rolling one back drops only the broadcasts queued inside it.
+    savepoint_ids = tuple(transaction.get_connection().savepoint_ids)
+    if batches and batches[-1].savepoint_ids == savepoint_ids:
+        batch = batches[-1]
+    else:
+        batch = BroadcastBatch(savepoint_ids)
+        PENDING_BROADCASTS.batches.append(ref(batch))
+    batch.entries[key] = (instance, send)
+
+
 def update_websocket(model):
     """
     Used to connect a model to broadcast out changes when updates are made. Attach a signal to have the instance run
     through the specified serializers and broadcasted to the listening clients.
     """
     def update_broadcaster(instance: Model, created=False, **kwargs):
-        if not transaction.get_autocommit():
-            # If we're in a transaction, delay this until we're completely finished.
-            transaction.on_commit(lambda: update_broadcaster(instance, created=created, **kwargs))
-            return
         if created:
-            send_new(model, instance)
+            defer_broadcast('new', model, instance, send_new)
         else:
-            send_updated(model, instance)
+            defer_broadcast('update', model, instance, send_updated)
 
     def delete_broadcaster(instance: Model, **kwargs):
-        if not transaction.get_autocommit():
-            # If we're in a transaction, delay this until we're completely finished.
-            transaction.on_commit(lambda: delete_broadcaster(instance, **kwargs))
-            return
-        send_deleted(model, instance)
+        defer_broadcast('delete', model, instance, send_deleted)
     post_save.connect(update_broadcaster, sender=model, weak=False)
     post_delete.connect(delete_broadcaster, sender=model, weak=False)
 
@@ -134,6 +229,9 @@ _registered_models = {}
 def register_serializer(cls: Type[ModelSerializer]):
     """
     Registers a serializer for broadcasted updates of a model.
+
+    Set viewer_independent = True on serializers whose output doesn't depend on who is viewing. These are serialized
+    once when a change is broadcast instead of once per listening client.
     """
     model = cls.Meta.model
     if not hasattr(model, 'watch_permissions'):
@@ -162,14 +260,27 @@ def get_serializer_data(serializer_class: Type[Serializer], instance: Model, con
     return serializer.data
 
 
-async def git_version():
-    proc = await asyncio.create_subprocess_exec(
-        'git', 'rev-parse', '--short', 'HEAD',
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, _stderr = await proc.communicate()
-    return stdout.decode('utf-8').strip()
+def json_patch(old: Any, new: Any, path: str = '') -> List[dict]:
+    """
+    Lists the operations, in the style of RFC 6902 JSON patches, which turn old into new. Dictionaries are compared
+    key by key. Anything else, lists included, is replaced whole if it differs.
+    """
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return [] if old == new else [{'op': 'replace', 'path': path, 'value': new}]
+    operations = []
+    for key in old:
+        if key not in new:
+            operations.append({'op': 'remove', 'path': f'{path}/{escape_pointer(key)}'})
+    for key, value in new.items():
+        if key not in old:
+            operations.append({'op': 'add', 'path': f'{path}/{escape_pointer(key)}', 'value': value})
+        else:
+            operations.extend(json_patch(old[key], value, f'{path}/{escape_pointer(key)}'))
+    return operations
+
+
+def escape_pointer(key: Any) -> str:
+    return str(key).replace('~', '~0').replace('/', '~1')
 
 
 def error_command(message: str):
@@ -183,13 +294,7 @@ def error_command(message: str):
 
 
 async def version(consumer, _payload):
-    if settings.DEBUG:
-        return {'command': 'version', 'payload': {'version': await git_version()}}
-    try:
-        async with async_open(f'{settings.BASE_DIR}/.static_hash_head', 'r') as current_hash:
-            return {'command': 'version', 'payload': {'version': (await current_hash.read()).strip()}}
-    except IOError:
-        return {'command': 'version', 'payload': {'version': '######'}}
+    return version_command(await SA(current_version)())
 
 
 async def viewer(consumer, payload):
@@ -200,10 +305,7 @@ async def viewer(consumer, payload):
     user = consumer.scope['user']
     user_info = await detailed_user_info(user=user, session=session)
     consumer.scope['socket_key'] = payload['socket_key']
-    await consumer.channel_layer.group_add(
-        f'client.socket_key.{payload["socket_key"]}',
-        consumer.channel_name,
-    )
+    await consumer.join_group(f'client.socket_key.{payload["socket_key"]}')
     return {'command': 'viewer', 'payload': user_info}
 
 
@@ -214,7 +316,7 @@ async def aprint(value: Any):
     await sync_to_async(pprint)(value)
 
 
-async def can_watch(*, user: User, instance: Type[Model], serializer_name: Optional[str]):
+def check_watch(user: User, instance: Model, serializer_name: Optional[str]) -> bool:
     """
     Runs a permissions check on a model to see if the listening user can watch it or not.
     """
@@ -226,11 +328,28 @@ async def can_watch(*, user: User, instance: Type[Model], serializer_name: Optio
     if permission_check is None:
         raise ValueError('That model does not support watching.')
     for perm in permission_check[serializer_name]:
-        if not await SA(perm().has_object_permission)(request, None, instance):
+        if not perm().has_object_permission(request, None, instance):
             return False
     return True
 
 
+async def can_watch(*, user: User, instance: Model, serializer_name: Optional[str]):
+    return await SA(check_watch)(user, instance, serializer_name)
+
+
+def check_watch_many(user: User, checks: List[Tuple[Model, Optional[str]]]) -> List[bool]:
+    """
+    Runs check_watch over several instances, treating any which can't be watched at all as forbidden.
+    """
+    results = []
+    for instance, serializer_name in checks:
+        try:
+            results.append(check_watch(user, instance, serializer_name))
+        except ValueError:
+            results.append(False)
+    return results
+
+
 async def watch_new(consumer, payload: Dict):
     from apps.lib.consumer_serializers import WatchNewSpecSerializer
     serializer = WatchNewSpecSerializer(data=payload)
@@ -244,21 +363,32 @@ async def watch_new(consumer, payload: Dict):
         model = apps.get_model(app_label, model_name)
         if pk:
             instance = await get_instance(model=model, pk=pk)
-            if not await can_watch(user=consumer.scope['user'], instance=instance, serializer_name=None):
+            if not await consumer.can_watch(instance, None):
                 raise ObjectDoesNotExist
             channel = f'{app_label}.{model_name}.pk.{pk}.{list_name}.{serializer_name}'
         else:
             channel = f'{app_label}.{model_name}.{list_name}'
-        await consumer.channel_layer.group_add(
-            channel,
-            consumer.channel_name,
-        )
+        await consumer.join_group(channel)
     except ValueError as err:
         return error_command(
             f'Encountered error when subscribing: {err} ::'
             f'{app_label}.{model_name} pk={pk}')
 
 
+def watch_groups(app_label: str, model_name: str, serializer_name: str, pk: Any) -> List[str]:
+    """
+    The groups a client joins to watch an object.
+    """
+    return [
+        f'{app_label}.{model_name}.update.{serializer_name}.{pk}',
+        f'{app_label}.{model_name}.delete.{pk}',
+    ]
+
+
+def describe_spec(spec: Dict) -> str:
+    return f'{spec["app_label"]}.{spec["model_name"]} pk={spec["pk"]} serializer={spec["serializer"]}'
+
+
 async def watch(consumer, payload: Dict):
     """
     Subscribes to changes on an object. The subscription must pass a permissions check,
@@ -274,15 +404,12 @@ async def watch(consumer, payload: Dict):
     try:
         model = apps.get_model(app_label, model_name)
         instance = await get_instance(model=model, pk=pk)
-        if not await can_watch(user=consumer.scope['user'], instance=instance, serializer_name=serializer_name):
+        if not await consumer.can_watch(instance, serializer_name):
             raise ObjectDoesNotExist
-        await consumer.channel_layer.group_add(
-            f'{app_label}.{model_name}.update.{serializer_name}.{instance.pk}',
-            consumer.channel_name,
-        )
-        await consumer.channel_layer.group_add(
-            f'{app_label}.{model_name}.delete.{instance.pk}',
-            consumer.channel_name,
+        for group in watch_groups(app_label, model_name, serializer_name, instance.pk):
+            await consumer.join_group(group)
+        consumer.track_deltas(
+            (instance._meta.label, str(instance.pk), serializer_name), serializer.validated_data['deltas'],
         )
     except (ObjectDoesNotExist, ValueError):
         return error_command(
@@ -292,8 +419,69 @@ async def watch(consumer, payload: Dict):
         return error_command(str(err))
 
 
+async def watch_many(consumer, payload: Dict):
+    """
+    Subscribes to changes on several objects at once. Instances are fetched with one query per model and authorized
+    together, and the groups are all joined concurrently. Reports any objects which could not be watched.
+    """
+    serializer = WatchManySerializer(data=payload)
+    if not serializer.is_valid():
+        return error_command(flatten_errors(serializer))
+    specs = serializer.validated_data['specs']
+    specs_by_model = defaultdict(list)
+    for spec in specs:
+        specs_by_model[(spec['app_label'], spec['model_name'])].append(spec)
+    failures = []
+    found = []
+    for (app_label, model_name), model_specs in specs_by_model.items():
+        try:
+            model = apps.get_model(app_label, model_name)
+            instances = await get_instances(model, [spec['pk'] for spec in model_specs])
+        except (LookupError, ValueError, ValidationError):
+            failures.extend(model_specs)
+            continue
+        for spec in model_specs:
+            instance = instances.get(str(spec['pk']))
+            if instance is None:
+                failures.append(spec)
+            else:
+                found.append((spec, instance))
+    allowed = await consumer.can_watch_many([(instance, spec['serializer']) for spec, instance in found])
+    groups = []
+    for (spec, instance), permitted in zip(found, allowed):
+        if not permitted:
+            failures.append(spec)
+            continue
+        groups.extend(watch_groups(spec['app_label'], spec['model_name'], spec['serializer'], instance.pk))
+        consumer.track_deltas(
+            (instance._meta.label, str(instance.pk), spec['serializer']), spec['deltas'],
+        )
+    await consumer.join_groups(groups)
+    if failures:
+        return error_command(
+            'Could not find these objects, or you do not have permission to watch them: '
+            + '; '.join(describe_spec(spec) for spec in failures)
+        )
+
+
+async def clear_watch_many(consumer, payload: Dict):
+    """
+    Stops watching changes on several objects at once.
+    """
+    serializer = WatchManySerializer(data=payload)
+    if not serializer.is_valid():
+        return error_command(flatten_errors(serializer))
+    groups = []
+    for spec in serializer.validated_data['specs']:
+        groups.extend(watch_groups(spec['app_label'], spec['model_name'], spec['serializer'], spec['pk']))
+        consumer.track_deltas(
+            (f'{spec["app_label"]}.{spec["model_name"]}', str(spec['pk']), spec['serializer']), False,
+        )
+    await consumer.leave_groups(groups)
+
+
 def flatten_errors(serializer: Serializer):
-    return ','.join(f'{key}: {",".join(value)}' for key, value in serializer.errors.items())
+    return ','.join(f'{key}: {",".join(str(item) for item in value)}' for key, value in serializer.errors.items())
 
 
 async def clear_watch(consumer, payload: Dict):
@@ -306,14 +494,9 @@ async def clear_watch(consumer, payload: Dict):
     app_label, model_name, serializer, pk = (
         payload['app_label'], payload['model_name'], payload['serializer'], payload['pk'],
     )
-    await consumer.channel_layer.group_discard(
-        f'{app_label}.{model_name}.update.{serializer}.{pk}',
-        consumer.channel_name,
-    )
-    await consumer.channel_layer.group_discard(
-        f'{app_label}.{model_name}.delete.{pk}',
-        consumer.channel_name,
-    )
+    for group in watch_groups(app_label, model_name, serializer, pk):
+        await consumer.leave_group(group)
+    consumer.track_deltas((f'{app_label}.{model_name}', str(pk), serializer), False)
 
 
 async def clear_watch_new(consumer, payload: Dict):
@@ -327,10 +510,7 @@ async def clear_watch_new(consumer, payload: Dict):
         payload['app_label'], payload['model_name'], payload['serializer'], payload['pk'],
         payload['list_name']
     )
-    await consumer.channel_layer.group_discard(
-        f'{app_label}.{model_name}.pk.{pk}.{list_name}.{serializer_name}',
-        consumer.channel_name,
-    )
+    await consumer.leave_group(f'{app_label}.{model_name}.pk.{pk}.{list_name}.{serializer_name}')
 
 
 @database_sync_to_async
@@ -338,6 +518,14 @@ def get_instance(model, pk: Any):
     return model.objects.get(pk=pk)
 
 
+@database_sync_to_async
+def get_instances(model, pks: List[Any]) -> Dict[str, Model]:
+    """
+    Fetches several instances of a model in one query, keyed by the string form of their primary keys.
+    """
+    return {str(pk): instance for pk, instance in model.objects.in_bulk(pks).items()}
+
+
 COMMANDS = {
     'version': {'func': version, 'serializer': EmptySerializer},
     'viewer': {'func': viewer, 'serializer': ViewerParamsSerializer},
@@ -345,20 +533,231 @@ COMMANDS = {
     'watch_new': {'func': watch_new, 'serializer': WatchNewSpecSerializer},
     'clear_watch': {'func': clear_watch, 'serializer': WatchSpecSerializer},
     'clear_watch_new': {'func': clear_watch_new, 'serializer': WatchNewSpecSerializer},
+    'watch_many': {'func': watch_many, 'serializer': WatchManySerializer},
+    'clear_watch_many': {'func': clear_watch_many, 'serializer': WatchManySerializer},
 }
 
 
+def group_membership_counts(limit: Optional[int] = None) -> Dict[str, int]:
+    """
+    Reports how many connections in this process belong to each channel layer group, largest first. Meant for
+    monitoring, to spot groups whose broadcasts fan out widely. Reported by the realtime stats endpoint.
+    """
+    return dict(GROUP_MEMBERS.most_common(limit))
+
+
+def outbox_counts() -> Dict[str, int]:
+    """
+    Reports how many outgoing websocket messages this process has coalesced or dropped, and how many resyncs it has
+    sent as a result. Reported by the realtime stats endpoint.
+    """
+    return {name: OUTBOX_COUNTS[name] for name in ('coalesced', 'dropped', 'resyncs')}
+
+
 class EventConsumer(AsyncJsonWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.permission_cache = {}
+        self.joined_groups = set()
+        self.delta_watches = set()
+        self.last_payloads = {}
+        # Messages waiting for the writer, each built only when it is sent. Keyed so that a newer update for the same
+        # object can take the place of one not yet sent.
+        self.outbox = OrderedDict()
+        self.outbox_ready = asyncio.Event()
+        self.outbox_serial = 0
+        self.writer = None
+        self.coalesced = 0
+        self.dropped = 0
+
     async def connect(self):
         await self.accept()
+        self.writer = asyncio.ensure_future(self.write_outbox())
+        await self.join_group(VERSION_GROUP)
 
-    async def disconnect(self, code):
-        key = self.scope.get('socket_key')
-        if key:
-            await self.channel_layer.group_discard(
-                f'client.socket_key.{key}',
-                self.channel_name,
+    def queue_message(self, build: Callable[[], dict], key: Optional[tuple] = None):
+        """
+        Queues a message for the client. If a message with the same key is still waiting, this one replaces it. If the
+        outbox is full, everything waiting is dropped in favor of a single resync command, after which the client
+        should refetch whatever it's showing.
+        """
+        if 'resync' in self.outbox:
+            self.count_outbox('dropped')
+            return
+        if key is not None and key in self.outbox:
+            self.outbox[key] = build
+            self.count_outbox('coalesced')
+            return
+        if len(self.outbox) >= OUTBOX_SIZE:
+            self.count_outbox('dropped', len(self.outbox) + 1)
+            OUTBOX_COUNTS['resyncs'] += 1
+            self.outbox.clear()
+            # Any patches would be against payloads the client is about to replace.
+            self.last_payloads.clear()
+            self.outbox['resync'] = lambda: {'command': 'resync', 'payload': {}}
+        else:
+            if key is None:
+                self.outbox_serial += 1
+                key = self.outbox_serial
+            self.outbox[key] = build
+        self.outbox_ready.set()
+
+    def count_outbox(self, name: str, amount: int = 1):
+        if name == 'dropped':
+            self.dropped += amount
+        else:
+            self.coalesced += amount
+        OUTBOX_COUNTS[name] += amount
+
+    async def write_outbox(self):
+        while True:
+            await self.outbox_ready.wait()
+            while self.outbox:
+                _key, build = self.outbox.popitem(last=False)
+                try:
+                    content = build()
+                except Exception as err:
+                    # Skip just this message. The client still gets the rest.
+                    logger.exception(err)
+                    continue
+                try:
+                    await super().send_json(content)
+                except Exception as err:
+                    # Nothing more can be sent over this connection. Closing it has the client reconnect and resync,
+                    # rather than being left connected to a consumer that will never write to it again.
+                    logger.exception(err)
+                    await self.close()
+                    return
+            self.outbox_ready.clear()
+
+    async def send_json(self, content, close=False):
+        if close:
+            await super().send_json(content, close=close)
+            return
+        self.queue_message(lambda: content)
+
+    async def can_watch(self, instance: Model, serializer_name: Optional[str]) -> bool:
+        """
+        Checks whether this connection's user may watch an instance, remembering the answer for a short while.
+        """
+        key = (instance._meta.label, str(instance.pk), serializer_name)
+        cached = self.permission_cache.get(key)
+        now = monotonic()
+        if cached and cached[1] > now:
+            return cached[0]
+        allowed = await can_watch(user=self.scope['user'], instance=instance, serializer_name=serializer_name)
+        if len(self.permission_cache) >= PERMISSION_CACHE_SIZE:
+            self.permission_cache.clear()
+        self.permission_cache[key] = (allowed, now + PERMISSION_CACHE_TTL)
+        return allowed
+
+    async def can_watch_many(self, checks: List[Tuple[Model, Optional[str]]]) -> List[bool]:
+        """
+        Checks several (instance, serializer_name) pairs at once. Those without a remembered decision are all
+        checked in a single trip to the sync thread. Pairs which can't be watched at all come back False.
+        """
+        now = monotonic()
+        results = []
+        unknown = []
+        for index, (instance, serializer_name) in enumerate(checks):
+            cached = self.permission_cache.get((instance._meta.label, str(instance.pk), serializer_name))
+            if cached and cached[1] > now:
+                results.append(cached[0])
+            else:
+                results.append(None)
+                unknown.append(index)
+        if not unknown:
+            return results
+        decisions = await SA(check_watch_many)(self.scope['user'], [checks[index] for index in unknown])
+        if len(self.permission_cache) + len(unknown) > PERMISSION_CACHE_SIZE:
+            self.permission_cache.clear()
+        for index, allowed in zip(unknown, decisions):
+            instance, serializer_name = checks[index]
+            results[index] = allowed
+            self.permission_cache[(instance._meta.label, str(instance.pk), serializer_name)] = (
+                allowed, now + PERMISSION_CACHE_TTL,
             )
+        return results
+
+    def forget_permissions(self, contents: dict):
+        """
+        Drops any remembered permission decisions for the instance a group message is about.
+        """
+        label, pk = f'{contents["app_label"]}.{contents["model_name"]}', str(contents['pk'])
+        for key in [key for key in self.permission_cache if key[:2] == (label, pk)]:
+            del self.permission_cache[key]
+
+    def track_deltas(self, key: Tuple[str, str, str], enabled: bool):
+        """
+        Sets whether updates for a (model label, pk, serializer) key may be sent as patches. Either way, the next
+        update is sent in full, since the client has just fetched the object or stopped listening to it.
+        """
+        if enabled:
+            self.delta_watches.add(key)
+        else:
+            self.delta_watches.discard(key)
+        self.last_payloads.pop(key, None)
+
+    def update_fields(self, key: Tuple[str, str, str], data: dict) -> dict:
+        """
+        Builds the body of an update message. For keys watched with deltas, each update is numbered, and sent as a
+        patch against the previous revision when that's smaller than the payload. A full payload goes out for the
+        first update, and whenever the deployed version has changed since the last one, as serializers may differ.
+        """
+        if key not in self.delta_watches:
+            return {'payload': data}
+        # This runs on the event loop, so it can't wait on the filesystem. The version is read at startup.
+        version = cached_version()
+        previous = self.last_payloads.get(key)
+        revision = previous[1] + 1 if previous else 1
+        if previous is None and len(self.last_payloads) >= DELTA_CACHE_SIZE:
+            self.last_payloads.clear()
+        self.last_payloads[key] = (version, revision, data)
+        if previous and previous[0] == version:
+            patch = json_patch(previous[2], data)
+            if len(json.dumps(patch, cls=JSONEncoder)) < len(json.dumps(data, cls=JSONEncoder)):
+                return {'patch': patch, 'base': previous[1], 'revision': revision}
+        return {'payload': data, 'revision': revision}
+
+    async def join_group(self, group: str):
+        """
+        Adds this connection to a channel layer group, remembering it so it can be discarded on disconnect.
+        """
+        if group not in self.joined_groups:
+            self.joined_groups.add(group)
+            GROUP_MEMBERS[group] += 1
+        await self.channel_layer.group_add(group, self.channel_name)
+
+    async def join_groups(self, groups: List[str]):
+        await asyncio.gather(*(self.join_group(group) for group in groups))
+
+    def forget_group(self, group: str):
+        if group not in self.joined_groups:
+            return
+        self.joined_groups.remove(group)
+        GROUP_MEMBERS[group] -= 1
+        if GROUP_MEMBERS[group] <= 0:
+            del GROUP_MEMBERS[group]
+
+    async def leave_group(self, group: str):
+        self.forget_group(group)
+        await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def leave_groups(self, groups: List[str]):
+        for group in groups:
+            self.forget_group(group)
+        results = await asyncio.gather(
+            *(self.channel_layer.group_discard(group, self.channel_name) for group in groups),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def disconnect(self, code):
+        if self.writer is not None:
+            self.writer.cancel()
+        await self.leave_groups(list(self.joined_groups))
 
     async def receive_json(self, content, **_kwargs):
         command_name = content.get('command')
@@ -397,12 +796,14 @@ class EventConsumer(AsyncJsonWebsocketConsumer):
         except ObjectDoesNotExist:
             # Object deleted between then and now.
             return None
-        if not await can_watch(user=self.scope['user'], instance=instance, serializer_name=serializer_name):
+        if not await self.can_watch(instance, serializer_name):
             return None
-        serializer_class = BROADCAST_SERIALIZERS[model][contents['serializer']]
-        data = await get_serializer_data(
-            serializer_class, instance, context={'request': FakeRequest(user=self.scope['user'])},
-        )
+        data = contents.get('payload')
+        if data is None:
+            serializer_class = BROADCAST_SERIALIZERS[model][contents['serializer']]
+            data = await get_serializer_data(
+                serializer_class, instance, context={'request': FakeRequest(user=self.scope['user'])},
+            )
         await self.send_json(
             {'command': f'{list_name}.new',
              'payload': data,
@@ -414,20 +815,29 @@ class EventConsumer(AsyncJsonWebsocketConsumer):
         Used when a model is updated and its serialized data needs to be pushed outward to listening clients.
         """
         contents = event['contents']
-        model = apps.get_model(contents['app_label'], contents['model_name'])
-        try:
-            instance = await get_instance(model, pk=contents['pk'])
-        except ObjectDoesNotExist:
-            # Object deleted between then and now.
-            return None
-        serializer_class = BROADCAST_SERIALIZERS[model][contents['serializer']]
-        data = await get_serializer_data(
-            serializer_class, instance, context={'request': FakeRequest(user=self.scope['user'])},
-        )
-        await self.send_json(
-            {'command': f'{contents["app_label"]}.{contents["model_name"]}.update.{contents["serializer"]}.{contents["pk"]}',
-             'payload': data,
-             'exclude': event.get('exclude', [])},
+        self.forget_permissions(contents)
+        data = contents.get('payload')
+        if data is None:
+            model = apps.get_model(contents['app_label'], contents['model_name'])
+            try:
+                instance = await get_instance(model, pk=contents['pk'])
+            except ObjectDoesNotExist:
+                # Object deleted between then and now.
+                return None
+            serializer_class = BROADCAST_SERIALIZERS[model][contents['serializer']]
+            data = await get_serializer_data(
+                serializer_class, instance, context={'request': FakeRequest(user=self.scope['user'])},
+            )
+        key = (f'{contents["app_label"]}.{contents["model_name"]}', str(contents['pk']), contents['serializer'])
+        command = f'{contents["app_label"]}.{contents["model_name"]}.update.{contents["serializer"]}.{contents["pk"]}'
+        # Built when sent, so that a patch is always against the payload the client last received.
+        self.queue_message(
+            lambda: {
+                'command': command,
+                **self.update_fields(key, data),
+                'exclude': event.get('exclude', []),
+            },
+            key=('update', *key),
         )
 
     async def delete_model(self, event):
@@ -435,6 +845,14 @@ class EventConsumer(AsyncJsonWebsocketConsumer):
         Used when a model is updated and its serialized data needs to be pushed outward to listening clients.
         """
         contents = event['contents']
+        self.forget_permissions(contents)
+        label, pk = f'{contents["app_label"]}.{contents["model_name"]}', str(contents['pk'])
+        for key in [key for key in self.last_payloads if key[:2] == (label, pk)]:
+            del self.last_payloads[key]
+        # Updates not yet sent are moot now.
+        for key in [key for key in self.outbox if isinstance(key, tuple) and key[:3] == ('update', label, pk)]:
+            del self.outbox[key]
+            self.count_outbox('coalesced')
         await self.send_json(
             {'command': f'{contents["app_label"]}.{contents["model_name"]}.delete.{contents["pk"]}',
              'payload': {},
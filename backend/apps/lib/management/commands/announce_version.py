@@ -0,0 +1,22 @@
+from typing import Dict, List
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from apps.lib.version import current_version, version_command, VERSION_GROUP
+
+
+class Command(BaseCommand):
+    """
+    Run after a deploy writes the new version, so that connected clients learn of it right away. Sent directly rather
+    than through the background publisher, since this process exits as soon as the command finishes.
+    """
+    help = 'Pushes the current version to every connected websocket client.'
+
+    def handle(self, *args: List, **options: Dict):
+        version = current_version()
+        async_to_sync(get_channel_layer().group_send)(
+            VERSION_GROUP, {'type': 'broadcast', 'contents': version_command(version)},
+        )
+        self.stdout.write(f'Announced version {version}.')
@@ -0,0 +1,184 @@
+import asyncio
+from statistics import quantiles
+from time import perf_counter
+from typing import Dict, List
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from moneyed import Money
+from short_stuff import gen_shortcode
+
+from apps.lib.consumers import EventConsumer
+from apps.profiles.models import User, ArtistProfile
+from apps.sales.models import Deliverable, Order, Invoice, LineItem, ADD_ON, TransactionRecord
+
+SA = sync_to_async
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    """
+    Simulated clients connect straight to EventConsumer, each watching the same deliverable for updates and its line
+    item list for new entries. The deliverable is then saved and line items created as fast as possible, and each
+    client notes when the resulting broadcasts reach it.
+
+    Consumers do their database work on this thread, so every query they run is counted along with those from the
+    saves themselves. The fixtures are left in place afterward.
+    """
+    help = 'Measures broadcast latency, throughput and queries per broadcast for the websocket consumer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Number of simulated clients.')
+        parser.add_argument('--updates', type=int, default=100, help='Number of times to save the watched object.')
+        parser.add_argument('--new-items', type=int, default=20, help='Number of new list items to create.')
+        parser.add_argument(
+            '--timeout', type=float, default=5,
+            help='Seconds a client waits for another message before deciding it has received everything.',
+        )
+        parser.add_argument(
+            '--redis', action='store_true',
+            help='Use the configured channel layer rather than an in-memory one.',
+        )
+
+    def handle(self, *args: List, **options: Dict):
+        if not settings.DEBUG:
+            raise RuntimeError('This command creates throwaway data, and should not be run in production.')
+        layers = settings.CHANNEL_LAYERS
+        if not options['redis']:
+            layers = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}},
+            }
+        # The in-memory layer belongs to this command's event loop, so messages can't be handed to a publisher thread.
+        publisher = options['redis'] and settings.CHANNEL_PUBLISHER
+        counter = QueryCounter()
+        with override_settings(CHANNEL_LAYERS=layers, CHANNEL_PUBLISHER=publisher):
+            deliverable = self.create_deliverable()
+            with connection.execute_wrapper(counter):
+                results = async_to_sync(self.benchmark)(deliverable, counter, options)
+        self.report(results, options)
+
+    def create_user(self) -> User:
+        username = f'benchmark_{gen_shortcode()}'
+        user = User.objects.create(username=username, email=f'{username}@localhost')
+        ArtistProfile.objects.create(user=user)
+        return user
+
+    def create_deliverable(self) -> Deliverable:
+        buyer = self.create_user()
+        order = Order.objects.create(seller=self.create_user(), buyer=buyer)
+        return Deliverable.objects.create(
+            name='Benchmark', order=order, invoice=Invoice.objects.create(bill_to=buyer),
+        )
+
+    async def benchmark(self, deliverable: Deliverable, counter: QueryCounter, options: Dict) -> Dict:
+        communicators = []
+        for _ in range(options['clients']):
+            communicator = WebsocketCommunicator(EventConsumer.as_asgi(), '/ws/events/')
+            communicator.scope['user'] = deliverable.order.buyer
+            communicator.scope['client'] = ('127.0.0.1', '1234')
+            connected, _subprotocol = await communicator.connect()
+            assert connected
+            await communicator.send_json_to({
+                'command': 'watch',
+                'payload': {
+                    'app_label': 'sales',
+                    'model_name': 'Deliverable',
+                    'pk': deliverable.pk,
+                    'serializer': 'DeliverableViewSerializer',
+                },
+            })
+            await communicator.send_json_to({
+                'command': 'watch_new',
+                'payload': {
+                    'app_label': 'sales',
+                    'model_name': 'Deliverable',
+                    'pk': deliverable.pk,
+                    'list_name': 'line_items',
+                    'serializer': 'LineItemSerializer',
+                },
+            })
+            await communicator.receive_nothing()
+            communicators.append(communicator)
+        update_times = {}
+        new_item_times = {}
+        latencies = []
+        received = []
+
+        async def listen(communicator: WebsocketCommunicator):
+            # Other broadcasts can repeat an earlier payload, so only the first arrival of each one is timed.
+            seen = set()
+            while True:
+                try:
+                    message = await communicator.receive_json_from(timeout=options['timeout'])
+                except asyncio.TimeoutError:
+                    return
+                now = perf_counter()
+                received.append(now)
+                command, payload = message['command'], message.get('payload') or {}
+                sent = None
+                if command.endswith('.line_items.LineItemSerializer.new'):
+                    key = ('new', payload.get('id'))
+                    sent = new_item_times.get(key[1])
+                elif '.update.' in command:
+                    key = ('update', payload.get('details'))
+                    sent = update_times.get(key[1])
+                if sent is not None and key not in seen:
+                    seen.add(key)
+                    latencies.append(now - sent)
+
+        listeners = [asyncio.ensure_future(listen(communicator)) for communicator in communicators]
+        queries_before = counter.count
+        start = perf_counter()
+        for index in range(options['updates']):
+            deliverable.details = f'benchmark-{index}'
+            update_times[deliverable.details] = perf_counter()
+            await SA(deliverable.save)()
+        for _ in range(options['new_items']):
+            created = perf_counter()
+            line_item = await SA(LineItem.objects.create)(
+                invoice=deliverable.invoice, type=ADD_ON, priority=1, amount=Money('15.00', 'USD'),
+                destination_account=TransactionRecord.ESCROW,
+            )
+            new_item_times[line_item.id] = created
+        await asyncio.gather(*listeners)
+        queries = counter.count - queries_before
+        for communicator in communicators:
+            await communicator.disconnect()
+        return {
+            'broadcasts': options['updates'] + options['new_items'],
+            'messages': len(received),
+            'elapsed': (max(received) if received else perf_counter()) - start,
+            'latencies': latencies,
+            'queries': queries,
+        }
+
+    def report(self, results: Dict, options: Dict):
+        broadcasts, messages, elapsed = results['broadcasts'], results['messages'], results['elapsed']
+        self.stdout.write(f'Clients: {options["clients"]}')
+        self.stdout.write(f'Broadcasts: {broadcasts}')
+        self.stdout.write(f'Messages delivered: {messages} (expected at least {broadcasts * options["clients"]})')
+        self.stdout.write(f'Elapsed: {elapsed:.3f}s')
+        self.stdout.write(f'Messages/sec: {messages / elapsed:.1f}' if elapsed else 'Messages/sec: n/a')
+        latencies = sorted(results['latencies'])
+        if len(latencies) >= 2:
+            cuts = quantiles(latencies, n=100)
+            self.stdout.write(
+                f'Latency (ms): p50 {cuts[49] * 1000:.1f}, p90 {cuts[89] * 1000:.1f}, '
+                f'p99 {cuts[98] * 1000:.1f}, max {latencies[-1] * 1000:.1f}',
+            )
+        self.stdout.write(
+            f'Queries: {results["queries"]} total, {results["queries"] / broadcasts:.1f} per broadcast'
+            if broadcasts else f'Queries: {results["queries"]} total',
+        )
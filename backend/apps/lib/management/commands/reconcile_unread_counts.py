@@ -0,0 +1,23 @@
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+
+from apps.lib.utils import rebuild_unread_counts
+from apps.profiles.models import User
+
+
+class Command(BaseCommand):
+    """
+    The unread counters are maintained as notifications change, so this should only be needed if they've drifted,
+    for instance after notifications were modified by hand.
+    """
+    help = 'Rebuilds the unread notification counters from the notification tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only rebuild the counters for these users.')
+
+    def handle(self, *args: List, **options: Dict):
+        users = User.objects.all()
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        rebuild_unread_counts(users)
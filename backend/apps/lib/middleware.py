@@ -1,10 +1,31 @@
 import re
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
 from threading import currentThread
 
 from dateutil import parser
+from django.db import connection
+from django.db.models import Q
 from hitcount.utils import get_ip
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils import json
+from rest_framework.utils.urls import replace_query_param
+
+
+def estimate_count(queryset) -> int:
+    """
+    Returns the query planner's estimate of how many rows a queryset will return. This is far cheaper than a COUNT on
+    large tables, but can be well off for heavily filtered querysets.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
 
 
 class ResizablePagination(PageNumberPagination):
@@ -23,7 +44,84 @@ class ResizablePagination(PageNumberPagination):
         })
 
 
-class OlderThanPagination(ResizablePagination):
+class KeysetPagination(ResizablePagination):
+    """
+    Paginates a queryset newest first by (timestamp, id), using opaque cursors rather than page numbers so that deep
+    pages are as cheap as the first. Clients opt in by sending the cursor parameter, empty for the first page, and
+    then following the next link. Without it, this falls back to page numbers.
+
+    In cursor mode, the count is the query planner's estimate unless exact_count is set.
+    """
+    cursor_query_param = 'cursor'
+    timestamp_field = 'created_on'
+    exact_count = False
+    invalid_cursor_message = 'Invalid cursor'
+    use_cursor = False
+
+    def encode_cursor(self, item) -> str:
+        position = [getattr(item, self.timestamp_field).isoformat(), item.id]
+        return urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor: str):
+        if not cursor:
+            return None
+        try:
+            timestamp, pk = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            return parser.parse(timestamp), int(pk)
+        except (BinasciiError, UnicodeError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view=view)
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request = request
+        self.use_cursor = True
+        self.count = queryset.count() if self.exact_count else estimate_count(queryset)
+        position = self.decode_cursor(request.query_params[self.cursor_query_param])
+        queryset = queryset.order_by(f'-{self.timestamp_field}', '-id')
+        if position:
+            timestamp, pk = position
+            queryset = queryset.filter(
+                Q(**{f'{self.timestamp_field}__lt': timestamp}) | Q(**{self.timestamp_field: timestamp, 'id__lt': pk}),
+            )
+        results = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_cursor = self.encode_cursor(results[-1])
+        return results
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_previous_link(self):
+        if not self.use_cursor:
+            return super().get_previous_link()
+        # Cursors only run forward. Clients keep the pages they've already loaded.
+        return None
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        return Response({
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'count': self.count,
+            'results': data,
+            "size": self.get_page_size(self.request),
+        })
+
+
+class OlderThanPagination(KeysetPagination):
     """
     Paginates a queryset based on when items in the set were created.
     """
@@ -31,6 +129,8 @@ class OlderThanPagination(ResizablePagination):
     timestamp_query = 'created_on__lt'
 
     def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            return super().paginate_queryset(queryset, request, view=view)
         page_size = self.get_page_size(request)
         if not page_size:
             return None
@@ -44,6 +144,10 @@ class OlderThanPagination(ResizablePagination):
         return super().paginate_queryset(queryset.filter(**{self.timestamp_query: timestamp}), request, view=view)
 
 
+class NotificationPagination(KeysetPagination):
+    timestamp_field = 'date'
+
+
 ip_pattern = re.compile('[0-9]+[.][0-9]+[.][0-9]+[.][0-9]+')
 
 
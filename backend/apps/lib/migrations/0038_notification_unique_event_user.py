@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lib', '0037_auto_20221030_1740'),
+    ]
+
+    operations = [
+        # Any duplicate notifications must be cleared out before the constraint can be added. Keep the oldest.
+        migrations.RunSQL(
+            """
+            DELETE FROM lib_notification AS duplicate
+            USING lib_notification AS original
+            WHERE duplicate.event_id = original.event_id
+            AND duplicate.user_id = original.user_id
+            AND duplicate.id > original.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='notification',
+            unique_together={('event', 'user')},
+        ),
+    ]
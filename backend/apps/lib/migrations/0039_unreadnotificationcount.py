@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('lib', '0038_notification_unique_event_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadNotificationCount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('community', models.IntegerField(default=0)),
+                ('sales', models.IntegerField(default=0)),
+            ],
+        ),
+        # Backfill from the existing notifications. The type list mirrors ORDER_NOTIFICATION_TYPES, and comments count
+        # as sales notifications when they're on orders, deliverables, references, or revisions.
+        migrations.RunSQL(
+            """
+            INSERT INTO lib_unreadnotificationcount (user_id, community, sales)
+            SELECT counted.user_id, counted.total - counted.sales, counted.sales FROM (
+                SELECT notification.user_id, COUNT(*) AS total, COUNT(*) FILTER (
+                    WHERE event.type IN (15, 19, 18, 29, 27, 28, 22, 32, 16, 35, 36)
+                    OR (event.type = 4 AND event.content_type_id IN (
+                        SELECT id FROM django_content_type
+                        WHERE app_label = 'sales' AND model IN ('order', 'reference', 'revision', 'deliverable')
+                    ))
+                ) AS sales
+                FROM lib_notification AS notification
+                INNER JOIN lib_event AS event ON event.id = notification.event_id
+                WHERE NOT notification.read AND NOT event.recalled
+                GROUP BY notification.user_id
+            ) AS counted;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('lib', '0039_unreadnotificationcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='category',
+            field=models.IntegerField(choices=[(0, 'Community'), (1, 'Sales')], default=0),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='date',
+            field=models.DateTimeField(null=True),
+        ),
+        # As in 0039, the type list mirrors ORDER_NOTIFICATION_TYPES, and comments are sales notifications when
+        # they're on orders, deliverables, references, or revisions.
+        migrations.RunSQL(
+            """
+            UPDATE lib_notification AS notification SET date = event.date, category = CASE WHEN (
+                event.type IN (15, 19, 18, 29, 27, 28, 22, 32, 16, 35, 36)
+                OR (event.type = 4 AND event.content_type_id IN (
+                    SELECT id FROM django_content_type
+                    WHERE app_label = 'sales' AND model IN ('order', 'reference', 'revision', 'deliverable')
+                ))
+            ) THEN 1 ELSE 0 END
+            FROM lib_event AS event
+            WHERE event.id = notification.event_id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='date',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'category', 'read', '-date'], name='lib_notification_feed'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('lib', '0040_notification_category_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(
+                condition=models.Q(removed=False), fields=['type', 'content_type', 'object_id'],
+                name='lib_subscription_match',
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lib', '0041_subscription_match_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='email_frequency',
+            field=models.IntegerField(choices=[(0, 'Immediately'), (1, 'Hourly digest'), (2, 'Daily digest')], default=0),
+        ),
+        migrations.CreateModel(
+            name='PendingEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frequency', models.IntegerField(choices=[(0, 'Immediately'), (1, 'Hourly digest'), (2, 'Daily digest')], db_index=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lib.event')),
+                ('subscriber', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('subscriber', 'event')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lib', '0042_digest_emails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='recalled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE lib_notification AS notification SET recalled = true
+            FROM lib_event AS event
+            WHERE event.id = notification.event_id AND event.recalled;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # The feeds never show recalled notifications, so they're left out of the index.
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='lib_notification_feed',
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(
+                condition=models.Q(recalled=False), fields=['user', 'category', 'read', '-date'],
+                name='lib_notification_feed',
+            ),
+        ),
+    ]
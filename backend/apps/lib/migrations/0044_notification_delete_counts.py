@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lib', '0043_notification_recalled'),
+    ]
+
+    operations = [
+        # Notifications are deleted in bulk, whether directly or as their events are, so the unread counters are
+        # adjusted once per DELETE statement from everything it removed. Only existing counters are updated. A user
+        # without one has nothing to take away, and writing one could race the user's own deletion. The category
+        # numbers mirror COMMUNITY_NOTIFICATION and SALES_NOTIFICATION.
+        migrations.RunSQL(
+            """
+            CREATE FUNCTION lib_notification_discount_deleted() RETURNS trigger AS $$
+            BEGIN
+                UPDATE lib_unreadnotificationcount AS counter SET
+                    community = counter.community - deltas.community,
+                    sales = counter.sales - deltas.sales
+                FROM (
+                    SELECT user_id, COUNT(*) FILTER (WHERE category = 0) AS community,
+                        COUNT(*) FILTER (WHERE category = 1) AS sales
+                    FROM removed WHERE NOT read AND NOT recalled
+                    GROUP BY user_id
+                ) AS deltas
+                WHERE counter.user_id = deltas.user_id;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER lib_notification_discount_deleted
+            AFTER DELETE ON lib_notification
+            REFERENCING OLD TABLE AS removed
+            FOR EACH STATEMENT EXECUTE PROCEDURE lib_notification_discount_deleted();
+            """,
+            reverse_sql="""
+            DROP TRIGGER lib_notification_discount_deleted ON lib_notification;
+            DROP FUNCTION lib_notification_discount_deleted();
+            """,
+        ),
+    ]
@@ -6,7 +6,7 @@ from django.core.cache import cache
 from django.core.validators import FileExtensionValidator
 from django.db import models
 from django.db.models import DateTimeField, Model, SlugField, CASCADE, ForeignKey, SET_NULL, \
-    UUIDField, JSONField
+    UUIDField, JSONField, Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -163,6 +163,23 @@ EMAIL_SUBJECTS = {
     WAITLIST_UPDATED: "A new order has been added to your waitlist!",
 }
 
+# Event types which can be sent out over Telegram. Each needs a TG_ template in templates/notifications.
+TELEGRAM_TYPES = (COMMISSIONS_OPEN,)
+
+# Event types a user is subscribed to for everyone they watch.
+WATCH_TYPES = (COMMISSIONS_OPEN, NEW_CHARACTER, NEW_PRODUCT, STREAMING, NEW_JOURNAL)
+
+# How often emails for a subscription are sent. Anything other than immediately is rolled up into a digest email.
+EMAIL_IMMEDIATE = 0
+EMAIL_HOURLY = 1
+EMAIL_DAILY = 2
+
+EMAIL_FREQUENCIES = (
+    (EMAIL_IMMEDIATE, 'Immediately'),
+    (EMAIL_HOURLY, 'Hourly digest'),
+    (EMAIL_DAILY, 'Daily digest'),
+)
+
 
 class Event(models.Model):
     type = models.IntegerField(db_index=True, choices=EVENT_TYPES)
@@ -185,15 +202,74 @@ class Subscription(models.Model):
     telegram = models.BooleanField(default=False, db_index=True)
     removed = models.BooleanField(default=False, db_index=True)
     until = models.DateField(null=True, db_index=True)
+    email_frequency = models.IntegerField(choices=EMAIL_FREQUENCIES, default=EMAIL_IMMEDIATE)
 
     class Meta:
         unique_together = ('type', 'subscriber', 'object_id', 'content_type')
+        indexes = [
+            # Covers the lookup in apps.lib.utils.get_matching_subscriptions, run for every notification.
+            models.Index(
+                fields=['type', 'content_type', 'object_id'], condition=Q(removed=False),
+                name='lib_subscription_match',
+            ),
+        ]
+
+
+# Which notification feed a notification is listed in.
+COMMUNITY_NOTIFICATION = 0
+SALES_NOTIFICATION = 1
+
+NOTIFICATION_CATEGORIES = (
+    (COMMUNITY_NOTIFICATION, 'Community'),
+    (SALES_NOTIFICATION, 'Sales'),
+)
 
 
 class Notification(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=CASCADE)
     event = models.ForeignKey(Event, on_delete=CASCADE, related_name='notifications')
     read = models.BooleanField(default=False, db_index=True)
+    # Copied from the event when the notification is created, so that the feeds can be filtered and sorted without
+    # joining against it.
+    category = models.IntegerField(choices=NOTIFICATION_CATEGORIES, default=COMMUNITY_NOTIFICATION)
+    date = models.DateTimeField()
+    # Kept in step with the event's recalled flag by apps.lib.utils.
+    recalled = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('event', 'user')
+        indexes = [
+            models.Index(
+                fields=['user', 'category', 'read', '-date'], condition=Q(recalled=False),
+                name='lib_notification_feed',
+            ),
+        ]
+
+
+class PendingEmail(models.Model):
+    """
+    An event waiting to be sent out in a subscriber's next digest email. If the event is updated before then, the
+    digest shows it as it is when the digest goes out.
+    """
+    subscriber = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=CASCADE, related_name='+')
+    event = models.ForeignKey(Event, on_delete=CASCADE, related_name='+')
+    frequency = models.IntegerField(choices=EMAIL_FREQUENCIES, db_index=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('subscriber', 'event')
+
+
+class UnreadNotificationCount(models.Model):
+    """
+    Denormalized count of a user's unread notifications whose events have not been recalled, split between the
+    community and sales feeds. Kept up to date by the functions in apps.lib.utils that change notifications, and, when
+    notifications are deleted, by a database trigger. If it ever drifts, rebuild it with the reconcile_unread_counts
+    command.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=CASCADE, primary_key=True, related_name='+')
+    community = models.IntegerField(default=0)
+    sales = models.IntegerField(default=0)
 
 
 class Tag(Model):
@@ -0,0 +1,160 @@
+"""
+Hands channel layer messages off from synchronous code to a background thread, so that request threads don't wait on
+an event loop hop and a Redis round trip for every group_send.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+from time import monotonic
+from typing import Dict, List, Tuple
+
+from asgiref.sync import async_to_sync
+from celery.signals import worker_process_shutdown
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelPublisher:
+    """
+    Process-wide publisher for channel layer group messages. Messages are put on a bounded queue and sent by a daemon
+    thread which keeps its own event loop, sending whatever has accumulated to each group concurrently, and each
+    group's messages in order. If the queue is full, the message is dropped and counted rather than blocking the
+    caller.
+
+    Since the thread is a daemon, anything still queued when the process exits is lost unless flush is called first.
+    flush_publisher does this at exit, and when a Celery worker process shuts down.
+    """
+    def __init__(self, max_size: int, batch_size: int):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_size)
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # Counters are updated both by callers and by the publisher thread.
+        self.stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def ensure_started(self):
+        # Checking the PID means a forked worker starts its own thread rather than relying on its parent's.
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.max_size)
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='channel-publisher', daemon=True)
+            self.thread.start()
+
+    def publish(self, group: str, message: dict):
+        self.ensure_started()
+        try:
+            self.queue.put_nowait((group, message))
+        except queue.Full:
+            dropped = self.count('dropped')
+            if dropped == 1 or not dropped % 1000:
+                logger.warning('Channel publisher queue is full. %s messages dropped so far.', dropped)
+
+    def count(self, name: str) -> int:
+        with self.stats_lock:
+            total = getattr(self, name) + 1
+            setattr(self, name, total)
+            return total
+
+    def next_batch(self) -> List[Tuple[str, dict]]:
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    async def send_group(self, layer, group: str, messages: List[dict]):
+        for message in messages:
+            try:
+                await layer.group_send(group, message)
+            except Exception as err:
+                self.count('failed')
+                logger.error('Failed to publish channel message.', exc_info=err)
+            else:
+                self.count('sent')
+
+    async def send_batch(self, batch: List[Tuple[str, dict]]):
+        # Different groups are sent to concurrently, but each group's messages go out one at a time in the order they
+        # were published, so that, for instance, a delete can't overtake the update before it.
+        by_group = {}
+        for group, message in batch:
+            by_group.setdefault(group, []).append(message)
+        layer = get_channel_layer()
+        await asyncio.gather(*(self.send_group(layer, group, messages) for group, messages in by_group.items()))
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            batch = self.next_batch()
+            try:
+                loop.run_until_complete(self.send_batch(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for everything queued in this process to be sent. Returns whether it was.
+        """
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        deadline = monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    logger.warning(
+                        'Channel publisher gave up flushing with %s messages unsent.', self.queue.unfinished_tasks,
+                    )
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
+
+PUBLISHER = ChannelPublisher(
+    max_size=settings.CHANNEL_PUBLISHER_QUEUE_SIZE, batch_size=settings.CHANNEL_PUBLISHER_BATCH_SIZE,
+)
+
+
+@worker_process_shutdown.connect
+def flush_publisher(**_kwargs):
+    PUBLISHER.flush(settings.CHANNEL_PUBLISHER_FLUSH_TIMEOUT)
+
+
+atexit.register(flush_publisher)
+
+
+def group_send(group: str, message: dict):
+    """
+    Sends a message to a channel layer group from synchronous code. Unless settings.CHANNEL_PUBLISHER is disabled,
+    this returns immediately and the message is sent in the background.
+    """
+    if not settings.CHANNEL_PUBLISHER:
+        async_to_sync(get_channel_layer().group_send)(group, message)
+        return
+    PUBLISHER.publish(group, message)
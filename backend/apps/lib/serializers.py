@@ -1,8 +1,11 @@
+import json
 import os
-from typing import Union, List
+from hashlib import sha256
+from typing import Union, List, Callable, Any
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db.models import Q
 from django.db.transaction import atomic
 from rest_framework import serializers
@@ -10,14 +13,14 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.fields import SerializerMethodField, empty
 from rest_framework_bulk import BulkSerializerMixin, BulkListSerializer
 
-from apps.lib.abstract_models import THUMBNAIL_IMAGE_EXTENSIONS
+from apps.lib.abstract_models import THUMBNAIL_IMAGE_EXTENSIONS, GENERAL
 from apps.lib.consumers import register_serializer
 from apps.lib.models import (
     Comment, Notification, Event, CHAR_TAG, SUBMISSION_CHAR_TAG, Tag, REVISION_UPLOADED,
     ORDER_UPDATE, SALE_UPDATE, COMMENT, Subscription, SUBMISSION_SHARED, CHAR_SHARED, NEW_CHARACTER,
     NEW_PRODUCT, STREAMING, NEW_JOURNAL, FAVORITE, SUBMISSION_ARTIST_TAG,
     Asset,
-    DISPUTE, REFERENCE_UPLOADED, WAITLIST_UPDATED)
+    DISPUTE, REFERENCE_UPLOADED, WAITLIST_UPDATED, COMMISSIONS_OPEN)
 from apps.lib.utils import tag_list_cleaner, add_check, set_tags
 from apps.profiles.models import User, Submission, Character, Journal, Conversation
 from apps.sales.models import Revision, Product, Order, WAITING, Deliverable
@@ -539,12 +542,67 @@ NOTIFICATION_TYPE_MAP = {
 }
 
 
+# Event types whose rendered data and target do not depend on who is reading them, aside from their content rating.
+# These are rendered once per event and rating and then shared between all readers, which matters for broadcast events
+# that can reach thousands of watchers. NEW_PRODUCT and NEW_JOURNAL don't qualify, since the submission and journal
+# they render include whether the reader is subscribed to them.
+VIEWER_INDEPENDENT_TYPES = {COMMISSIONS_OPEN}
+
+
+def rating_context(context: dict) -> int:
+    """
+    Gets the content rating a notification is being rendered for.
+    """
+    request = context.get('request')
+    if request is None:
+        return GENERAL
+    max_rating = getattr(request, 'max_rating', None)
+    if max_rating is not None:
+        return max_rating
+    user = request.user
+    if not user.is_authenticated or user.sfw_mode:
+        return GENERAL
+    return user.rating
+
+
+def event_payload_key(event: Event, context: dict, part: str) -> str:
+    digest = sha256(json.dumps(event.data, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    return f'notification_payload__{event.id}__{digest}__{rating_context(context)}__{part}'
+
+
+def cached_event_payload(event: Event, context: dict, part: str, render: Callable[[], Any]) -> Any:
+    """
+    Renders part of an event's payload, reusing an earlier rendering if the event is viewer independent.
+    """
+    if not settings.NOTIFICATION_PAYLOAD_TTL or event.type not in VIEWER_INDEPENDENT_TYPES:
+        return render()
+    key = event_payload_key(event, context, part)
+    payload = cache.get(key)
+    if payload is None:
+        payload = render()
+        cache.set(key, payload, settings.NOTIFICATION_PAYLOAD_TTL)
+    return payload
+
+
+def event_data(event: Event, context: dict):
+    return cached_event_payload(
+        event, context, 'data', lambda: NOTIFICATION_TYPE_MAP.get(event.type, lambda x, _: x.data)(event, context),
+    )
+
+
+def event_target(event: Event, context: dict):
+    return cached_event_payload(event, context, 'target', lambda: notification_serialize(event.target, context))
+
+
 class EventSerializer(serializers.ModelSerializer):
-    target = EventTargetRelatedField(read_only=True)
+    target = SerializerMethodField(read_only=True)
     data = SerializerMethodField(read_only=True)
 
     def get_data(self, obj):
-        return NOTIFICATION_TYPE_MAP.get(obj.type, lambda x, _: x.data)(obj, self.context)
+        return event_data(obj, self.context)
+
+    def get_target(self, obj):
+        return event_target(obj, self.context)
 
     class Meta:
         model = Event
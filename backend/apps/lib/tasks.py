@@ -1,4 +1,5 @@
 import random
+from typing import List
 
 from django.core.mail import mail_admins
 from easy_thumbnails.files import generate_all_aliases
@@ -45,3 +46,63 @@ def check_asset_associations(self, asset_id: str):
             self.retry(exc=err, countdown=max(
                 [random.uniform(2, 4) ** self.request.retries, 3600 + random.uniform(100, 500)])
             )
+
+
+@celery_app.task
+def fan_out_notification(event_id: int, exclude_ids: List[int]):
+    """
+    Splits the email and Telegram subscribers of an event into batches and queues a delivery task for each.
+    """
+    from apps.lib.models import Event
+    from apps.lib.utils import match_subscriptions
+    event = Event.objects.filter(id=event_id).first()
+    if not event or event.recalled:
+        # Removed or recalled before we got to it.
+        return
+    match = match_subscriptions(event.type, event.object_id, event.content_type_id, exclude_ids)
+    batch_size = settings.NOTIFICATION_BATCH_SIZE
+    for medium, subscription_ids in (('email', match.email_ids), ('telegram', match.telegram_ids)):
+        subscription_ids = list(subscription_ids)
+        for index in range(0, len(subscription_ids), batch_size):
+            deliver_notifications.delay(event_id, medium, subscription_ids[index:index + batch_size])
+
+
+@celery_app.task
+def deliver_notifications(event_id: int, medium: str, subscription_ids: List[int]):
+    """
+    Sends a batch of notifications for an event over a particular medium, either 'email' or 'telegram'.
+    """
+    from apps.lib.models import Event, Subscription
+    from apps.lib.utils import send_notification_emails, send_notification_telegrams
+    event = Event.objects.filter(id=event_id).first()
+    if not event or event.recalled:
+        return
+    subscriptions = Subscription.objects.filter(
+        id__in=subscription_ids, removed=False, **{medium: True},
+    ).select_related('subscriber')
+    if medium == 'email':
+        send_notification_emails(event, subscriptions)
+    elif medium == 'telegram':
+        send_notification_telegrams(event, subscriptions)
+    else:
+        raise ValueError(f'Unknown notification medium: {medium}')
+
+
+@celery_app.task
+def send_hourly_digests():
+    """
+    Rolls up the pending hourly digest emails into one email per subscriber.
+    """
+    from apps.lib.models import EMAIL_HOURLY
+    from apps.lib.utils import send_digest_emails
+    send_digest_emails(EMAIL_HOURLY)
+
+
+@celery_app.task
+def send_daily_digests():
+    """
+    Rolls up the pending daily digest emails into one email per subscriber.
+    """
+    from apps.lib.models import EMAIL_DAILY
+    from apps.lib.utils import send_digest_emails
+    send_digest_emails(EMAIL_DAILY)
@@ -1,14 +1,19 @@
+import asyncio
 from typing import Optional, List, Tuple
+from unittest.mock import patch, AsyncMock, Mock
 
 from asgiref.sync import sync_to_async
 from channels.testing import WebsocketCommunicator
-from django.test import TransactionTestCase
+from django.db import transaction
+from django.test import TransactionTestCase, SimpleTestCase, TestCase
 
-from apps.profiles.models import ArtconomyAnonymousUser
+from apps.lib.consumers import EventConsumer, group_membership_counts, json_patch, shared_payload, GROUP_MEMBERS
+from apps.profiles.models import ArtconomyAnonymousUser, User
 from apps.profiles.serializers import UserSerializer
 from apps.profiles.tests.factories import UserFactory
 from apps.profiles.utils import empty_user
-from apps.sales.tests.factories import DeliverableFactory, LineItemFactory, ServicePlanFactory
+from apps.sales.tests.factories import DeliverableFactory, LineItemFactory, ServicePlanFactory, \
+    CreditCardTokenFactory
 from conf.asgi import application
 
 SA = sync_to_async
@@ -169,3 +174,264 @@ class TestConsumer(TransactionTestCase):
         await SA(deliverable.delete)()
         delete_command = await com.receive_json_from()
         self.assertEqual(delete_command['command'], f'sales.Deliverable.delete.{deliverable_id}')
+
+    async def test_updated_model_shared_payload(self):
+        card = await SA(CreditCardTokenFactory.create)()
+        com = self.get_communicator()
+        com.scope['user'] = card.user
+        await com.send_json_to(
+            {
+                'command': 'watch',
+                'payload': {
+                    'app_label': 'sales',
+                    'model_name': 'CreditCardToken',
+                    'pk': card.pk,
+                    'serializer': 'CardSerializer',
+                },
+            },
+        )
+        await com.receive_nothing()
+        card.cvv_verified = True
+        with patch('apps.lib.consumers.get_instance') as mock_get_instance:
+            await SA(card.save)()
+            updated = await com.receive_json_from()
+        # The payload was serialized once when the change was broadcast, rather than fetched by the consumer.
+        mock_get_instance.assert_not_called()
+        self.assertEqual(updated['command'], f'sales.CreditCardToken.update.CardSerializer.{card.pk}')
+        self.assertTrue(updated['payload']['cvv_verified'])
+
+    async def test_watch_many(self):
+        user = await SA(UserFactory.create)()
+        deliverable = await SA(DeliverableFactory.create)(order__buyer=user)
+        deliverable2 = await SA(DeliverableFactory.create)(order__buyer=user)
+        forbidden = await SA(DeliverableFactory.create)()
+        com = self.get_communicator()
+        com.scope['user'] = user
+        specs = [
+            {
+                'app_label': 'sales',
+                'model_name': 'Deliverable',
+                'pk': instance.pk,
+                'serializer': 'DeliverableViewSerializer',
+            } for instance in [deliverable, deliverable2, forbidden]
+        ]
+        await com.send_json_to({'command': 'watch_many', 'payload': {'specs': specs}})
+        response = await com.receive_json_from()
+        self.assertEqual(response['command'], 'error')
+        self.assertIn(f'pk={forbidden.pk} ', response['payload']['message'])
+        self.assertNotIn(f'pk={deliverable.pk} ', response['payload']['message'])
+        deliverable2.details = 'boop'
+        await SA(deliverable2.save)()
+        updated = await com.receive_json_from()
+        self.assertEqual(updated['command'], f'sales.Deliverable.update.DeliverableViewSerializer.{deliverable2.id}')
+        await com.send_json_to({'command': 'clear_watch_many', 'payload': {'specs': specs}})
+        await com.receive_nothing()
+        deliverable.details = 'beep'
+        await SA(deliverable.save)()
+        await com.receive_nothing()
+
+    async def test_clear_watch_many_invalid(self):
+        com = self.get_communicator()
+        com.scope['user'] = await SA(UserFactory.create)()
+        specs = [
+            {'app_label': 'sales', 'model_name': 'Deliverable', 'pk': '1.2', 'serializer': 'DeliverableViewSerializer'},
+        ]
+        await com.send_json_to({'command': 'clear_watch_many', 'payload': {'specs': specs}})
+        response = await com.receive_json_from()
+        self.assertEqual(response['command'], 'error')
+
+    async def test_updated_model_deltas(self):
+        user = await SA(UserFactory.create)()
+        deliverable = await SA(DeliverableFactory.create)(order__buyer=user)
+        com = self.get_communicator()
+        com.scope['user'] = user
+        await com.send_json_to(
+            {
+                'command': 'watch',
+                'payload': {
+                    'app_label': 'sales',
+                    'model_name': 'Deliverable',
+                    'pk': deliverable.pk,
+                    'serializer': 'DeliverableViewSerializer',
+                    'deltas': True,
+                },
+            },
+        )
+        await com.receive_nothing()
+        deliverable.details = 'boop'
+        await SA(deliverable.save)()
+        updated = await com.receive_json_from()
+        self.assertEqual(updated['revision'], 1)
+        self.assertEqual(updated['payload']['details'], 'boop')
+        deliverable.details = 'beep'
+        await SA(deliverable.save)()
+        updated = await com.receive_json_from()
+        self.assertNotIn('payload', updated)
+        self.assertEqual((updated['base'], updated['revision']), (1, 2))
+        self.assertEqual(updated['patch'], [{'op': 'replace', 'path': '/details', 'value': 'beep'}])
+
+
+class TestJSONPatch(SimpleTestCase):
+    def test_json_patch(self):
+        old = {'status': 1, 'order': {'id': 5, 'seller': 'Fox'}, 'outputs': [1], 'a/b': 1}
+        new = {'status': 2, 'order': {'id': 5}, 'outputs': [1, 2], 'a/b': 1, 'notes': ''}
+        self.assertEqual(
+            json_patch(old, new),
+            [
+                {'op': 'replace', 'path': '/status', 'value': 2},
+                {'op': 'remove', 'path': '/order/seller'},
+                {'op': 'replace', 'path': '/outputs', 'value': [1, 2]},
+                {'op': 'add', 'path': '/notes', 'value': ''},
+            ],
+        )
+        self.assertEqual(json_patch({'a~': 1}, {'a~': 2}), [{'op': 'replace', 'path': '/a~0', 'value': 2}])
+
+
+class TestPermissionCache(SimpleTestCase):
+    @patch('apps.lib.consumers.can_watch', new_callable=AsyncMock)
+    async def test_decisions_cached_until_update(self, mock_can_watch):
+        mock_can_watch.return_value = True
+        consumer = EventConsumer()
+        consumer.scope = {'user': ArtconomyAnonymousUser()}
+        instance = User(id=5)
+        self.assertTrue(await consumer.can_watch(instance, 'UserSerializer'))
+        self.assertTrue(await consumer.can_watch(instance, 'UserSerializer'))
+        self.assertEqual(mock_can_watch.call_count, 1)
+        consumer.forget_permissions({'app_label': 'profiles', 'model_name': 'User', 'pk': 5})
+        self.assertTrue(await consumer.can_watch(instance, 'UserSerializer'))
+        self.assertEqual(mock_can_watch.call_count, 2)
+
+
+class TestGroupRegistry(SimpleTestCase):
+    async def test_groups_discarded_on_disconnect(self):
+        consumer = EventConsumer()
+        consumer.channel_name = 'channel'
+        consumer.channel_layer = Mock()
+        consumer.channel_layer.group_add = AsyncMock()
+        consumer.channel_layer.group_discard = AsyncMock()
+        await consumer.join_groups(['test.group1', 'test.group2'])
+        await consumer.join_group('test.group1')
+        self.assertEqual(group_membership_counts()['test.group1'], 1)
+        await consumer.leave_group('test.group2')
+        self.assertNotIn('test.group2', group_membership_counts())
+        consumer.channel_layer.group_discard.reset_mock()
+        await consumer.disconnect(1000)
+        consumer.channel_layer.group_discard.assert_called_once_with('test.group1', 'channel')
+        self.assertEqual(consumer.joined_groups, set())
+        self.assertNotIn('test.group1', group_membership_counts())
+
+
+class TestOutbox(SimpleTestCase):
+    @patch('apps.lib.consumers.OUTBOX_SIZE', 3)
+    async def test_coalesce_and_resync(self):
+        consumer = EventConsumer()
+        consumer.base_send = AsyncMock()
+        key = ('update', 'sales.Deliverable', '1', 'DeliverableViewSerializer')
+        consumer.queue_message(lambda: {'command': 'update', 'payload': 1}, key=key)
+        consumer.queue_message(lambda: {'command': 'update', 'payload': 2}, key=key)
+        self.assertEqual(len(consumer.outbox), 1)
+        self.assertEqual(consumer.coalesced, 1)
+        self.assertEqual(consumer.outbox[key](), {'command': 'update', 'payload': 2})
+        for _ in range(3):
+            await consumer.send_json({'command': 'other'})
+        self.assertEqual(list(consumer.outbox), ['resync'])
+        self.assertEqual(consumer.dropped, 4)
+        await consumer.send_json({'command': 'other'})
+        self.assertEqual(consumer.dropped, 5)
+        writer = asyncio.ensure_future(consumer.write_outbox())
+        await asyncio.sleep(0)
+        writer.cancel()
+        consumer.base_send.assert_called_once_with(
+            {'type': 'websocket.send', 'text': '{"command": "resync", "payload": {}}'},
+        )
+        self.assertFalse(consumer.outbox)
+
+    async def test_build_failure_skipped(self):
+        consumer = EventConsumer()
+        consumer.base_send = AsyncMock()
+
+        def broken():
+            raise ValueError('Nope')
+
+        consumer.queue_message(broken)
+        consumer.queue_message(lambda: {'command': 'other'})
+        writer = asyncio.ensure_future(consumer.write_outbox())
+        with self.assertLogs('apps.lib.consumers', 'ERROR'):
+            await asyncio.sleep(0)
+        writer.cancel()
+        consumer.base_send.assert_called_once_with({'type': 'websocket.send', 'text': '{"command": "other"}'})
+
+    async def test_send_failure_closes(self):
+        consumer = EventConsumer()
+        consumer.base_send = AsyncMock(side_effect=[OSError('Gone'), None])
+        consumer.queue_message(lambda: {'command': 'other'})
+        consumer.queue_message(lambda: {'command': 'other'})
+        with self.assertLogs('apps.lib.consumers', 'ERROR'):
+            await consumer.write_outbox()
+        self.assertEqual(consumer.base_send.call_args_list[-1][0][0], {'type': 'websocket.close'})
+
+
+class TestBroadcastCoalescing(TestCase):
+    def create_card(self):
+        with patch('apps.lib.consumers.send_new'), self.captureOnCommitCallbacks(execute=True):
+            return CreditCardTokenFactory.create()
+
+    @patch('apps.lib.consumers.send_updated')
+    def test_updates_coalesced(self, mock_send_updated):
+        card = self.create_card()
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                card.save()
+        mock_send_updated.assert_called_once()
+        self.assertIs(mock_send_updated.call_args[0][1], card)
+
+    @patch('apps.lib.consumers.send_updated')
+    @patch('apps.lib.consumers.send_new')
+    def test_update_skipped_for_new(self, mock_send_new, mock_send_updated):
+        with self.captureOnCommitCallbacks(execute=True):
+            card = CreditCardTokenFactory.create()
+            card.save()
+        self.assertEqual([call[0][1] for call in mock_send_new.call_args_list].count(card), 1)
+        self.assertNotIn(card, [call[0][1] for call in mock_send_updated.call_args_list])
+
+    @patch('apps.lib.consumers.send_updated')
+    def test_rolled_back_savepoint(self, mock_send_updated):
+        card = self.create_card()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    card.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            card.save()
+        mock_send_updated.assert_called_once()
+
+    @patch('apps.lib.consumers.send_updated')
+    def test_rolled_back_savepoint_dropped(self, mock_send_updated):
+        card, other = self.create_card(), self.create_card()
+        with self.captureOnCommitCallbacks(execute=True):
+            card.save()
+            try:
+                with transaction.atomic():
+                    other.save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual([call[0][1] for call in mock_send_updated.call_args_list], [card])
+
+
+class TestSharedPayload(TestCase):
+    def test_serialized_for_members(self):
+        card = CreditCardTokenFactory.create()
+        group = f'sales.CreditCardToken.update.CardSerializer.{card.pk}'
+        with patch.dict(GROUP_MEMBERS, {group: 1}):
+            payload = shared_payload(type(card), card, 'CardSerializer', [group])
+        self.assertEqual(payload['id'], card.id)
+
+    @patch('apps.sales.serializers.CardSerializer.to_representation')
+    def test_skipped_without_members(self, mock_to_representation):
+        card = CreditCardTokenFactory.create()
+        group = f'sales.CreditCardToken.update.CardSerializer.{card.pk}'
+        self.assertIsNone(shared_payload(type(card), card, 'CardSerializer', [group]))
+        mock_to_representation.assert_not_called()
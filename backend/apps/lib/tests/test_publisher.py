@@ -0,0 +1,64 @@
+import asyncio
+from unittest.mock import patch, Mock, AsyncMock
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+
+from apps.lib.publisher import ChannelPublisher
+
+
+class TestChannelPublisher(SimpleTestCase):
+    def test_drops_when_full(self):
+        publisher = ChannelPublisher(max_size=1, batch_size=10)
+        with patch.object(publisher, 'ensure_started'):
+            publisher.publish('group', {'type': 'broadcast'})
+            publisher.publish('group', {'type': 'broadcast'})
+        self.assertEqual(publisher.stats(), {'queue_depth': 1, 'sent': 0, 'failed': 0, 'dropped': 1})
+
+    @patch('apps.lib.publisher.get_channel_layer')
+    def test_send_batch(self, mock_get_channel_layer):
+        layer = Mock()
+        layer.group_send = AsyncMock(side_effect=[None, ValueError('Nope')])
+        mock_get_channel_layer.return_value = layer
+        publisher = ChannelPublisher(max_size=10, batch_size=10)
+        with patch.object(publisher, 'ensure_started'):
+            publisher.publish('group1', {'type': 'broadcast'})
+            publisher.publish('group2', {'type': 'broadcast'})
+        batch = publisher.next_batch()
+        self.assertEqual(len(batch), 2)
+        async_to_sync(publisher.send_batch)(batch)
+        self.assertEqual(publisher.stats(), {'queue_depth': 0, 'sent': 1, 'failed': 1, 'dropped': 0})
+
+    @patch('apps.lib.publisher.get_channel_layer')
+    def test_send_batch_group_order(self, mock_get_channel_layer):
+        sent = []
+
+        async def group_send(group, message):
+            if message['order'] == 0:
+                # Yield, so a later message would get ahead of this one if the group's messages were sent
+                # concurrently.
+                await asyncio.sleep(0.01)
+            sent.append((group, message['order']))
+
+        layer = Mock()
+        layer.group_send = group_send
+        mock_get_channel_layer.return_value = layer
+        publisher = ChannelPublisher(max_size=10, batch_size=10)
+        batch = [('group1', {'order': 0}), ('group2', {'order': 1}), ('group1', {'order': 2})]
+        async_to_sync(publisher.send_batch)(batch)
+        self.assertEqual([entry for entry in sent if entry[0] == 'group1'], [('group1', 0), ('group1', 2)])
+        self.assertEqual(publisher.stats()['sent'], 3)
+
+    @patch('apps.lib.publisher.get_channel_layer')
+    def test_flush(self, mock_get_channel_layer):
+        layer = Mock()
+        layer.group_send = AsyncMock()
+        mock_get_channel_layer.return_value = layer
+        publisher = ChannelPublisher(max_size=10, batch_size=1)
+        for index in range(3):
+            publisher.publish('group', {'type': 'broadcast', 'index': index})
+        self.assertTrue(publisher.flush(timeout=5))
+        self.assertEqual(publisher.stats(), {'queue_depth': 0, 'sent': 3, 'failed': 0, 'dropped': 0})
+
+    def test_flush_not_started(self):
+        self.assertTrue(ChannelPublisher(max_size=10, batch_size=10).flush(timeout=0))
@@ -1,11 +1,13 @@
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 
-from apps.lib.models import Notification, NEW_PRODUCT, Event
-from apps.lib.serializers import comment_made, new_product
+from apps.lib.models import Notification, NEW_PRODUCT, Event, ORDER_UPDATE, COMMISSIONS_OPEN
+from apps.lib.serializers import comment_made, new_product, event_data, event_payload_key, NOTIFICATION_TYPE_MAP
 from apps.lib.test_resources import APITestCase
 from apps.lib.tests.factories_interdepend import CommentFactory
+from apps.lib.utils import FakeRequest
 from apps.profiles.tests.factories import SubmissionFactory, UserFactory
 from apps.sales.tests.factories import ProductFactory
 
@@ -44,3 +46,37 @@ class TestNotificationSerializers(TestCase):
         self.assertEqual(output['product']['id'], product.id)
         self.assertEqual(output['product']['name'], product.name)
         self.assertEqual(output['display']['title'], product.primary_submission.title)
+
+    @override_settings(NOTIFICATION_PAYLOAD_TTL=60)
+    def test_viewer_independent_rendered_once(self):
+        user = UserFactory.create()
+        event = Event.objects.create(target=user, data={}, type=COMMISSIONS_OPEN)
+        readers = UserFactory.create_batch(3)
+        for reader in readers:
+            self.addCleanup(cache.delete, event_payload_key(event, {'request': FakeRequest(reader)}, 'data'))
+        renderer = Mock(return_value={'display': 'rendered'})
+        with patch.dict(NOTIFICATION_TYPE_MAP, {COMMISSIONS_OPEN: renderer}):
+            for reader in readers:
+                self.assertEqual(event_data(event, {'request': FakeRequest(reader)}), {'display': 'rendered'})
+        renderer.assert_called_once()
+
+    @override_settings(NOTIFICATION_PAYLOAD_TTL=60)
+    def test_new_product_rendered_each_time(self):
+        user = UserFactory.create()
+        product = ProductFactory.create(user=user)
+        event = Event.objects.create(target=user, data={'product': product.id}, type=NEW_PRODUCT)
+        renderer = Mock(return_value={'product': 'rendered'})
+        with patch.dict(NOTIFICATION_TYPE_MAP, {NEW_PRODUCT: renderer}):
+            for reader in UserFactory.create_batch(3):
+                event_data(event, {'request': FakeRequest(reader)})
+        self.assertEqual(renderer.call_count, 3)
+
+    @override_settings(NOTIFICATION_PAYLOAD_TTL=60)
+    def test_viewer_dependent_rendered_each_time(self):
+        user = UserFactory.create()
+        event = Event.objects.create(target=user, data={}, type=ORDER_UPDATE)
+        renderer = Mock(return_value={'display': 'rendered'})
+        with patch.dict(NOTIFICATION_TYPE_MAP, {ORDER_UPDATE: renderer}):
+            for reader in UserFactory.create_batch(3):
+                event_data(event, {'request': FakeRequest(reader)})
+        self.assertEqual(renderer.call_count, 3)
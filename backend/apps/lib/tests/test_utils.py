@@ -1,15 +1,25 @@
+from datetime import date
+from unittest.mock import patch, call
+
 import ddt
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from freezegun import freeze_time
 
-from apps.lib.models import FAVORITE, Notification, SYSTEM_ANNOUNCEMENT, Event, Subscription, Comment
+from apps.lib.models import FAVORITE, Notification, SYSTEM_ANNOUNCEMENT, Event, Subscription, Comment, \
+    COMMISSIONS_OPEN, COMMENT, COMMUNITY_NOTIFICATION, WATCH_TYPES, NEW_JOURNAL, EMAIL_DAILY, \
+    PendingEmail
+from apps.lib.tasks import fan_out_notification, deliver_notifications
 from apps.lib.test_resources import SignalsDisabledMixin
 from apps.lib.tests.factories_interdepend import CommentFactory
 from apps.lib.utils import notify, recall_notification, send_transaction_email, subscribe, mark_read, check_read, \
-    mark_modified, clear_events_subscriptions_and_comments, shift_position
-from apps.profiles.models import Submission, ArtconomyAnonymousUser
+    mark_modified, clear_events_subscriptions_and_comments, shift_position, commissions_open_subscription, \
+    NotificationTemplates, unread_counts, rebuild_unread_counts, bulk_subscribe, bulk_unsubscribe, import_watch_list, \
+    match_subscriptions, send_digest_emails, digest_email
+from apps.profiles.models import Submission, ArtconomyAnonymousUser, User
 from apps.profiles.tests.factories import SubmissionFactory, UserFactory
 from apps.sales.models import ServicePlan
 
@@ -105,6 +115,19 @@ class NotificationsTestCase(SignalsDisabledMixin, TestCase):
             self.assertEqual(event.data, {'users': [1, 2, 3]})
             self.assertFalse(notification.read)
 
+    @freeze_time('2018-01-01')
+    def test_notification_category_and_date(self):
+        submission = SubmissionFactory.create()
+        subscribe(FAVORITE, submission.owner, submission)
+        notify(FAVORITE, target=submission, data={'users': []})
+        notification = Notification.objects.get(user=submission.owner)
+        self.assertEqual(notification.category, COMMUNITY_NOTIFICATION)
+        self.assertEqual(notification.date, notification.event.date)
+        with freeze_time('2019-08-04'):
+            notify(FAVORITE, target=submission, data={'users': [1]}, unique=True, mark_unread=True)
+        notification.refresh_from_db()
+        self.assertEqual(notification.date.year, 2019)
+
     @freeze_time('2018-01-01')
     def test_unique_data(self):
         submission = SubmissionFactory.create()
@@ -234,6 +257,19 @@ class NotificationsTestCase(SignalsDisabledMixin, TestCase):
         recall_notification(FAVORITE, target=submission)
         notification.event.refresh_from_db()
         self.assertEqual(notification.event.recalled, True)
+        notification.refresh_from_db()
+        self.assertTrue(notification.recalled)
+
+    def test_recalled_notification_restored(self):
+        submission = SubmissionFactory.create()
+        subscribe(FAVORITE, submission.owner, submission)
+        notify(FAVORITE, target=submission, data={'users': []})
+        recall_notification(FAVORITE, target=submission)
+        notify(FAVORITE, target=submission, data={'users': [1]}, unique=True)
+        notification = Notification.objects.get(user=submission.owner)
+        self.assertFalse(notification.event.recalled)
+        self.assertFalse(notification.recalled)
+        self.assertEqual(unread_counts(submission.owner)['count'], 1)
 
     def test_global_event_broadcast_global_with_target(self):
         submission = SubmissionFactory.create()
@@ -259,10 +295,216 @@ class NotificationsTestCase(SignalsDisabledMixin, TestCase):
         notify(FAVORITE, target=submission, data={'users': []})
         self.assertEqual(Notification.objects.filter(user=submission.owner).count(), 1)
 
+    def test_global_and_targeted_subscription_single_notification(self):
+        submission = SubmissionFactory.create()
+        subscribe(FAVORITE, submission.owner, submission)
+        Subscription.objects.create(type=FAVORITE, subscriber=submission.owner)
+        notify(FAVORITE, target=submission, data={'users': []}, unique=True)
+        notify(FAVORITE, target=submission, data={'users': []}, unique=True)
+        self.assertEqual(Notification.objects.filter(user=submission.owner).count(), 1)
+
+    def test_unread_counts(self):
+        submission = SubmissionFactory.create()
+        subscribe(FAVORITE, submission.owner, submission)
+        notify(FAVORITE, target=submission, data={'users': []})
+        notify(FAVORITE, target=submission, data={'users': []}, unique=True)
+        self.assertEqual(
+            unread_counts(submission.owner), {'count': 1, 'community_count': 1, 'sales_count': 0},
+        )
+        recall_notification(FAVORITE, target=submission)
+        self.assertEqual(
+            unread_counts(submission.owner), {'count': 0, 'community_count': 0, 'sales_count': 0},
+        )
+        notify(FAVORITE, target=submission, data={'users': []}, unique=True)
+        self.assertEqual(unread_counts(submission.owner)['community_count'], 1)
+        mark_read(obj=submission, user=submission.owner)
+        self.assertEqual(unread_counts(submission.owner)['community_count'], 0)
+
+    def test_unread_counts_deleted(self):
+        submissions = SubmissionFactory.create_batch(2, owner=UserFactory.create())
+        owner = submissions[0].owner
+        for submission in submissions:
+            subscribe(FAVORITE, owner, submission)
+            notify(FAVORITE, target=submission, data={'users': []})
+        self.assertEqual(unread_counts(owner)['count'], 2)
+        Event.objects.filter(type=FAVORITE).delete()
+        self.assertEqual(unread_counts(owner)['count'], 0)
+
+    def test_rebuild_unread_counts(self):
+        submission = SubmissionFactory.create()
+        subscribe(FAVORITE, submission.owner, submission)
+        notify(FAVORITE, target=submission, data={'users': []})
+        Notification.objects.filter(user=submission.owner).update(read=True)
+        self.assertEqual(unread_counts(submission.owner)['count'], 1)
+        rebuild_unread_counts(User.objects.filter(id=submission.owner.id))
+        self.assertEqual(unread_counts(submission.owner)['count'], 0)
+
+    def test_match_subscriptions(self):
+        user = UserFactory.create()
+        watcher = UserFactory.create()
+        excluded = UserFactory.create()
+        global_subscriber = UserFactory.create()
+        commissions_open_subscription(watcher, user, date(2100, 1, 1))
+        commissions_open_subscription(excluded, user, date(2100, 1, 1))
+        Subscription.objects.create(type=COMMISSIONS_OPEN, subscriber=global_subscriber)
+        content_type = ContentType.objects.get_for_model(user)
+        with self.assertNumQueries(1):
+            match = match_subscriptions(COMMISSIONS_OPEN, user.id, content_type, [excluded])
+        self.assertTrue(match.found)
+        self.assertCountEqual(
+            match.subscriptions.values_list('subscriber_id', flat=True), [watcher.id, global_subscriber.id],
+        )
+        subscription = Subscription.objects.get(subscriber=watcher, type=COMMISSIONS_OPEN)
+        self.assertEqual(match.email_ids, (subscription.id,))
+        self.assertEqual(match.telegram_ids, (subscription.id,))
+
+    def test_match_subscriptions_in_app_only(self):
+        user = UserFactory.create()
+        Subscription.objects.create(type=COMMISSIONS_OPEN, subscriber=UserFactory.create())
+        content_type = ContentType.objects.get_for_model(user)
+        self.assertTrue(match_subscriptions(COMMISSIONS_OPEN, user.id, content_type).found)
+        self.assertFalse(match_subscriptions(FAVORITE, user.id, content_type).found)
+
+    def test_digest_emails(self):
+        watcher = UserFactory.create()
+        watched = UserFactory.create_batch(2)
+        for user in watched:
+            commissions_open_subscription(watcher, user, date(2100, 1, 1))
+        Subscription.objects.filter(subscriber=watcher).update(email_frequency=EMAIL_DAILY)
+        for user in watched:
+            notify(COMMISSIONS_OPEN, target=user)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(PendingEmail.objects.filter(subscriber=watcher, frequency=EMAIL_DAILY).count(), 2)
+        send_digest_emails(EMAIL_DAILY)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [watcher.email])
+        self.assertEqual(mail.outbox[0].subject, 'You have 2 new notifications on Artconomy')
+        self.assertFalse(PendingEmail.objects.exists())
+
+    def test_digest_emails_untemplated(self):
+        watcher = UserFactory.create()
+        watched = UserFactory.create()
+        submission = SubmissionFactory.create()
+        favorite = Event.objects.create(type=FAVORITE, target=submission)
+        PendingEmail.objects.create(subscriber=watcher, event=favorite, frequency=EMAIL_DAILY)
+        commissions_open_subscription(watcher, watched, date(2100, 1, 1))
+        Subscription.objects.filter(subscriber=watcher).update(email_frequency=EMAIL_DAILY)
+        notify(COMMISSIONS_OPEN, target=watched)
+        send_digest_emails(EMAIL_DAILY)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'You have 1 new notification on Artconomy')
+        self.assertFalse(PendingEmail.objects.exists())
+
+    def test_digest_emails_failure_isolated(self):
+        watched = UserFactory.create()
+        broken, watcher = UserFactory.create_batch(2)
+        for user in [broken, watcher]:
+            commissions_open_subscription(user, watched, date(2100, 1, 1))
+        Subscription.objects.filter(type=COMMISSIONS_OPEN).update(email_frequency=EMAIL_DAILY)
+        notify(COMMISSIONS_OPEN, target=watched)
+        original = digest_email
+
+        def render(subscriber, events):
+            if subscriber == broken:
+                raise ValueError('Broken template.')
+            return original(subscriber, events)
+
+        with patch('apps.lib.utils.digest_email', side_effect=render), self.assertLogs('apps.lib.utils', 'ERROR'):
+            send_digest_emails(EMAIL_DAILY)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [watcher.email])
+        self.assertFalse(PendingEmail.objects.exists())
+
     def test_transaction_email(self):
         user = UserFactory.create()
         send_transaction_email('Test transaction', 'registration_code.html', user, {})
 
+    @override_settings(NOTIFICATION_FANOUT=True)
+    @patch('apps.lib.tasks.fan_out_notification.delay')
+    def test_fan_out_deferred(self, mock_fan_out):
+        user = UserFactory.create()
+        watcher = UserFactory.create()
+        excluded = UserFactory.create()
+        commissions_open_subscription(watcher, user, date(2100, 1, 1))
+        commissions_open_subscription(excluded, user, date(2100, 1, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            notify(COMMISSIONS_OPEN, target=user, exclude=[excluded])
+            mock_fan_out.assert_not_called()
+        self.assertEqual(len(mail.outbox), 0)
+        event = Event.objects.get(type=COMMISSIONS_OPEN)
+        mock_fan_out.assert_called_once_with(event.id, [excluded.id])
+        # In-app notifications are still created immediately.
+        Notification.objects.get(user=watcher, event=event)
+
+    @override_settings(NOTIFICATION_BATCH_SIZE=2)
+    @patch('apps.lib.tasks.deliver_notifications.delay')
+    def test_fan_out_batches(self, mock_deliver):
+        user = UserFactory.create()
+        watchers = UserFactory.create_batch(6)
+        for watcher in watchers:
+            commissions_open_subscription(watcher, user, date(2100, 1, 1))
+        event = Event.objects.create(type=COMMISSIONS_OPEN, target=user)
+        fan_out_notification(event.id, [watchers[5].id])
+        subscription_ids = list(Subscription.objects.filter(
+            subscriber__in=watchers[:5], type=COMMISSIONS_OPEN,
+        ).order_by('id').values_list('id', flat=True))
+        # Five subscriptions in batches of two make three batches for each medium.
+        batches = [subscription_ids[0:2], subscription_ids[2:4], subscription_ids[4:5]]
+        mock_deliver.assert_has_calls(
+            [call(event.id, 'email', batch) for batch in batches]
+            + [call(event.id, 'telegram', batch) for batch in batches],
+        )
+        self.assertEqual(mock_deliver.call_count, 6)
+
+    def test_deliver_notifications(self):
+        user = UserFactory.create()
+        watcher = UserFactory.create()
+        commissions_open_subscription(watcher, user, date(2100, 1, 1))
+        event = Event.objects.create(type=COMMISSIONS_OPEN, target=user)
+        subscription = Subscription.objects.get(subscriber=watcher, type=COMMISSIONS_OPEN)
+        deliver_notifications(event.id, 'email', [subscription.id])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [watcher.email])
+        self.assertEqual(mail.outbox[0].subject, f'Commissions are open for {user.username}!')
+
+
+class TestBulkSubscriptions(SignalsDisabledMixin, TestCase):
+    def test_bulk_subscribe(self):
+        watchers = UserFactory.create_batch(2)
+        watched = UserFactory.create_batch(2)
+        Subscription.objects.create(
+            subscriber=watchers[0], type=NEW_JOURNAL, content_type=ContentType.objects.get_for_model(watched[0]),
+            object_id=watched[0].id, email=True,
+        )
+        bulk_subscribe(watchers, watched, WATCH_TYPES)
+        self.assertEqual(
+            Subscription.objects.filter(subscriber__in=watchers, type__in=WATCH_TYPES).count(),
+            2 * 2 * len(WATCH_TYPES),
+        )
+        # Existing subscriptions are left alone.
+        subscription = Subscription.objects.get(subscriber=watchers[0], type=NEW_JOURNAL, object_id=watched[0].id)
+        self.assertTrue(subscription.email)
+
+    def test_bulk_unsubscribe(self):
+        watcher = UserFactory.create()
+        watched = UserFactory.create_batch(2)
+        bulk_subscribe([watcher], watched, WATCH_TYPES)
+        bulk_unsubscribe([watcher], watched[:1], WATCH_TYPES)
+        self.assertFalse(Subscription.objects.filter(subscriber=watcher, object_id=watched[0].id).exists())
+        self.assertEqual(
+            Subscription.objects.filter(subscriber=watcher, object_id=watched[1].id).count(), len(WATCH_TYPES),
+        )
+
+    def test_import_watch_list(self):
+        watcher = UserFactory.create()
+        watched = UserFactory.create_batch(3)
+        watcher.watching.add(*watched)
+        Subscription.objects.filter(subscriber=watcher).delete()
+        import_watch_list(watcher)
+        self.assertEqual(
+            Subscription.objects.filter(subscriber=watcher, type__in=WATCH_TYPES).count(), 3 * len(WATCH_TYPES),
+        )
+
 
 class TestMarkers(TestCase):
     def test_edit_marker(self):
@@ -341,3 +583,20 @@ class TestPositionShifts(TestCase):
                 f'Expected delta of {delta} to result in position value of {result} with initial '
                 f'position {start}. {err}',
             )
+
+
+class TestNotificationTemplates(TestCase):
+    def test_all_templates_present(self):
+        self.assertEqual(NotificationTemplates().load(), [])
+
+    @patch('apps.lib.utils.EMAIL_SUBJECTS', {FAVORITE: 'Test'})
+    def test_missing_template(self):
+        registry = NotificationTemplates()
+        self.assertEqual(registry.load(), [f'No email template found for event type {FAVORITE}.'])
+        self.assertRaises(ImproperlyConfigured, registry.email_for, FAVORITE)
+
+    def test_exact_prefix(self):
+        registry = NotificationTemplates()
+        registry.load()
+        template, _subject = registry.email_for(COMMENT)
+        self.assertEqual(template.template.name, 'notifications/4_new_comment.html')
@@ -0,0 +1,46 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.lib.version import VersionCache, UNKNOWN_VERSION
+
+
+class TestVersionCache(SimpleTestCase):
+    @patch('apps.lib.version.VERSION_CHECK_INTERVAL', 0)
+    def test_refreshes_when_file_changes(self):
+        with TemporaryDirectory() as base_dir, override_settings(DEBUG=False, BASE_DIR=base_dir):
+            cache = VersionCache()
+            self.assertEqual(cache.get(), UNKNOWN_VERSION)
+            path = os.path.join(base_dir, '.static_hash_head')
+            with open(path, 'w') as current_hash:
+                current_hash.write('abc123\n')
+            os.utime(path, (1, 1))
+            self.assertEqual(cache.get(), 'abc123')
+            with open(path, 'w') as current_hash:
+                current_hash.write('def456\n')
+            # Unchanged modification time means the cached value is still served.
+            os.utime(path, (1, 1))
+            self.assertEqual(cache.get(), 'abc123')
+            os.utime(path, (2, 2))
+            self.assertEqual(cache.get(), 'def456')
+
+    def test_checks_throttled(self):
+        with TemporaryDirectory() as base_dir, override_settings(DEBUG=False, BASE_DIR=base_dir):
+            path = os.path.join(base_dir, '.static_hash_head')
+            with open(path, 'w') as current_hash:
+                current_hash.write('abc123\n')
+            cache = VersionCache()
+            with patch('apps.lib.version.monotonic', return_value=100):
+                self.assertEqual(cache.get(), 'abc123')
+            with open(path, 'w') as current_hash:
+                current_hash.write('def456\n')
+            os.utime(path, (1, 1))
+            with patch('apps.lib.version.monotonic', return_value=105), \
+                    patch('apps.lib.version.os.stat') as mock_stat:
+                self.assertEqual(cache.get(), 'abc123')
+            mock_stat.assert_not_called()
+            with patch('apps.lib.version.monotonic', return_value=111):
+                self.assertEqual(cache.get(), 'def456')
+            self.assertEqual(cache.cached(), 'def456')
@@ -42,6 +42,26 @@ class TestComment(SignalsDisabledMixin, APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['results'][0]['id'], comment.id)
 
+    def test_list_comments_cursor(self):
+        submission = SubmissionFactory.create()
+        comments = [
+            CommentFactory.create(user=submission.owner, content_object=submission, top=submission)
+            for _ in range(3)
+        ]
+        url = f'/api/lib/v1/comments/profiles.Submission/{submission.id}/'
+        response = self.client.get(url, {'cursor': '', 'size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['results']], [comments[2].id, comments[1].id])
+        self.assertIsNone(response.data['links']['previous'])
+        response = self.client.get(response.data['links']['next'])
+        self.assertEqual([item['id'] for item in response.data['results']], [comments[0].id])
+        self.assertIsNone(response.data['links']['next'])
+
+    def test_list_comments_bad_cursor(self):
+        submission = SubmissionFactory.create()
+        response = self.client.get(f'/api/lib/v1/comments/profiles.Submission/{submission.id}/?cursor=nonsense')
+        self.assertEqual(response.status_code, 404)
+
 
 class TestSupportRequest(APITestCase):
     def test_send_request(self):
@@ -72,3 +92,21 @@ class TestAssetUpload(APITestCase):
         user = UserFactory.create()
         self.login(user)
         self.upload_asset(mock_cache)
+
+
+class TestRealtimeStats(APITestCase):
+    def test_staff_only(self):
+        self.login(UserFactory.create())
+        response = self.client.get('/api/lib/v1/realtime-stats/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_realtime_stats(self):
+        self.login(UserFactory.create(is_staff=True))
+        response = self.client.get('/api/lib/v1/realtime-stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data['publisher']), {'queue_depth', 'sent', 'failed', 'dropped'})
+        self.assertEqual(set(response.data['outbox']), {'coalesced', 'dropped', 'resyncs'})
+        self.assertIn('largest_groups', response.data)
+        self.assertEqual(
+            list(response.data['account_lock_waits']), ['<=0.001s', '<=0.01s', '<=0.1s', '<=1s', '<=10s', '>10s'],
+        )
@@ -1,20 +1,20 @@
 import logging
 import os
+from dataclasses import dataclass
 from hashlib import sha256
 from itertools import chain
 from pathlib import Path
-from typing import Optional, TYPE_CHECKING, Type, List, Union
+from typing import Optional, TYPE_CHECKING, Type, List, Union, Iterable, Tuple
 from uuid import uuid4
 
 import markdown
-from asgiref.sync import async_to_sync
 from bs4 import BeautifulSoup
-from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.db import connection, transaction, IntegrityError
-from django.db.models import Q, Model, Subquery, IntegerField
+from django.db.models import Q, Model, Subquery, IntegerField, Count, QuerySet
 from django.db.models.signals import pre_delete
 from django.db.transaction import atomic
 from django.dispatch import receiver
@@ -34,8 +34,10 @@ from rest_framework.response import Response
 from telegram import Bot
 
 from apps.lib.models import Subscription, Event, Notification, Tag, Comment, COMMENT, \
-    NEW_PRODUCT, COMMISSIONS_OPEN, NEW_CHARACTER, STREAMING, EMAIL_SUBJECTS, NEW_JOURNAL, ReadMarker, ModifiedMarker, \
-    Asset
+    COMMISSIONS_OPEN, EMAIL_SUBJECTS, ReadMarker, ModifiedMarker, \
+    Asset, TELEGRAM_TYPES, WATCH_TYPES, ORDER_NOTIFICATION_TYPES, EMAIL_IMMEDIATE, PendingEmail, \
+    UnreadNotificationCount, SALES_NOTIFICATION, COMMUNITY_NOTIFICATION
+from apps.lib.publisher import group_send
 from shortcuts import make_url, disable_on_load, gen_textifier
 
 BOT = None
@@ -108,26 +110,188 @@ def recall_notification(event_type, target, data=None, unique_data=False):
     content_type = target and ContentType.objects.get_for_model(target)
     object_id = target and target.id
     events = get_matching_events(event_type, content_type, object_id, data, unique_data)
+    adjust_unread_counts(Notification.objects.filter(event__in=events), -1)
     events.update(recalled=True)
+    Notification.objects.filter(event__in=events, recalled=False).update(recalled=True)
 
 
-def update_event(event, data, subscriptions, mark_unread, time_override=None, transform=None):
+def update_event(event, data, match, mark_unread, time_override=None, transform=None):
+    was_recalled = event.recalled
     event.recalled = False
+    old_date = event.date
     if mark_unread or time_override:
         event.date = time_override or timezone.now()
     if transform:
         try:
             data = transform(event.data, data)
         except RecallNotification as err:
+            if not was_recalled:
+                adjust_unread_counts(Notification.objects.filter(event=event), -1)
+                Notification.objects.filter(event=event).update(recalled=True)
             event.recalled = True
             event.data = err.data
             event.save()
             return
     event.data = data
     event.save()
+    # Notifications carry copies of these, so that the feeds needn't join against the event.
+    copied = {}
+    if event.date != old_date:
+        copied['date'] = event.date
+    if was_recalled:
+        copied['recalled'] = False
+    if copied:
+        Notification.objects.filter(event=event).update(**copied)
+    if was_recalled:
+        adjust_unread_counts(Notification.objects.filter(event=event), 1)
     if mark_unread:
-        subscribers = subscriptions.values_list('subscriber_id', flat=True)
-        Notification.objects.filter(user__in=subscribers, event=event).update(read=False)
+        mark_notifications_unread(event, match)
+
+
+ORDER_COMMENT_TYPES_STORE = None
+
+
+def order_comment_types():
+    """
+    Content types which, when commented on, produce notifications for the sales feed rather than the community feed.
+    """
+    global ORDER_COMMENT_TYPES_STORE
+    if ORDER_COMMENT_TYPES_STORE is not None:
+        return ORDER_COMMENT_TYPES_STORE
+    from apps.sales.models import Order, Reference, Revision, Deliverable
+    ORDER_COMMENT_TYPES_STORE = (
+        ContentType.objects.get_for_model(Order),
+        ContentType.objects.get_for_model(Reference),
+        ContentType.objects.get_for_model(Revision),
+        ContentType.objects.get_for_model(Deliverable),
+    )
+    return ORDER_COMMENT_TYPES_STORE
+
+
+def notification_category(event: Event) -> int:
+    """
+    Determines which feed the notifications for an event belong in.
+    """
+    if event.type in ORDER_NOTIFICATION_TYPES:
+        return SALES_NOTIFICATION
+    if event.type == COMMENT and event.content_type_id in [
+        content_type.id for content_type in order_comment_types()
+    ]:
+        return SALES_NOTIFICATION
+    return COMMUNITY_NOTIFICATION
+
+
+# Adds the rows selected by a statement to the unread counters. The statement must come before this and provide
+# user_id, community and sales columns.
+UNREAD_COUNT_UPSERT = """
+    INSERT INTO lib_unreadnotificationcount (user_id, community, sales)
+    SELECT deltas.user_id, deltas.community, deltas.sales FROM deltas
+    ON CONFLICT (user_id) DO UPDATE SET
+        community = lib_unreadnotificationcount.community + EXCLUDED.community,
+        sales = lib_unreadnotificationcount.sales + EXCLUDED.sales
+"""
+
+
+def adjust_unread_counts(notifications, delta: int):
+    """
+    Adjusts the unread counters by delta for every notification in the queryset which currently counts as unread--
+    that is, it is unread and its event has not been recalled. Call this just before a change which stops them
+    counting, with a delta of -1, or just after a change which makes them count, with a delta of 1.
+    """
+    counted = notifications.filter(read=False, recalled=False).order_by().values('user_id').annotate(
+        total=Count('id'), sales=Count('id', filter=Q(category=SALES_NOTIFICATION)),
+    ).values('user_id', 'total', 'sales')
+    sql, params = counted.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH counted AS ({sql}), deltas AS (
+                SELECT counted.user_id, (counted.total - counted.sales) * %s AS community, counted.sales * %s AS sales
+                FROM counted
+            )
+            {UNREAD_COUNT_UPSERT}
+            """,
+            [*params, delta, delta],
+        )
+
+
+def execute_counted(event: Event, statement: str, params: list):
+    """
+    Runs a statement which inserts notifications for an event or marks them unread, and which returns the user_id of
+    each row it changed. Each of those users has their unread counter incremented in the same query.
+    """
+    with connection.cursor() as cursor:
+        if event.recalled:
+            # Notifications on recalled events aren't counted.
+            cursor.execute(statement, params)
+            return
+        community, sales = (0, 1) if notification_category(event) == SALES_NOTIFICATION else (1, 0)
+        cursor.execute(
+            f"""
+            WITH changed AS ({statement}), deltas AS (
+                SELECT changed.user_id, %s AS community, %s AS sales FROM changed
+            )
+            {UNREAD_COUNT_UPSERT}
+            """,
+            [*params, community, sales],
+        )
+
+
+def rebuild_unread_counts(users):
+    """
+    Recomputes the unread counters for a queryset of users from the notification tables.
+    """
+    with transaction.atomic():
+        UnreadNotificationCount.objects.filter(user__in=users).delete()
+        adjust_unread_counts(Notification.objects.filter(user__in=users), 1)
+
+
+def unread_counts(user: 'User') -> dict:
+    counter = UnreadNotificationCount.objects.filter(user=user).first()
+    community, sales = (counter.community, counter.sales) if counter else (0, 0)
+    return {'count': community + sales, 'community_count': community, 'sales_count': sales}
+
+
+def mark_notifications_unread(event: Event, match: 'SubscriptionMatch'):
+    """
+    Marks the notifications for an event unread for everyone with a matching subscription, in a single UPDATE.
+    Rows which are already unread are left alone.
+    """
+    if match.subscriptions is None:
+        return
+    sql, params = match.subscriptions.order_by().values('subscriber_id').query.sql_with_params()
+    # noinspection SqlResolve
+    execute_counted(
+        event,
+        f"""
+        UPDATE {Notification._meta.db_table} SET read = false
+        WHERE event_id = %s AND read AND user_id IN ({sql})
+        RETURNING user_id
+        """,
+        [event.id, *params],
+    )
+
+
+def insert_notifications(event: Event, match: 'SubscriptionMatch'):
+    """
+    Creates notifications for an event for everyone with a matching subscription. This runs entirely on the database
+    server as an INSERT ... SELECT, and relies on the unique (event, user) constraint to skip anyone who already has
+    a notification for this event.
+    """
+    if match.subscriptions is None:
+        return
+    sql, params = match.subscriptions.order_by().values('subscriber_id').distinct().query.sql_with_params()
+    # noinspection SqlResolve
+    execute_counted(
+        event,
+        f"""
+        INSERT INTO {Notification._meta.db_table} (event_id, user_id, read, category, date, recalled)
+        SELECT %s, subscribers.subscriber_id, false, %s, %s, %s FROM ({sql}) AS subscribers
+        ON CONFLICT (event_id, user_id) DO NOTHING
+        RETURNING user_id
+        """,
+        [event.id, notification_category(event), event.date, event.recalled, *params],
+    )
 
 
 def target_params(object_id, content_type):
@@ -144,6 +308,48 @@ def get_matching_subscriptions(event_type, object_id, content_type, exclude=None
     ).exclude(subscriber__in=exclude).filter(Q(until__isnull=True) | Q(until__gte=date.today()))
 
 
+@dataclass(frozen=True)
+class SubscriptionMatch:
+    """
+    Everyone who should hear about an event. Everyone with one of the matching subscriptions gets an in-app
+    notification, which is written by statements run over the subscriptions query, so the subscribers themselves
+    never need to be loaded. email_ids and telegram_ids are the subscriptions which also want it sent over those
+    mediums right away. digests holds (subscriber_id, frequency) pairs for those who want the email rolled up into a
+    digest instead.
+    """
+    subscriptions: Optional[QuerySet] = None
+    found: bool = False
+    email_ids: Tuple[int, ...] = ()
+    telegram_ids: Tuple[int, ...] = ()
+    digests: Tuple[Tuple[int, int], ...] = ()
+
+
+def match_subscriptions(event_type, object_id, content_type, exclude=None) -> SubscriptionMatch:
+    """
+    Finds the subscriptions for an event and sorts the ones with email or Telegram turned on by how they should be
+    delivered. Only those are loaded. If there are none, whether there are any subscriptions at all is checked
+    separately. content_type may be a ContentType or its ID.
+    """
+    subscriptions = get_matching_subscriptions(event_type, object_id, content_type, exclude)
+    email_ids = []
+    telegram_ids = []
+    digests = []
+    rows = subscriptions.filter(Q(email=True) | Q(telegram=True)).order_by('id').values_list(
+        'id', 'subscriber_id', 'email', 'telegram', 'email_frequency',
+    )
+    for subscription_id, subscriber_id, email, telegram, email_frequency in rows:
+        if email and email_frequency == EMAIL_IMMEDIATE:
+            email_ids.append(subscription_id)
+        elif email:
+            digests.append((subscriber_id, email_frequency))
+        if telegram:
+            telegram_ids.append(subscription_id)
+    return SubscriptionMatch(
+        subscriptions=subscriptions, found=bool(rows) or subscriptions.exists(), email_ids=tuple(email_ids),
+        telegram_ids=tuple(telegram_ids), digests=tuple(digests),
+    )
+
+
 def get_matching_events(event_type, content_type, object_id, data, unique_data=None):
     query = Q(type=event_type)
     query &= target_params(object_id, content_type)
@@ -170,73 +376,56 @@ def commissions_open_subscription(watcher: 'User', watched: 'User', target_date:
     sub.save()
 
 
-def watch_subscriptions(watcher, watched):
-    # To be implemented when paid service is in place.
-    content_type = ContentType.objects.get_for_model(watched)
-    Subscription.objects.get_or_create(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=COMMISSIONS_OPEN
-    )
-    Subscription.objects.get_or_create(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_CHARACTER
-    )
-    Subscription.objects.get_or_create(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_PRODUCT
-    )
-    Subscription.objects.get_or_create(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=STREAMING
-    )
-    Subscription.objects.get_or_create(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_JOURNAL
+def bulk_subscribe(subscribers: Iterable['User'], targets: Iterable[Model], types: Iterable[int], **kwargs):
+    """
+    Subscribes every subscriber to each of the event types on every target in a single INSERT. Subscriptions which
+    already exist are left untouched. Any kwargs are set on the subscriptions which are created.
+    """
+    targets = [(ContentType.objects.get_for_model(target), target.id) for target in targets]
+    Subscription.objects.bulk_create(
+        [
+            Subscription(
+                subscriber=subscriber, content_type=content_type, object_id=object_id, type=event_type, **kwargs,
+            )
+            for subscriber in subscribers
+            for content_type, object_id in targets
+            for event_type in types
+        ],
+        ignore_conflicts=True,
     )
 
 
+def bulk_unsubscribe(subscribers: Iterable['User'], targets: Iterable[Model], types: Iterable[int]):
+    """
+    Removes every subscriber's subscriptions to each of the event types on every target in a single DELETE.
+    """
+    object_ids = {}
+    for target in targets:
+        object_ids.setdefault(ContentType.objects.get_for_model(target), []).append(target.id)
+    if not object_ids:
+        return
+    target_q = Q()
+    for content_type, ids in object_ids.items():
+        target_q |= Q(content_type=content_type, object_id__in=ids)
+    Subscription.objects.filter(target_q, subscriber__in=subscribers, type__in=types).delete()
+
+
+def watch_subscriptions(watcher, watched):
+    bulk_subscribe([watcher], [watched], WATCH_TYPES)
+
+
 def remove_watch_subscriptions(watcher, watched):
-    content_type = ContentType.objects.get_for_model(watched)
-    Subscription.objects.filter(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_CHARACTER
-    ).delete()
-    Subscription.objects.filter(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_PRODUCT
-    ).delete()
-    Subscription.objects.filter(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=COMMISSIONS_OPEN
-    ).delete()
-    Subscription.objects.filter(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=STREAMING
-    ).delete()
-    Subscription.objects.filter(
-        subscriber=watcher,
-        content_type=content_type,
-        object_id=watched.id,
-        type=NEW_JOURNAL
-    ).delete()
+    bulk_unsubscribe([watcher], [watched], WATCH_TYPES)
+
+
+def import_watch_list(watcher: 'User', watched: Optional[Iterable['User']] = None):
+    """
+    Creates the watch subscriptions for everyone on a watch list at once-- by default, the watcher's current one.
+    Useful when watch lists are brought over from elsewhere, or to repair subscriptions which have gone missing.
+    """
+    if watched is None:
+        watched = watcher.watching.all()
+    bulk_subscribe([watcher], watched, WATCH_TYPES)
 
 
 class FakeSession:
@@ -261,6 +450,247 @@ class FakeRequest:
         return make_url(value)
 
 
+def notification_context(event: Event, subscriber: 'User') -> dict:
+    """
+    Builds the template context used to render an email or Telegram message about an event for a particular
+    subscriber.
+    """
+    from apps.lib.serializers import event_data, event_target
+    req_context = {'request': FakeRequest(subscriber)}
+    return {
+        'data': event_data(event, req_context),
+        'target': event_target(event, req_context), 'user': subscriber,
+        'base_url': make_url(''),
+    }
+
+
+class NotificationTemplates:
+    """
+    Registry of the compiled templates used to render notification emails and Telegram messages, keyed by event type.
+    Built once per process so that sending a notification does not touch the filesystem or reparse templates.
+    """
+    def __init__(self):
+        self.email = {}
+        self.telegram = {}
+        self.subjects = {}
+        self.digest = None
+        self.loaded = False
+
+    @staticmethod
+    def find(file_names: List[str], prefix: str) -> Optional[str]:
+        for file_name in file_names:
+            if file_name.startswith(f'{prefix}_'):
+                return f'notifications/{file_name}'
+        return None
+
+    def load(self) -> List[str]:
+        """
+        Compiles all notification templates. Returns a list of problems found, such as missing templates.
+        """
+        errors = []
+        path = Path(settings.BACKEND_ROOT) / 'templates' / 'notifications'
+        file_names = sorted(os.listdir(str(path)))
+        email, telegram, subjects = {}, {}, {}
+        for event_type, subject in EMAIL_SUBJECTS.items():
+            subjects[event_type] = Template(subject)
+            template_name = self.find(file_names, str(event_type))
+            if template_name is None:
+                errors.append(f'No email template found for event type {event_type}.')
+                continue
+            email[event_type] = get_template(template_name)
+        for event_type in TELEGRAM_TYPES:
+            template_name = self.find(file_names, f'TG_{event_type}')
+            if template_name is None:
+                errors.append(f'No Telegram template found for event type {event_type}.')
+                continue
+            telegram[event_type] = get_template(template_name)
+        self.email, self.telegram, self.subjects = email, telegram, subjects
+        self.digest = get_template('notifications/digest.html')
+        self.loaded = True
+        return errors
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def email_for(self, event_type: int):
+        self.ensure_loaded()
+        if event_type not in self.email:
+            raise ImproperlyConfigured(f'No email template registered for event type {event_type}.')
+        return self.email[event_type], self.subjects[event_type]
+
+    def has_email(self, event_type: int) -> bool:
+        self.ensure_loaded()
+        return event_type in self.email
+
+    def digest_template(self):
+        self.ensure_loaded()
+        return self.digest
+
+    def telegram_for(self, event_type: int):
+        self.ensure_loaded()
+        if event_type not in self.telegram:
+            raise ImproperlyConfigured(f'No Telegram template registered for event type {event_type}.')
+        return self.telegram[event_type]
+
+
+NOTIFICATION_TEMPLATES = NotificationTemplates()
+
+
+def notification_email(event: Event, subscriber: 'User') -> EmailMultiAlternatives:
+    """
+    Renders the email for an event to a subscriber. Does not send it.
+    """
+    template, subject_template = NOTIFICATION_TEMPLATES.email_for(event.type)
+    ctx = notification_context(event, subscriber)
+    subject = subject_template.render(Context(ctx))
+    to = [subscriber.guest_email or subscriber.email]
+    from_email = settings.DEFAULT_FROM_EMAIL
+    message = template.render(ctx)
+    textifier = gen_textifier()
+    msg = EmailMultiAlternatives(
+        subject, textifier.handle(message), to=to, from_email=from_email,
+        headers={'Return-Path': settings.RETURN_PATH_EMAIL},
+    )
+    msg.attach_alternative(message, 'text/html')
+    return msg
+
+
+def digest_email(subscriber: 'User', events: List[Event]) -> Optional[EmailMultiAlternatives]:
+    """
+    Renders a single email rolling up several events for a subscriber. Does not send it. Events of types which have no
+    email are left out, and if that leaves nothing to send, returns None.
+    """
+    items = []
+    for event in events:
+        if not NOTIFICATION_TEMPLATES.has_email(event.type):
+            continue
+        _, subject_template = NOTIFICATION_TEMPLATES.email_for(event.type)
+        items.append({'subject': subject_template.render(Context(notification_context(event, subscriber)))})
+    if not items:
+        return None
+    ctx = {'user': subscriber, 'items': items, 'base_url': make_url('')}
+    subject = f'You have {len(items)} new notification{"" if len(items) == 1 else "s"} on Artconomy'
+    message = NOTIFICATION_TEMPLATES.digest_template().render(ctx)
+    textifier = gen_textifier()
+    msg = EmailMultiAlternatives(
+        subject, textifier.handle(message), to=[subscriber.guest_email or subscriber.email],
+        from_email=settings.DEFAULT_FROM_EMAIL, headers={'Return-Path': settings.RETURN_PATH_EMAIL},
+    )
+    msg.attach_alternative(message, 'text/html')
+    return msg
+
+
+def queue_digest_emails(event: Event, digests: Iterable[Tuple[int, int]]):
+    """
+    Holds an event for the next digest email of each (subscriber_id, frequency) pair. Events of types which have no
+    email aren't held.
+    """
+    if not NOTIFICATION_TEMPLATES.has_email(event.type):
+        return
+    PendingEmail.objects.bulk_create(
+        [
+            PendingEmail(subscriber_id=subscriber_id, event=event, frequency=frequency)
+            for subscriber_id, frequency in digests
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def send_digest_emails(frequency: int):
+    """
+    Sends everyone with events pending for digests of the given frequency a single email covering all of them.
+    Subscribers are handled in batches of settings.NOTIFICATION_BATCH_SIZE, each sent to the mail backend at once. A
+    subscriber whose email can't be rendered is logged and skipped, and their pending events are dropped rather than
+    failing the batch on every run.
+    """
+    cutoff = timezone.now()
+    pending = PendingEmail.objects.filter(frequency=frequency, created_on__lte=cutoff)
+    subscriber_ids = list(pending.order_by('subscriber_id').values_list('subscriber_id', flat=True).distinct())
+    batch_size = settings.NOTIFICATION_BATCH_SIZE
+    for index in range(0, len(subscriber_ids), batch_size):
+        batch = pending.filter(subscriber_id__in=subscriber_ids[index:index + batch_size]).select_related(
+            'subscriber', 'event',
+        ).order_by('subscriber_id', 'event__date')
+        events_by_subscriber = {}
+        pending_ids = []
+        for entry in batch:
+            pending_ids.append(entry.id)
+            if entry.event.recalled:
+                continue
+            events_by_subscriber.setdefault(entry.subscriber, []).append(entry.event)
+        messages = []
+        for subscriber, events in events_by_subscriber.items():
+            try:
+                message = digest_email(subscriber, events)
+            except Exception as err:
+                logger.exception(err)
+                continue
+            if message:
+                messages.append(message)
+        if messages:
+            get_connection().send_messages(messages)
+        PendingEmail.objects.filter(id__in=pending_ids).delete()
+
+
+def notification_telegram(event: Event, subscriber: 'User') -> str:
+    """
+    Renders the Telegram message for an event to a subscriber. Does not send it.
+    """
+    return NOTIFICATION_TEMPLATES.telegram_for(event.type).render(notification_context(event, subscriber))
+
+
+def send_notification_emails(event: Event, subscriptions: Iterable[Subscription]):
+    """
+    Renders and sends notification emails for an event to a set of subscriptions, handing them to the mail backend
+    in a single batch.
+    """
+    messages = [notification_email(event, subscription.subscriber) for subscription in subscriptions]
+    if not messages:
+        return
+    get_connection().send_messages(messages)
+
+
+def send_notification_telegrams(event: Event, subscriptions: Iterable[Subscription]):
+    """
+    Renders and sends Telegram notifications for an event to a set of subscriptions.
+    """
+    for subscription in subscriptions:
+        if not subscription.subscriber.tg_chat_id:
+            continue
+        message = notification_telegram(event, subscription.subscriber)
+        try:
+            get_bot().send_message(chat_id=subscription.subscriber.tg_chat_id, parse_mode='Markdown', text=message)
+        except Exception as err:
+            logger.exception(err)
+
+
+def broadcast_notification(event: Event, match: SubscriptionMatch, exclude=None):
+    """
+    Sends out the email and Telegram notifications for an event, either inline or by handing them off to the
+    notification workers, depending on settings.NOTIFICATION_FANOUT. Emails for subscribers who want digests are
+    held for the digest workers instead.
+    """
+    if match.digests:
+        queue_digest_emails(event, match.digests)
+    if not (match.email_ids or match.telegram_ids):
+        return
+    if settings.NOTIFICATION_FANOUT:
+        from apps.lib.tasks import fan_out_notification
+        event_id = event.id
+        exclude_ids = [getattr(user, 'id', user) for user in (exclude or [])]
+        transaction.on_commit(lambda: fan_out_notification.delay(event_id, exclude_ids))
+        return
+    if match.email_ids:
+        send_notification_emails(
+            event, Subscription.objects.filter(id__in=match.email_ids).select_related('subscriber'),
+        )
+    if match.telegram_ids:
+        send_notification_telegrams(
+            event, Subscription.objects.filter(id__in=match.telegram_ids).select_related('subscriber'),
+        )
+
+
 @atomic
 def notify(
         event_type, target, data=None, unique=False, unique_data=None, mark_unread=False, time_override=None,
@@ -291,17 +721,17 @@ def notify(
     will be useful for later subscribers.
 
     silent_broadcast will not generate any emails or telegram notifications if they otherwise would have been generated.
-    """
-    from apps.lib.serializers import NOTIFICATION_TYPE_MAP
-    from apps.lib.serializers import notification_serialize
 
+    Emails and Telegram messages are sent by the notification workers once the transaction commits, unless
+    settings.NOTIFICATION_FANOUT is disabled, in which case they are sent inline as before.
+    """
     if data is None:
         data = {}
     content_type = target and ContentType.objects.get_for_model(target)
     object_id = target and target.id
-    subscriptions = get_matching_subscriptions(event_type, object_id, content_type, exclude)
+    match = match_subscriptions(event_type, object_id, content_type, exclude)
 
-    if not subscriptions.exists() and not force_create:
+    if not match.found and not force_create:
         return
 
     event = None
@@ -310,7 +740,7 @@ def notify(
         if events.exists():
             event = events[0]
             update_event(
-                event, data, subscriptions,
+                event, data, match,
                 mark_unread=mark_unread,
                 time_override=time_override,
                 transform=transform
@@ -320,64 +750,12 @@ def notify(
             type=event_type, object_id=target and target.id, content_type=content_type, data=data
         )
 
-    # Send email notifications if needed.
-    email_subscriptions = subscriptions.filter(email=True)
-    if not silent_broadcast and email_subscriptions.exists():
-        path = Path(settings.BACKEND_ROOT) / 'templates' / 'notifications'
-        template = [file for file in os.listdir(str(path)) if file.startswith(str(event_type))][0]
-        template_path = path / template
-        for subscription in email_subscriptions:
-            subject = EMAIL_SUBJECTS[event_type]
-            req_context = {'request': FakeRequest(subscription.subscriber)}
-            ctx = {
-                'data': NOTIFICATION_TYPE_MAP.get(event_type, lambda x, _: x.data)(event, req_context),
-                'target': notification_serialize(event.target, req_context), 'user': subscription.subscriber
-            }
-            subject = Template(subject).render(Context(ctx))
-            to = [subscription.subscriber.guest_email or subscription.subscriber.email]
-            from_email = settings.DEFAULT_FROM_EMAIL
-            message = get_template(template_path).render(ctx)
-            textifier = gen_textifier()
-            msg = EmailMultiAlternatives(
-                subject, textifier.handle(message), to=to, from_email=from_email, headers={'Return-Path': settings.RETURN_PATH_EMAIL}
-            )
-            msg.attach_alternative(message, 'text/html')
-            msg.send()
-
-    telegram_subscriptions = subscriptions.filter(telegram=True)
-    if not silent_broadcast and telegram_subscriptions.exists():
-        path = Path(settings.BACKEND_ROOT) / 'templates' / 'notifications'
-        template = [file for file in os.listdir(str(path)) if file.startswith('TG_' + str(event_type))][0]
-        template_path = path / template
-        for subscription in telegram_subscriptions:
-            if not subscription.subscriber.tg_chat_id:
-                continue
-            req_context = {'request': FakeRequest(subscription.subscriber)}
-            ctx = {
-                'data': NOTIFICATION_TYPE_MAP.get(event_type, lambda x, _: x.data)(event, req_context),
-                'target': notification_serialize(event.target, req_context), 'user': subscription.subscriber,
-                'base_url': make_url('')
-            }
-            message = get_template(template_path).render(ctx)
-            try:
-                get_bot().send_message(chat_id=subscription.subscriber.tg_chat_id, parse_mode='Markdown', text=message)
-            except Exception as err:
-                logger.exception(err)
+    if not silent_broadcast:
+        broadcast_notification(event, match, exclude)
 
-    # We need to make sure anyone who was previously ineligible for a notification who is now eligible can get one.
-    # To do that, we must avoid creating any that already exist if we want to leverage bulk_create. This should
-    # be a minority case that won't require too much overhead when it happens, but I suppose we will see.
-    existing = Notification.objects.filter(event=event.id).values_list('user_id', flat=True)
-    subscriptions = subscriptions.exclude(subscriber_id__in=existing)
-    Notification.objects.bulk_create(
-        (
-            Notification(
-                event_id=event.id, user_id=subscriber_id
-            )
-            for subscriber_id in subscriptions.values_list('subscriber_id', flat=True)
-        ),
-        batch_size=1000
-    )
+    # Anyone who was previously ineligible for a notification (for instance, because they were excluded) but who is
+    # now eligible should get one. Those who already have one are skipped by the database.
+    insert_notifications(event, match)
 
 
 def subscribe(event_type, user, target, implicit=True):
@@ -431,7 +809,7 @@ def remove_comment(comment_id):
     )
     data = comment_id
     for event in events:
-        update_event(event, data, False, Subscription.objects.none(), transform=_comment_filter)
+        update_event(event, data, SubscriptionMatch(), mark_unread=False, transform=_comment_filter)
 
 
 def add_check(instance: Optional[Model], field_name: str, *args, replace: bool = False, fallback_max: int = 200):
@@ -727,7 +1105,10 @@ def mark_read(*, obj: Model, user: 'User'):
         content_type=ContentType.objects.get_for_model(obj),
         object_id=obj.id,
     )
-    Notification.objects.filter(event__content_type=content_type, event__object_id=obj.id, user=user).update(read=True)
+    notifications = Notification.objects.filter(event__content_type=content_type, event__object_id=obj.id, user=user)
+    with transaction.atomic():
+        adjust_unread_counts(notifications, -1)
+        notifications.update(read=True)
 
 
 def mark_modified(*, obj: Model, deliverable: 'Deliverable' = None, order: 'Order' = None):
@@ -764,8 +1145,7 @@ def websocket_send(*, group: str, command: str, payload: Optional[dict] = None,
     """
     Broadcasts a message to a specific websocket group.
     """
-    layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    group_send(
         group,
         {'type': 'broadcast', 'contents': {'command': command, 'payload': payload or {}, 'exclude': exclude or []}},
     )
@@ -793,11 +1173,10 @@ def update_websocket(signal, model, *serializer_names):
             # If we're in a transaction, delay this until we're completely finished.
             transaction.on_commit(lambda: update_broadcaster(instance, **kwargs))
             return
-        layer = get_channel_layer()
         app_label = model._meta.app_label
         model_name = model.__name__
         for serializer_name in serializer_names:
-            async_to_sync(layer.group_send)(
+            group_send(
                 f'{app_label}.{model_name}.update.{serializer_name}.{instance.pk}',
                 {'type': 'update_model', 'contents': {
                     'model_name': model_name,
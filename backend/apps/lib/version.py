@@ -0,0 +1,85 @@
+"""
+Keeps track of the deployed version, so that clients can tell when they need to reload.
+"""
+import os
+import subprocess
+from time import monotonic
+from typing import Optional
+
+from django.conf import settings
+
+# Every websocket connection joins this group, so that new versions can be announced to all of them.
+VERSION_GROUP = 'client.version'
+UNKNOWN_VERSION = '######'
+# How long, in seconds, the version is served from memory before checking whether its file has changed.
+VERSION_CHECK_INTERVAL = 10
+
+
+class VersionCache:
+    """
+    Holds the version in memory, only reading it again when the file it comes from changes. The file is checked at
+    most once every VERSION_CHECK_INTERVAL seconds. Deploys write the version to .static_hash_head. In DEBUG, the
+    version is the checked out commit, and git's HEAD log changes whenever that does.
+
+    Checking may block on the filesystem, or on git in DEBUG, so async code should call get through sync_to_async,
+    or use cached instead.
+    """
+    def __init__(self):
+        self.version = None
+        self.mtime = None
+        self.checked = None
+
+    def watched_path(self) -> str:
+        if settings.DEBUG:
+            return os.path.join(settings.BASE_DIR, '.git', 'logs', 'HEAD')
+        return os.path.join(settings.BASE_DIR, '.static_hash_head')
+
+    def modified(self) -> Optional[float]:
+        try:
+            return os.stat(self.watched_path()).st_mtime
+        except OSError:
+            return None
+
+    def resolve(self) -> str:
+        if settings.DEBUG:
+            result = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, cwd=settings.BASE_DIR,
+            )
+            return result.stdout.decode('utf-8').strip() or UNKNOWN_VERSION
+        try:
+            with open(self.watched_path(), 'r') as current_hash:
+                return current_hash.read().strip() or UNKNOWN_VERSION
+        except IOError:
+            return UNKNOWN_VERSION
+
+    def get(self) -> str:
+        now = monotonic()
+        if self.version is not None and now - self.checked < VERSION_CHECK_INTERVAL:
+            return self.version
+        self.checked = now
+        mtime = self.modified()
+        if self.version is None or mtime != self.mtime:
+            self.mtime = mtime
+            self.version = self.resolve()
+        return self.version
+
+    def cached(self) -> str:
+        """
+        Returns the version last read, without touching the filesystem.
+        """
+        return self.version or UNKNOWN_VERSION
+
+
+VERSION = VersionCache()
+
+
+def current_version() -> str:
+    return VERSION.get()
+
+
+def cached_version() -> str:
+    return VERSION.cached()
+
+
+def version_command(version: str) -> dict:
+    return {'command': 'version', 'payload': {'version': version}}
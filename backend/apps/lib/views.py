@@ -1,3 +1,4 @@
+import os
 from collections import OrderedDict
 
 from django.apps import apps
@@ -21,6 +22,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from reversion.models import VersionQuerySet, Version
 
+from apps.lib.consumers import group_membership_counts, outbox_counts
 from apps.lib.middleware import OlderThanPagination
 from apps.lib.models import Comment, Asset
 from apps.lib.permissions import (
@@ -28,6 +30,7 @@ from apps.lib.permissions import (
     IsMethod, IsSafeMethod, CanComment,
     CanListComments,
     IsAuthenticatedObj, IsStaff, SessionKeySet)
+from apps.lib.publisher import PUBLISHER
 from apps.lib.serializers import CommentSerializer, CommentSubscriptionSerializer
 from apps.lib.utils import (
     countries_tweaked, safe_add, default_context,
@@ -379,3 +382,21 @@ class NoOp(APIView):
 
     def get(self, *args, **kwargs):
         return Response({})
+
+
+class RealtimeStats(APIView):
+    """
+    Reports the channel publisher, websocket and account lock wait counters of the process which serves the request.
+    Websockets are served by the same processes as the API, so polling this samples them.
+    """
+    permission_classes = [IsStaff]
+
+    def get(self, request):
+        from apps.sales.utils import lock_wait_histogram
+        return Response({
+            'pid': os.getpid(),
+            'publisher': PUBLISHER.stats(),
+            'outbox': outbox_counts(),
+            'largest_groups': group_membership_counts(limit=20),
+            'account_lock_waits': lock_wait_histogram(),
+        })
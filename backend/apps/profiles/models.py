@@ -35,13 +35,12 @@ from apps.lib.models import (
     SUBMISSION_CHAR_TAG, CHAR_TAG, COMMENT, Tag, SUBMISSION_SHARED, CHAR_SHARED,
     NEW_CHARACTER, RENEWAL_FAILURE, SUBSCRIPTION_DEACTIVATED, RENEWAL_FIXED, NEW_JOURNAL,
     TRANSFER_FAILED, SUBMISSION_ARTIST_TAG, REFERRAL_LANDSCAPE_CREDIT,
-    WATCHING,
+    WATCHING, WATCH_TYPES,
     Notification, WAITLIST_UPDATED)
 from apps.lib.utils import (
     clear_events, tag_list_cleaner, notify, recall_notification, preview_rating,
     send_transaction_email,
-    watch_subscriptions,
-    remove_watch_subscriptions, websocket_send, exclude_request, clear_events_subscriptions_and_comments
+    bulk_subscribe, bulk_unsubscribe, websocket_send, exclude_request, clear_events_subscriptions_and_comments
 )
 from apps.profiles.permissions import (
     SubmissionViewPermission, SubmissionCommentPermission, MessageReadPermission,
@@ -917,13 +916,17 @@ def auto_unsubscribe_journal(sender, instance, **kwargs):
 @disable_on_load
 def subscribe_watching(sender, instance, **kwargs):
     action = kwargs.get('action', '')
-    for pk in kwargs.get('pk_set', set()):
-        user = User.objects.get(pk=pk)
+    if action not in ('post_add', 'post_remove'):
+        return
+    users = list(User.objects.filter(pk__in=kwargs.get('pk_set') or set()))
+    if action == 'post_add':
+        bulk_subscribe([instance], users, WATCH_TYPES)
+    else:
+        bulk_unsubscribe([instance], users, WATCH_TYPES)
+    for user in users:
         if action == 'post_add':
-            watch_subscriptions(instance, user)
             notify(WATCHING, user, {'user_id': instance.id}, unique_data=True)
-        elif action == 'post_remove':
-            remove_watch_subscriptions(instance, user)
+        else:
             recall_notification(WATCHING, user, {'user_id': instance.id}, unique_data=True)
 
 
@@ -12,12 +12,12 @@ from rest_framework import status
 
 from apps.lib.models import (
     Subscription, COMMENT, Notification, SUBMISSION_SHARED, CHAR_SHARED,
-    NEW_PRODUCT, NEW_CHARACTER, Tag,
+    NEW_PRODUCT, NEW_CHARACTER, Tag, FAVORITE,
 )
 from apps.lib.tests.factories import AssetFactory
 from apps.lib.tests.factories_interdepend import CommentFactory
 from apps.lib.tests.test_utils import EnsurePlansMixin
-from apps.lib.utils import watch_subscriptions
+from apps.lib.utils import watch_subscriptions, notify, recall_notification, subscribe, unread_counts
 from apps.profiles.models import Character, Submission, Conversation, User, ConversationParticipant
 from apps.lib.abstract_models import MATURE, ADULT, GENERAL, EXTREME
 from apps.lib.test_resources import APITestCase, SignalsDisabledMixin, PermissionsTestCase, MethodAccessMixin
@@ -1736,3 +1736,43 @@ class TestProfilePreview(EnsurePlansMixin, APITestCase):
         response = self.client.get(f'/profile/{user.username}/about')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn(b'Beep boop', response.content)
+
+
+class TestNotificationsList(APITestCase):
+    def test_recalled_hidden(self):
+        submissions = SubmissionFactory.create_batch(2)
+        user = UserFactory.create()
+        for submission in submissions:
+            subscribe(FAVORITE, user, submission)
+            notify(FAVORITE, target=submission, data={'users': []})
+        recall_notification(FAVORITE, target=submissions[0])
+        self.login(user)
+        response = self.client.get('/api/profiles/v1/data/notifications/community/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [Notification.objects.get(user=user, event__object_id=submissions[1].id).id],
+        )
+
+    def test_mark_read_counts(self):
+        submissions = SubmissionFactory.create_batch(3)
+        user = UserFactory.create()
+        for submission in submissions:
+            subscribe(FAVORITE, user, submission)
+            notify(FAVORITE, target=submission, data={'users': []})
+        first, second, third = Notification.objects.filter(user=user).order_by('id')
+        self.assertEqual(unread_counts(user)['count'], 3)
+        self.login(user)
+        url = '/api/profiles/v1/data/notifications/mark-read/'
+        response = self.client.patch(
+            url, [{'id': first.id, 'read': True}, {'id': third.id, 'read': True}], format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(unread_counts(user)['count'], 1)
+        # Marking an unread notification unread again shouldn't count it twice.
+        response = self.client.patch(
+            url, [{'id': second.id, 'read': False}, {'id': third.id, 'read': False}], format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(unread_counts(user)['count'], 2)
+        self.assertEqual(Notification.objects.filter(user=user, read=False).count(), 2)
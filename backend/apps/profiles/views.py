@@ -41,10 +41,11 @@ from rest_framework_bulk import BulkUpdateAPIView
 from short_stuff import unslugify
 
 from apps.lib.abstract_models import GENERAL
+from apps.lib.middleware import NotificationPagination
 from apps.lib.models import (
     Notification, CHAR_TAG, SUBMISSION_CHAR_TAG, SUBMISSION_ARTIST_TAG, ARTIST_TAG,
     Tag, SUBMISSION_SHARED, CHAR_SHARED,
-    COMMENT, ORDER_NOTIFICATION_TYPES,
+    COMMENT, COMMUNITY_NOTIFICATION, SALES_NOTIFICATION,
     Comment,
     Subscription, FAVORITE)
 from apps.lib.permissions import Any, All, IsSafeMethod, IsMethod, IsAnonymous, \
@@ -55,7 +56,7 @@ from apps.lib.serializers import (
 )
 from apps.lib.utils import (
     recall_notification, notify, demark, preview_rating,
-    add_check, count_hit, shift_position)
+    add_check, count_hit, shift_position, unread_counts, adjust_unread_counts)
 from apps.lib.views import BasePreview
 from apps.profiles.models import (
     User, Character, Submission, RefColor, Attribute, Conversation,
@@ -85,7 +86,6 @@ from apps.profiles.tasks import mailchimp_subscribe
 from apps.profiles.utils import (
     available_chars, char_ordering, available_submissions,
     empty_user, clear_user, UserClearException)
-from apps.sales.models import Order, Reference, Deliverable, Revision
 from apps.sales.serializers import SearchQuerySerializer
 from apps.sales.utils import claim_order_by_token
 from apps.sales.tasks import withdraw_all
@@ -121,6 +121,7 @@ class Register(CreateAPIView):
         instance = serializer.save(guest=False, guest_email='')
         instance.set_password(instance.password)
         # Guests may have historical comments to be concerned with.
+        adjust_unread_counts(instance.notification_set.all(), -1)
         instance.notification_set.all().update(read=True)
         # noinspection SpellCheckingInspection
         instance.offered_mailchimp = True
@@ -823,78 +824,40 @@ class UserSerializerView:
             return UserInfoSerializer
 
 
-ORDER_COMMENT_TYPES_STORE = None
-
-def order_comment_types():
-    global ORDER_COMMENT_TYPES_STORE
-    if ORDER_COMMENT_TYPES_STORE is not None:
-        return ORDER_COMMENT_TYPES_STORE
-    ORDER_COMMENT_TYPES_STORE = (
-        ContentType.objects.get_for_model(Order),
-        ContentType.objects.get_for_model(Reference),
-        ContentType.objects.get_for_model(Revision),
-        ContentType.objects.get_for_model(Deliverable),
-    )
-    return ORDER_COMMENT_TYPES_STORE
-
-
 class UnreadNotifications(APIView):
     permission_classes = [IsRegistered]
 
     # noinspection PyUnusedLocal
     def get(self, request):
-        return Response(
-            status=200,
-            data={
-                'count': Notification.objects.filter(
-                    user=self.request.user, read=False
-                ).exclude(event__recalled=True).count(),
-                'community_count': Notification.objects.filter(
-                    user=self.request.user, read=False
-                ).exclude(
-                    event__recalled=True
-                ).exclude(
-                    event__type__in=ORDER_NOTIFICATION_TYPES
-                ).exclude(
-                    event__type=COMMENT, event__content_type__in=order_comment_types()
-                ).count(),
-                'sales_count': Notification.objects.filter(
-                    user=self.request.user, read=False,
-                ).exclude(event__recalled=True).filter(
-                    Q(event__type__in=ORDER_NOTIFICATION_TYPES) |
-                    Q(event__type=COMMENT, event__content_type__in=order_comment_types())
-                ).count()
-            }
-        )
+        return Response(status=200, data=unread_counts(self.request.user))
 
 
 class CommunityNotificationsList(ListAPIView):
     serializer_class = NotificationSerializer
     permission_classes = [IsRegistered]
+    pagination_class = NotificationPagination
 
     def get_queryset(self):
-        qs = Notification.objects.filter(user=self.request.user).exclude(event__recalled=True).exclude(
-            event__type__in=ORDER_NOTIFICATION_TYPES
-        ).exclude(
-            event__type=COMMENT, event__content_type__in=order_comment_types(),
+        qs = Notification.objects.filter(
+            user=self.request.user, category=COMMUNITY_NOTIFICATION, recalled=False,
         )
         if self.request.GET.get('unread'):
             qs = qs.filter(read=False)
-        return qs.prefetch_related('event').order_by('-event__date')
+        return qs.select_related('event').order_by('-date', '-id')
 
 
 class SalesNotificationsList(ListAPIView):
     serializer_class = NotificationSerializer
     permission_classes = [IsRegistered]
+    pagination_class = NotificationPagination
 
     def get_queryset(self):
-        qs = Notification.objects.filter(user=self.request.user).exclude(event__recalled=True).filter(
-            Q(event__type__in=ORDER_NOTIFICATION_TYPES) |
-            Q(event__type=COMMENT, event__content_type__in=order_comment_types())
+        qs = Notification.objects.filter(
+            user=self.request.user, category=SALES_NOTIFICATION, recalled=False,
         )
         if self.request.GET.get('unread'):
             qs = qs.filter(read=False)
-        return qs.select_related('event').order_by('-event__date')
+        return qs.select_related('event').order_by('-date', '-id')
 
 
 class RefColorList(ListCreateAPIView):
@@ -935,6 +898,17 @@ class MarkNotificationsRead(BulkUpdateAPIView):
     def filter_queryset(self, queryset):
         return queryset.filter(user=self.request.user)
 
+    def perform_bulk_update(self, serializer):
+        # Only rows whose read state actually flips change the counters, so they're adjusted around the save rather
+        # than recounted from the user's whole notification history.
+        mine = Notification.objects.filter(user=self.request.user)
+        read_ids = [item['id'] for item in serializer.validated_data if item.get('read') is True]
+        unread_ids = [item['id'] for item in serializer.validated_data if item.get('read') is False]
+        becoming_unread = list(mine.filter(id__in=unread_ids, read=True).values_list('id', flat=True))
+        adjust_unread_counts(mine.filter(id__in=read_ids), -1)
+        super().perform_bulk_update(serializer)
+        adjust_unread_counts(mine.filter(id__in=becoming_unread), 1)
+
 
 class WatchListSubmissions(ListAPIView):
     serializer_class = SubmissionSerializer
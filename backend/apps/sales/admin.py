@@ -165,6 +165,10 @@ class TransactionRecordAdmin(admin.ModelAdmin):
     list_display = ('id', 'status', 'category', 'created_on', 'finalized_on', 'paid_by', 'source', 'paid_to', 'destination', 'amount')
     ordering = ('-created_on',)
 
+    def get_queryset(self, request):
+        # Records are shown by their targets when they're listed for deletion and logged.
+        return super().get_queryset(request).with_targets()
+
     def paid_by(self, obj):
         if obj.payer:
             return obj.payer.username
@@ -0,0 +1,30 @@
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apps.sales.utils import backfill_transaction_targets
+
+
+class Command(BaseCommand):
+    """
+    The migration creating the TransactionTarget table copies every target that existed at the time, and triggers
+    copy any added since, so this is only needed if the table was modified by hand or the triggers were disabled. It's
+    safe to run while records are being written, since targets which are already copied are skipped. Each batch is
+    committed separately so no lock is held for long.
+    """
+    help = 'Copies any missing TransactionRecord targets into the TransactionTarget lookup table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=10000, help='Number of target links to copy per transaction.',
+        )
+
+    def handle(self, *args: List, **options: Dict):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sales_transactionrecord_targets')
+            last_id = cursor.fetchone()[0]
+        copied = 0
+        for start in range(0, last_id, options['batch_size']):
+            copied += backfill_transaction_targets(start, start + options['batch_size'])
+        self.stdout.write(f'Copied {copied} transaction target(s).')
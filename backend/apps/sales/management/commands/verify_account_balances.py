@@ -0,0 +1,34 @@
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+
+from apps.sales.utils import account_balance_drift, rebuild_account_balances
+
+
+class Command(BaseCommand):
+    """
+    The AccountBalance table is kept current by triggers on the TransactionRecord table, so drift should only happen if
+    the triggers were disabled or the table was modified by hand.
+    """
+    help = 'Recomputes account balances from the transaction ledger and reports any that differ from the balance table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix', action='store_true', help='Rebuild the balance table from the ledger if any drift is found.',
+        )
+
+    def handle(self, *args: List, **options: Dict):
+        drift = account_balance_drift()
+        for user_id, account, currency, status, ledger, recorded in drift:
+            self.stdout.write(
+                f'User {user_id or "(Artconomy)"}, account {account}, status {status}: '
+                f'ledger has {ledger} {currency}, balance table has {recorded} {currency}.'
+            )
+        if not drift:
+            self.stdout.write('Account balances match the ledger.')
+            return
+        if options['fix']:
+            rebuild_account_balances()
+            self.stdout.write(f'Rebuilt account balances. {len(drift)} balance(s) had drifted.')
+        else:
+            self.stdout.write(self.style.ERROR(f'{len(drift)} balance(s) have drifted from the ledger.'))
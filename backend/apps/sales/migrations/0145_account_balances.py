@@ -0,0 +1,118 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sales', '0144_auto_20221104_0624'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.IntegerField(choices=[(300, 'Credit Card'), (301, 'Bank Account'), (302, 'Escrow'), (303, 'Finalized Earnings, available for withdraw'), (500, '(Local Currency) Finalized Earnings, available for withdraw'), (501, '(Local Currency) Bank Account'), (304, 'Contingency reserve'), (305, 'Unannotated earnings'), (306, 'Card transaction fees'), (307, 'Other card fees'), (407, 'Cash deposit'), (308, 'ACH Transaction fees'), (309, 'Other ACH fees'), (310, 'Tax staging'), (311, 'Tax')])),
+                ('currency', models.CharField(max_length=3)),
+                ('status', models.IntegerField(choices=[(0, 'Successful'), (1, 'Failed'), (2, 'Pending')])),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='account_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accountbalance',
+            constraint=models.UniqueConstraint(condition=models.Q(user__isnull=False), fields=('user', 'account', 'currency', 'status'), name='sales_accountbalance_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='accountbalance',
+            constraint=models.UniqueConstraint(condition=models.Q(user__isnull=True), fields=('account', 'currency', 'status'), name='sales_accountbalance_artconomy'),
+        ),
+        # Every TransactionRecord debits its payer's source account and credits its payee's destination account. The
+        # triggers undo a row's old effect and apply its new one whenever any of the columns involved change. The table
+        # is locked so that no records are written between the backfill and the triggers taking over.
+        migrations.RunSQL(
+            """
+            LOCK TABLE sales_transactionrecord IN SHARE ROW EXCLUSIVE MODE;
+
+            CREATE FUNCTION sales_adjust_account_balance(
+                target_user bigint, target_account integer, target_currency varchar, target_status integer,
+                delta numeric
+            ) RETURNS void AS $$
+            BEGIN
+                IF target_user IS NULL THEN
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (NULL, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (account, currency, status) WHERE user_id IS NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                ELSE
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (target_user, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (user_id, account, currency, status) WHERE user_id IS NOT NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE FUNCTION sales_transactionrecord_balance() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM sales_adjust_account_balance(
+                        OLD.payer_id, OLD.source, OLD.amount_currency, OLD.status, OLD.amount
+                    );
+                    PERFORM sales_adjust_account_balance(
+                        OLD.payee_id, OLD.destination, OLD.amount_currency, OLD.status, -OLD.amount
+                    );
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    PERFORM sales_adjust_account_balance(
+                        NEW.payer_id, NEW.source, NEW.amount_currency, NEW.status, -NEW.amount
+                    );
+                    PERFORM sales_adjust_account_balance(
+                        NEW.payee_id, NEW.destination, NEW.amount_currency, NEW.status, NEW.amount
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER sales_transactionrecord_balance_write
+            AFTER INSERT OR DELETE ON sales_transactionrecord
+            FOR EACH ROW EXECUTE PROCEDURE sales_transactionrecord_balance();
+
+            CREATE TRIGGER sales_transactionrecord_balance_update
+            AFTER UPDATE ON sales_transactionrecord
+            FOR EACH ROW WHEN (
+                OLD.status IS DISTINCT FROM NEW.status
+                OR OLD.amount IS DISTINCT FROM NEW.amount
+                OR OLD.amount_currency IS DISTINCT FROM NEW.amount_currency
+                OR OLD.source IS DISTINCT FROM NEW.source
+                OR OLD.destination IS DISTINCT FROM NEW.destination
+                OR OLD.payer_id IS DISTINCT FROM NEW.payer_id
+                OR OLD.payee_id IS DISTINCT FROM NEW.payee_id
+            )
+            EXECUTE PROCEDURE sales_transactionrecord_balance();
+
+            INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+            SELECT entries.user_id, entries.account, entries.currency, entries.status, SUM(entries.amount)
+            FROM (
+                SELECT payer_id AS user_id, source AS account, amount_currency AS currency, status, -amount AS amount
+                FROM sales_transactionrecord
+                UNION ALL
+                SELECT payee_id, destination, amount_currency, status, amount
+                FROM sales_transactionrecord
+            ) AS entries
+            GROUP BY entries.user_id, entries.account, entries.currency, entries.status;
+            """,
+            reverse_sql="""
+            DROP TRIGGER sales_transactionrecord_balance_update ON sales_transactionrecord;
+            DROP TRIGGER sales_transactionrecord_balance_write ON sales_transactionrecord;
+            DROP FUNCTION sales_transactionrecord_balance();
+            DROP FUNCTION sales_adjust_account_balance(bigint, integer, varchar, integer, numeric);
+            """,
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sales', '0145_account_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(db_index=True)),
+                ('account', models.IntegerField(choices=[(300, 'Credit Card'), (301, 'Bank Account'), (302, 'Escrow'), (303, 'Finalized Earnings, available for withdraw'), (500, '(Local Currency) Finalized Earnings, available for withdraw'), (501, '(Local Currency) Bank Account'), (304, 'Contingency reserve'), (305, 'Unannotated earnings'), (306, 'Card transaction fees'), (307, 'Other card fees'), (407, 'Cash deposit'), (308, 'ACH Transaction fees'), (309, 'Other ACH fees'), (310, 'Tax staging'), (311, 'Tax')])),
+                ('currency', models.CharField(max_length=3)),
+                ('status', models.IntegerField(choices=[(0, 'Successful'), (1, 'Failed'), (2, 'Pending')])),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
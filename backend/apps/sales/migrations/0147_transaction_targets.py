@@ -0,0 +1,84 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def copy_targets(apps, schema_editor):
+    """
+    Copies the targets that existed before the trigger did. Done in batches of link IDs so that no single statement
+    has to join the whole targets table at once.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sales_transactionrecord_targets')
+        last_id = cursor.fetchone()[0]
+        for start in range(0, last_id, BACKFILL_BATCH_SIZE):
+            cursor.execute(
+                """
+                INSERT INTO sales_transactiontarget (record_id, content_type_id, object_id)
+                SELECT link.transactionrecord_id, ref.content_type_id, ref.object_id
+                FROM sales_transactionrecord_targets link
+                INNER JOIN lib_genericreference ref ON ref.id = link.genericreference_id
+                WHERE link.id > %s AND link.id <= %s AND ref.content_type_id IS NOT NULL
+                ON CONFLICT DO NOTHING
+                """,
+                [start, start + BACKFILL_BATCH_SIZE],
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('sales', '0146_account_balance_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionTarget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.UUIDField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='target_links', to='sales.transactionrecord')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='transactiontarget',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id', 'record'), name='sales_transactiontarget_target'),
+        ),
+        # Adding a target copies its reference's content type and object ID over, and removing it deletes the copy.
+        # References without a content type can't be resolved, so they're left out. The targets table is locked until the
+        # migration commits, so that no targets are added between the existing ones being copied and the trigger taking
+        # over.
+        migrations.RunSQL(
+            """
+            LOCK TABLE sales_transactionrecord_targets IN SHARE ROW EXCLUSIVE MODE;
+
+            CREATE FUNCTION sales_transactionrecord_targets_sync() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO sales_transactiontarget (record_id, content_type_id, object_id)
+                    SELECT NEW.transactionrecord_id, ref.content_type_id, ref.object_id FROM lib_genericreference ref
+                    WHERE ref.id = NEW.genericreference_id AND ref.content_type_id IS NOT NULL
+                    ON CONFLICT DO NOTHING;
+                    RETURN NEW;
+                END IF;
+                DELETE FROM sales_transactiontarget target USING lib_genericreference ref
+                WHERE ref.id = OLD.genericreference_id AND target.record_id = OLD.transactionrecord_id
+                    AND target.content_type_id = ref.content_type_id AND target.object_id = ref.object_id;
+                RETURN OLD;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER sales_transactionrecord_targets_sync
+            AFTER INSERT OR DELETE ON sales_transactionrecord_targets
+            FOR EACH ROW EXECUTE PROCEDURE sales_transactionrecord_targets_sync();
+            """,
+            reverse_sql="""
+            DROP TRIGGER sales_transactionrecord_targets_sync ON sales_transactionrecord_targets;
+            DROP FUNCTION sales_transactionrecord_targets_sync();
+            """,
+        ),
+        migrations.RunPython(copy_targets, reverse_code=lambda x, y: None),
+    ]
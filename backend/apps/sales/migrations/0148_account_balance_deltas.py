@@ -0,0 +1,80 @@
+from django.db import migrations, models
+
+
+COMPACT_ARTCONOMY_BALANCES = """
+    LOCK TABLE sales_transactionrecord IN SHARE ROW EXCLUSIVE MODE;
+
+    WITH removed AS (
+        DELETE FROM sales_accountbalance WHERE user_id IS NULL RETURNING account, currency, status, amount
+    )
+    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+    SELECT NULL, account, currency, status, SUM(amount) FROM removed GROUP BY account, currency, status;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0147_transaction_targets'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='accountbalance',
+            name='sales_accountbalance_artconomy',
+        ),
+        # Going back to one row per balance means folding the delta rows together first.
+        migrations.RunSQL(migrations.RunSQL.noop, reverse_sql=COMPACT_ARTCONOMY_BALANCES),
+        migrations.AddIndex(
+            model_name='accountbalance',
+            index=models.Index(
+                condition=models.Q(user__isnull=True), fields=['account', 'currency', 'status'],
+                name='sales_accountbalance_deltas',
+            ),
+        ),
+        # Artconomy's balances change with nearly every payment, fee and refund, so keeping them in a single row each
+        # made every such transaction wait on the others until it committed. Their changes are now appended as
+        # separate rows, which never conflict, and summed on read. The fold_account_balances task folds them back
+        # together periodically. User balances keep one row each, so transactions changing the same user's balance
+        # still wait on each other. See 0150 for the order those rows are taken in.
+        migrations.RunSQL(
+            """
+            CREATE OR REPLACE FUNCTION sales_adjust_account_balance(
+                target_user bigint, target_account integer, target_currency varchar, target_status integer,
+                delta numeric
+            ) RETURNS void AS $$
+            BEGIN
+                IF target_user IS NULL THEN
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (NULL, target_account, target_currency, target_status, delta);
+                ELSE
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (target_user, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (user_id, account, currency, status) WHERE user_id IS NOT NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            reverse_sql="""
+            CREATE OR REPLACE FUNCTION sales_adjust_account_balance(
+                target_user bigint, target_account integer, target_currency varchar, target_status integer,
+                delta numeric
+            ) RETURNS void AS $$
+            BEGIN
+                IF target_user IS NULL THEN
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (NULL, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (account, currency, status) WHERE user_id IS NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                ELSE
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (target_user, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (user_id, account, currency, status) WHERE user_id IS NOT NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+        ),
+    ]
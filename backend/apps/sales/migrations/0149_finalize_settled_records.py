@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0148_account_balance_deltas'),
+    ]
+
+    operations = [
+        # Some records were settled by bulk updates which didn't set finalized_on, and so counted as pending in every
+        # balance as of a past time. When they actually settled is lost, so they're treated as settling now. Balances
+        # as of earlier times, and the snapshots taken of them, still show them pending, as they did at the time.
+        migrations.RunSQL(
+            "UPDATE sales_transactionrecord SET finalized_on = now() WHERE finalized_on IS NULL AND status != 2",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
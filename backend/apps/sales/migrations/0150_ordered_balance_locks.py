@@ -0,0 +1,134 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0149_finalize_settled_records'),
+    ]
+
+    operations = [
+        # A user's balance row is locked from the moment the trigger updates it until the transaction ends. Updating
+        # the payer's row and then the payee's meant that two transactions writing records between the same two users
+        # in opposite directions could each hold the row the other needed. The rows a record touches are now always
+        # updated in order of user ID, so one waits for the other instead.
+        #
+        # Rows which reach zero are deleted, so that they don't keep a user whose records are gone from being
+        # deleted.
+        migrations.RunSQL(
+            """
+            CREATE OR REPLACE FUNCTION sales_adjust_account_balance(
+                target_user bigint, target_account integer, target_currency varchar, target_status integer,
+                delta numeric
+            ) RETURNS void AS $$
+            DECLARE
+                balance_id bigint;
+                balance_amount numeric;
+            BEGIN
+                IF target_user IS NULL THEN
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (NULL, target_account, target_currency, target_status, delta);
+                ELSE
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (target_user, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (user_id, account, currency, status) WHERE user_id IS NOT NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount
+                    RETURNING id, amount INTO balance_id, balance_amount;
+                    IF balance_amount = 0 THEN
+                        DELETE FROM sales_accountbalance WHERE id = balance_id;
+                    END IF;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE FUNCTION sales_adjust_account_balances(
+                user_ids bigint[], accounts integer[], currencies varchar[], statuses integer[], deltas numeric[]
+            ) RETURNS void AS $$
+            DECLARE
+                entry record;
+            BEGIN
+                FOR entry IN
+                    SELECT * FROM unnest(user_ids, accounts, currencies, statuses, deltas)
+                        AS entries (user_id, account, currency, status, delta)
+                    ORDER BY user_id NULLS LAST, account, currency, status
+                LOOP
+                    PERFORM sales_adjust_account_balance(
+                        entry.user_id, entry.account, entry.currency, entry.status, entry.delta
+                    );
+                END LOOP;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION sales_transactionrecord_balance() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM sales_adjust_account_balances(
+                        ARRAY[NEW.payer_id, NEW.payee_id], ARRAY[NEW.source, NEW.destination],
+                        ARRAY[NEW.amount_currency, NEW.amount_currency], ARRAY[NEW.status, NEW.status],
+                        ARRAY[-NEW.amount, NEW.amount]
+                    );
+                ELSIF TG_OP = 'DELETE' THEN
+                    PERFORM sales_adjust_account_balances(
+                        ARRAY[OLD.payer_id, OLD.payee_id], ARRAY[OLD.source, OLD.destination],
+                        ARRAY[OLD.amount_currency, OLD.amount_currency], ARRAY[OLD.status, OLD.status],
+                        ARRAY[OLD.amount, -OLD.amount]
+                    );
+                ELSE
+                    PERFORM sales_adjust_account_balances(
+                        ARRAY[OLD.payer_id, OLD.payee_id, NEW.payer_id, NEW.payee_id],
+                        ARRAY[OLD.source, OLD.destination, NEW.source, NEW.destination],
+                        ARRAY[OLD.amount_currency, OLD.amount_currency, NEW.amount_currency, NEW.amount_currency],
+                        ARRAY[OLD.status, OLD.status, NEW.status, NEW.status],
+                        ARRAY[OLD.amount, -OLD.amount, -NEW.amount, NEW.amount]
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DELETE FROM sales_accountbalance WHERE user_id IS NOT NULL AND amount = 0;
+            """,
+            reverse_sql="""
+            CREATE OR REPLACE FUNCTION sales_adjust_account_balance(
+                target_user bigint, target_account integer, target_currency varchar, target_status integer,
+                delta numeric
+            ) RETURNS void AS $$
+            BEGIN
+                IF target_user IS NULL THEN
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (NULL, target_account, target_currency, target_status, delta);
+                ELSE
+                    INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+                    VALUES (target_user, target_account, target_currency, target_status, delta)
+                    ON CONFLICT (user_id, account, currency, status) WHERE user_id IS NOT NULL
+                    DO UPDATE SET amount = sales_accountbalance.amount + EXCLUDED.amount;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION sales_transactionrecord_balance() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM sales_adjust_account_balance(
+                        OLD.payer_id, OLD.source, OLD.amount_currency, OLD.status, OLD.amount
+                    );
+                    PERFORM sales_adjust_account_balance(
+                        OLD.payee_id, OLD.destination, OLD.amount_currency, OLD.status, -OLD.amount
+                    );
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    PERFORM sales_adjust_account_balance(
+                        NEW.payer_id, NEW.source, NEW.amount_currency, NEW.status, -NEW.amount
+                    );
+                    PERFORM sales_adjust_account_balance(
+                        NEW.payee_id, NEW.destination, NEW.amount_currency, NEW.status, NEW.amount
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP FUNCTION sales_adjust_account_balances(bigint[], integer[], varchar[], integer[], numeric[]);
+            """,
+        ),
+    ]
@@ -2,6 +2,7 @@ import re
 from contextlib import contextmanager
 from dataclasses import dataclass
 from decimal import Decimal
+from itertools import islice
 from typing import Union, List
 
 from django.core.exceptions import ValidationError
@@ -16,8 +17,9 @@ from django.db.models import (
     SET_NULL, PositiveIntegerField, URLField, CASCADE, DecimalField, Avg, DateField, EmailField, Sum,
     TextField,
     SlugField,
-    PROTECT, OneToOneField, JSONField, FloatField,
+    PROTECT, OneToOneField, JSONField, FloatField, Q, UUIDField, QuerySet,
 )
+from django.db.models.query import ModelIterable
 
 # Create your models here.
 from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
@@ -41,7 +43,8 @@ from apps.profiles.permissions import UserControls
 from apps.sales.apis import PROCESSOR_CHOICES
 from apps.sales.permissions import OrderViewPermission, ReferenceViewPermission
 from apps.sales.stripe import delete_payment_method, stripe
-from apps.sales.utils import update_availability, reckon_lines, order_context_to_link, order_context, get_totals
+from apps.sales.utils import update_availability, reckon_lines, order_context_to_link, order_context, get_totals, \
+    record_targets
 from shortcuts import disable_on_load
 
 
@@ -916,6 +919,34 @@ class CreditCardToken(Model):
         return super().save(**kwargs)
 
 
+# How many records at a time TransactionRecordQuerySet.with_targets looks up the targets of.
+TARGET_BATCH_SIZE = 100
+
+
+class TargetsResolvingIterable(ModelIterable):
+    def __iter__(self):
+        records = ModelIterable.__iter__(self)
+        while True:
+            batch = list(islice(records, TARGET_BATCH_SIZE))
+            if not batch:
+                return
+            targets = record_targets(batch)
+            for record in batch:
+                record.resolved_targets = targets[record.id]
+            yield from batch
+
+
+class TransactionRecordQuerySet(QuerySet):
+    def with_targets(self):
+        """
+        Looks up the records' targets in batches as they're loaded, so that showing each one's target_string doesn't
+        take queries per record.
+        """
+        clone = self._chain()
+        clone._iterable_class = TargetsResolvingIterable
+        return clone
+
+
 class TransactionRecord(Model):
     """
     Model for tracking the movement of money.
@@ -1054,6 +1085,10 @@ class TransactionRecord(Model):
     response_message = TextField(default='', blank=True)
     note = TextField(default='', blank=True)
 
+    objects = TransactionRecordQuerySet.as_manager()
+    # Filled in by TransactionRecordQuerySet.with_targets.
+    resolved_targets = None
+
     def __str__(self):
         return (
             f'{self.get_status_display()} [{self.get_category_display()}]: {self.amount} from '
@@ -1072,10 +1107,13 @@ class TransactionRecord(Model):
 
     @property
     def target_string(self):
-        count = self.targets.all().count()
+        targets = self.resolved_targets
+        if targets is None:
+            targets = record_targets([self])[self.id]
+        count = len(targets)
         if not count:
             return 'None'
-        base_string = str(self.targets.all().first().target)
+        base_string = str(targets[0])
         if count == 1:
             return base_string
         count -= 1
@@ -1092,6 +1130,73 @@ class TransactionRecord(Model):
         return super().save(*args, **kwargs)
 
 
+class AccountBalance(Model):
+    """
+    Running total of the TransactionRecords crediting and debiting an account, per user, currency and status. A null
+    user is Artconomy. Maintained by database triggers on the TransactionRecord table, so it changes in the same
+    transaction as the records do, however they're written. Check it against the ledger with the
+    verify_account_balances command.
+
+    Each user has one row per balance, so writers only wait on others changing the same user's balances. A record's
+    rows are updated in order of user ID, so two records between the same users can't deadlock each other. Rows which
+    reach zero are deleted. Artconomy's balances change with nearly every record, so changes to them are appended as
+    rows of their own instead, and folded together by the fold_account_balances task. Always sum the rows for a
+    balance rather than reading one.
+    """
+    user = ForeignKey(User, null=True, blank=True, related_name='account_balances', on_delete=PROTECT)
+    account = IntegerField(choices=TransactionRecord.ACCOUNT_TYPES)
+    currency = CharField(max_length=3)
+    status = IntegerField(choices=TransactionRecord.TRANSACTION_STATUSES)
+    amount = DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'account', 'currency', 'status'], condition=Q(user__isnull=False),
+                name='sales_accountbalance_user',
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=['account', 'currency', 'status'], condition=Q(user__isnull=True),
+                name='sales_accountbalance_deltas',
+            ),
+        ]
+
+
+class AccountBalanceSnapshot(Model):
+    """
+    An account's balance as it stood at taken_at, per user, currency and status. Records count as pending until their
+    finalized_on date, so a snapshot stays correct as later records settle. Written by the take_ledger_snapshot task,
+    so that balances as of a past time only need to sum the records since the snapshot before it.
+    """
+    taken_at = DateTimeField(db_index=True)
+    user = ForeignKey(User, null=True, blank=True, related_name='+', on_delete=PROTECT)
+    account = IntegerField(choices=TransactionRecord.ACCOUNT_TYPES)
+    currency = CharField(max_length=3)
+    status = IntegerField(choices=TransactionRecord.TRANSACTION_STATUSES)
+    amount = DecimalField(max_digits=14, decimal_places=2)
+
+
+class TransactionTarget(Model):
+    """
+    Denormalized copy of TransactionRecord.targets, holding each target's content type and object ID alongside the
+    record, so that records can be found by target and targets by record without joining through GenericReference.
+    Filled from the existing targets by its migration, and maintained by database triggers on the targets table since.
+    Resolve many records' targets at once with record_targets.
+    """
+    record = ForeignKey(TransactionRecord, related_name='target_links', on_delete=CASCADE)
+    content_type = ForeignKey(ContentType, related_name='+', on_delete=CASCADE)
+    object_id = UUIDField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_type', 'object_id', 'record'], name='sales_transactiontarget_target',
+            ),
+        ]
+
+
 DRAFT = 0
 OPEN = 1
 PAID = 2
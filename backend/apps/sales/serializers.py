@@ -1,13 +1,13 @@
 from decimal import Decimal
 from functools import lru_cache
 from itertools import chain
-from typing import List
+from typing import List, Dict, Tuple
 from urllib.parse import urlparse
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import RegexValidator, EmailValidator, MinValueValidator
-from django.db.models import Sum, QuerySet, Q
+from django.db.models import Sum, QuerySet, Q, Model
 from django.urls import reverse
 from django.utils.datetime_safe import datetime, date
 from luhn import verify
@@ -16,7 +16,6 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.fields import SerializerMethodField, DecimalField, IntegerField, FloatField, EmailField, ModelField, \
     ListField
-from short_stuff import unslugify
 from short_stuff.django.serializers import ShortCodeField
 
 from apps.lib.abstract_models import GENERAL, EXTREME, RATINGS
@@ -40,7 +39,7 @@ from apps.sales.models import (
 )
 from apps.sales.stripe import stripe
 from apps.sales.utils import account_balance, PENDING, POSTED_ONLY, AVAILABLE, get_totals, order_context, \
-    order_context_to_link
+    order_context_to_link, account_balances, record_targets, targeting
 from shortcuts import make_url
 
 
@@ -527,6 +526,7 @@ class OrderPreviewSerializer(ProductNameMixin, serializers.ModelSerializer):
 
 @register_serializer
 class CardSerializer(serializers.ModelSerializer):
+    viewer_independent = True
     user = RelatedUserSerializer(read_only=True)
     primary = SerializerMethodField('is_primary')
     processor = SerializerMethodField()
@@ -672,24 +672,55 @@ class RevisionSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'deliverable', 'owner', 'read')
 
 
+class AccountBalancesListSerializer(serializers.ListSerializer):
+    """
+    Fetches the balances for every user in the list in one query, rather than a few for each user.
+    """
+    def to_representation(self, data):
+        users = list(data)
+        balances = account_balances(users, list(self.child.balance_accounts.values()))
+        self.child.balances = {user.id: balances[user.id] for user in users}
+        return super().to_representation(users)
+
+
+class AccountBalancesMixin:
+    """
+    For user serializers which report account balances. balance_accounts maps field names to (account type, balance
+    type) pairs.
+    """
+    balance_accounts: Dict[str, Tuple[int, int]] = {}
+    balances = None
+
+    def balance(self, obj: User, name: str) -> str:
+        if self.balances is None or obj.id not in self.balances:
+            self.balances = {obj.id: account_balances([obj], list(self.balance_accounts.values()))[obj.id]}
+        return str(self.balances[obj.id][self.balance_accounts[name]])
+
+
 # noinspection PyMethodMayBeStatic
-class AccountBalanceSerializer(serializers.ModelSerializer):
+class AccountBalanceSerializer(AccountBalancesMixin, serializers.ModelSerializer):
     escrow = serializers.SerializerMethodField()
     available = serializers.SerializerMethodField()
     pending = serializers.SerializerMethodField()
+    balance_accounts = {
+        'escrow': (TransactionRecord.ESCROW, AVAILABLE),
+        'available': (TransactionRecord.HOLDINGS, AVAILABLE),
+        'pending': (TransactionRecord.BANK, PENDING),
+    }
 
     def get_escrow(self, obj):
-        return str(account_balance(obj, TransactionRecord.ESCROW))
+        return self.balance(obj, 'escrow')
 
     def get_available(self, obj):
-        return str(account_balance(obj, TransactionRecord.HOLDINGS))
+        return self.balance(obj, 'available')
 
     def get_pending(self, obj):
-        return str(account_balance(obj, TransactionRecord.BANK, PENDING))
+        return self.balance(obj, 'pending')
 
     class Meta:
         model = User
         fields = ('escrow', 'available', 'pending')
+        list_serializer_class = AccountBalancesListSerializer
 
 
 class BankAccountSerializer(serializers.ModelSerializer):
@@ -818,19 +849,24 @@ class NewInvoiceSerializer(serializers.Serializer, PriceValidationMixin, Product
         return user
 
 
-class HoldingsSummarySerializer(serializers.ModelSerializer):
+class HoldingsSummarySerializer(AccountBalancesMixin, serializers.ModelSerializer):
     escrow = serializers.SerializerMethodField()
     holdings = serializers.SerializerMethodField()
+    balance_accounts = {
+        'escrow': (TransactionRecord.ESCROW, AVAILABLE),
+        'holdings': (TransactionRecord.HOLDINGS, POSTED_ONLY),
+    }
 
     def get_escrow(self, obj):
-        return str(account_balance(obj, TransactionRecord.ESCROW))
+        return self.balance(obj, 'escrow')
 
     def get_holdings(self, obj):
-        return str(account_balance(obj, TransactionRecord.HOLDINGS, POSTED_ONLY))
+        return self.balance(obj, 'holdings')
 
     class Meta:
         model = User
         fields = ('id', 'username', 'escrow', 'holdings')
+        list_serializer_class = AccountBalancesListSerializer
 
 
 class ProductSampleSerializer(serializers.ModelSerializer):
@@ -1018,17 +1054,12 @@ class DeliverableValuesSerializer(serializers.ModelSerializer):
         fee = TransactionRecord.objects.filter(
             payer=None, payee=None, status=TransactionRecord.SUCCESS,
             source=TransactionRecord.UNPROCESSED_EARNINGS, destination=TransactionRecord.ACH_TRANSACTION_FEES,
-            targets__content_type=ContentType.objects.get_for_model(transaction),
-            targets__object_id=unslugify(transaction.id),
+            **targeting(transaction),
         ).first()
         if not fee:
             # Something's wrong here. Will need to find out why this transaction was not annotated.
             return
-        deliverables = []
-        deliverable_type = ContentType.objects.get_for_model(Deliverable)
-        for target in transaction.targets.all():
-            if target.content_type == deliverable_type:
-                deliverables.append(target.target)
+        deliverables = record_targets([transaction], [Deliverable])[transaction.id]
         lines = {}
         for order in deliverables:
             lines[order] = LineItemSim(
@@ -1073,7 +1104,30 @@ class DeliverableValuesSerializer(serializers.ModelSerializer):
         )
 
 
-class PayoutTransactionSerializer(serializers.ModelSerializer):
+class RecordTargetsListSerializer(serializers.ListSerializer):
+    """
+    Resolves the targets of every record in the list at once, rather than a few queries for each record.
+    """
+    def to_representation(self, data):
+        records = list(data)
+        targets = record_targets([record for record in records if record.resolved_targets is None])
+        for record in records:
+            if record.resolved_targets is None:
+                record.resolved_targets = targets[record.id]
+        return super().to_representation(records)
+
+
+class RecordTargetsMixin:
+    """
+    For TransactionRecord serializers which list the records' targets.
+    """
+    def record_targets(self, obj: TransactionRecord) -> List[Model]:
+        if obj.resolved_targets is None:
+            return record_targets([obj])[obj.id]
+        return obj.resolved_targets
+
+
+class PayoutTransactionSerializer(RecordTargetsMixin, serializers.ModelSerializer):
     id = ShortCodeField()
     payee = serializers.StringRelatedField(read_only=True)
     status = serializers.SerializerMethodField()
@@ -1096,7 +1150,7 @@ class PayoutTransactionSerializer(serializers.ModelSerializer):
     def get_fees(self, obj):
         return (
                 TransactionRecord.objects.filter(
-                    targets=ref_for_instance(obj),
+                    **targeting(obj),
                     source=TransactionRecord.UNPROCESSED_EARNINGS,
                     status=TransactionRecord.SUCCESS,
                     destination=TransactionRecord.ACH_TRANSACTION_FEES).aggregate(total=Sum('amount'))['total']
@@ -1104,14 +1158,11 @@ class PayoutTransactionSerializer(serializers.ModelSerializer):
         )
 
     def get_targets(self, obj: TransactionRecord):
-        targets = obj.targets.order_by('content_type_id').all()
         items: List[str] = []
-        for target in targets:
-            if not target:
-                continue
-            base = f'{target.target.__class__.__name__} #{target.target.id}'
-            if target.content_type.model_class == TransactionRecord:
-                base += f' ({target.target.amount.amount})'
+        for target in self.record_targets(obj):
+            base = f'{target.__class__.__name__} #{target.id}'
+            if isinstance(target, TransactionRecord):
+                base += f' ({target.amount.amount})'
             items.append(base)
         return ', '.join(items)
 
@@ -1125,9 +1176,10 @@ class PayoutTransactionSerializer(serializers.ModelSerializer):
             'created_on', 'finalized_on', 'targets',
         )
         read_only_fields = fields
+        list_serializer_class = RecordTargetsListSerializer
 
 
-class UserPayoutTransactionSerializer(serializers.ModelSerializer):
+class UserPayoutTransactionSerializer(RecordTargetsMixin, serializers.ModelSerializer):
     id = ShortCodeField()
     amount = serializers.SerializerMethodField()
     currency = serializers.SerializerMethodField()
@@ -1151,21 +1203,15 @@ class UserPayoutTransactionSerializer(serializers.ModelSerializer):
         return ', '.join(obj.remote_ids)
 
     def get_targets(self, obj: TransactionRecord):
-        targets = obj.targets.order_by('content_type_id').all()
         items: List[str] = []
-        for target in targets:
-            if not target.target:
-                continue
-            model_class = target.content_type.model_class()
-            if model_class == StripeAccount:
+        for target in self.record_targets(obj):
+            if isinstance(target, (StripeAccount, BankAccount)):
                 continue
-            if model_class == BankAccount:
-                continue
-            base = f'{target.target.__class__.__name__} #{target.target.id}'
-            if model_class == Deliverable:
-                base = target.target.notification_name(self.context)
-            if target.content_type.model_class() == TransactionRecord:
-                base += f' ({target.target.amount.amount})'
+            base = f'{target.__class__.__name__} #{target.id}'
+            if isinstance(target, Deliverable):
+                base = target.notification_name(self.context)
+            if isinstance(target, TransactionRecord):
+                base += f' ({target.amount.amount})'
             items.append(base)
         return ', '.join(items)
 
@@ -1176,6 +1222,7 @@ class UserPayoutTransactionSerializer(serializers.ModelSerializer):
             'created_on', 'finalized_on', 'targets',
         )
         read_only_fields = fields
+        list_serializer_class = RecordTargetsListSerializer
 
 
 def pin_link(url):
@@ -1392,6 +1439,8 @@ class PremiumIntentSettings(serializers.Serializer):
 
 @register_serializer
 class StripeAccountSerializer(serializers.ModelSerializer):
+    viewer_independent = True
+
     class Meta:
         model = StripeAccount
         fields = ('id', 'active', 'country')
@@ -1420,6 +1469,7 @@ class StripeBankSetupSerializer(serializers.Serializer):
 
 @register_serializer
 class InvoiceSerializer(serializers.ModelSerializer):
+    viewer_independent = True
     id = ShortCodeField()
     bill_to = RelatedUserSerializer()
     total = serializers.SerializerMethodField()
@@ -7,9 +7,9 @@ from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.datetime_safe import date, datetime
 from moneyed import Money
@@ -17,7 +17,7 @@ from pytz import UTC
 from urllib3.exceptions import HTTPError
 
 from apps.lib.models import RENEWAL_FAILURE, SUBSCRIPTION_DEACTIVATED, RENEWAL_FIXED, TRANSFER_FAILED, ref_for_instance
-from apps.lib.utils import notify, send_transaction_email, require_lock
+from apps.lib.utils import notify, send_transaction_email
 from apps.profiles.models import User
 from apps.sales.apis import dwolla
 from apps.sales.dwolla import TRANSACTION_STATUS_MAP
@@ -25,7 +25,7 @@ from apps.sales.models import CreditCardToken, TransactionRecord, REVIEW, NEW, D
     PREMIUM_SUBSCRIPTION, COMPLETED, StripeAccount, ServicePlan
 from apps.sales.stripe import stripe, money_to_stripe
 from apps.sales.utils import finalize_deliverable, account_balance, destroy_deliverable, \
-    get_term_invoice, fetch_prefixed, divide_amount
+    get_term_invoice, fetch_prefixed, divide_amount, snapshot_ledger, AccountMutex, targeting, compact_account_balances
 from conf.celery_config import celery_app
 
 
@@ -164,7 +164,7 @@ def update_transfer_status(record_id):
             new_record.targets.add(*record.targets.all())
             TransactionRecord.objects.filter(
                 targets=ref_for_instance(record), category=TransactionRecord.THIRD_PARTY_FEE,
-            ).update(status=TransactionRecord.SUCCESS)
+            ).update(status=TransactionRecord.SUCCESS, finalized_on=Coalesce(F('finalized_on'), timezone.now()))
         if status.body['status'] in ['cancelled', 'failed']:
             record.status = TransactionRecord.FAILURE
             record.save()
@@ -178,7 +178,7 @@ def update_transfer_status(record_id):
             )
             TransactionRecord.objects.filter(
                 targets=ref_for_instance(record), category=TransactionRecord.THIRD_PARTY_FEE,
-            ).update(status=TransactionRecord.FAILURE)
+            ).update(status=TransactionRecord.FAILURE, finalized_on=Coalesce(F('finalized_on'), timezone.now()))
             deliverable_ids = record.targets.filter(
                 content_type=ContentType.objects.get_for_model(Deliverable),
             ).values_list('object_id', flat=True)
@@ -209,55 +209,55 @@ def auto_finalize_run():
 RecordMap = Dict[Union[Deliverable, None], TransactionRecord]
 
 
-@require_lock(TransactionRecord, 'ACCESS EXCLUSIVE')
 def record_to_deliverable_map(user, bank: StripeAccount, amount: Money) -> RecordMap:
-    deliverables = Deliverable.objects.select_for_update(skip_locked=True).filter(
-        order__seller=user,
-        payout_sent=False,
-        escrow_disabled=False,
-        status=COMPLETED,
-    )
-    record_map: RecordMap = {}
-    bank_ref = ref_for_instance(bank)
-    for deliverable in deliverables:
-        target = ref_for_instance(deliverable)
-        records = TransactionRecord.objects.filter(
-            targets=target,
-            payee=user,
-            destination=TransactionRecord.HOLDINGS,
-            status=TransactionRecord.SUCCESS,
+    # Takes the same lock as withdraw_all, for callers that haven't already.
+    with AccountMutex([(user, TransactionRecord.HOLDINGS)]):
+        deliverables = Deliverable.objects.select_for_update(skip_locked=True).filter(
+            order__seller=user,
+            payout_sent=False,
+            escrow_disabled=False,
+            status=COMPLETED,
         )
-        sub_amount = sum(sub_record.amount for sub_record in records)
-        amount -= sub_amount
-        assert amount >= Money('0', amount.currency.code)
+        record_map: RecordMap = {}
+        bank_ref = ref_for_instance(bank)
+        for deliverable in deliverables:
+            records = TransactionRecord.objects.filter(
+                **targeting(deliverable),
+                payee=user,
+                destination=TransactionRecord.HOLDINGS,
+                status=TransactionRecord.SUCCESS,
+            )
+            sub_amount = sum(sub_record.amount for sub_record in records)
+            amount -= sub_amount
+            assert amount >= Money('0', amount.currency.code)
+            record = TransactionRecord.objects.create(
+                amount=sub_amount,
+                source=TransactionRecord.HOLDINGS,
+                payee=user,
+                payer=user,
+                category=TransactionRecord.CASH_WITHDRAW,
+                destination=TransactionRecord.BANK,
+                status=TransactionRecord.PENDING,
+                response_message='Failed to connect to server',
+            )
+            for sub_record in records:
+                record.targets.add(*sub_record.targets.all())
+            record.targets.add(bank_ref)
+            record_map[deliverable] = record
+        if not amount:
+            return record_map
         record = TransactionRecord.objects.create(
-            amount=sub_amount,
+            amount=amount,
             source=TransactionRecord.HOLDINGS,
             payee=user,
             payer=user,
             category=TransactionRecord.CASH_WITHDRAW,
             destination=TransactionRecord.BANK,
             status=TransactionRecord.PENDING,
-            response_message='Failed to connect to server',
+            note='Remaining amount, not connected to deliverables. May need annotations later.'
         )
-        for sub_record in records:
-            record.targets.add(*sub_record.targets.all())
-        record.targets.add(bank_ref)
-        record_map[deliverable] = record
-    if not amount:
+        record_map[None] = record
         return record_map
-    record = TransactionRecord.objects.create(
-        amount=amount,
-        source=TransactionRecord.HOLDINGS,
-        payee=user,
-        payer=user,
-        category=TransactionRecord.CASH_WITHDRAW,
-        destination=TransactionRecord.BANK,
-        status=TransactionRecord.PENDING,
-        note='Remaining amount, not connected to deliverables. May need annotations later.'
-    )
-    record_map[None] = record
-    return record_map
 
 
 @celery_app.task
@@ -312,17 +312,18 @@ def withdraw_all(user_id):
     if not hasattr(user, 'stripe_account'):
         return
     banks = [user.stripe_account]
-    with cache.lock(f'account_user__{user.id}'):
+    # The balance has to be read under the same lock the withdrawal records are written under, or two runs could
+    # both withdraw it.
+    with AccountMutex([(user, TransactionRecord.HOLDINGS)]):
         balance = account_balance(user, TransactionRecord.HOLDINGS)
         if balance <= 0:
             return
-        with transaction.atomic():
-            record_map = record_to_deliverable_map(user, banks[0], Money(balance, 'USD'))
-            for deliverable, record in record_map.items():
-                if deliverable:
-                    deliverable.payout_sent = True
-                    deliverable.save()
-                stripe_transfer.delay(record.id, banks[0].id, deliverable and deliverable.id)
+        record_map = record_to_deliverable_map(user, banks[0], Money(balance, 'USD'))
+        for deliverable, record in record_map.items():
+            if deliverable:
+                deliverable.payout_sent = True
+                deliverable.save()
+            stripe_transfer.delay(record.id, banks[0].id, deliverable and deliverable.id)
 
 
 @celery_app.task
@@ -404,7 +405,7 @@ def annotate_connect_fees_for_year_month(*, year: int, month: int) -> None:
     target_transactions = list(TransactionRecord.objects.filter(
         finalized_on__gte=start_datetime, finalized_on__lt=end_datetime, status=TransactionRecord.SUCCESS,
         source=TransactionRecord.HOLDINGS, destination=TransactionRecord.BANK,
-        targets__content_type=ContentType.objects.get_for_model(StripeAccount)
+        target_links__content_type=ContentType.objects.get_for_model(StripeAccount)
     ).distinct().order_by('finalized_on'))
     if not len(target_transactions):
         return
@@ -425,7 +426,7 @@ def annotate_connect_fees_for_year_month(*, year: int, month: int) -> None:
             source=TransactionRecord.UNPROCESSED_EARNINGS,
             destination=TransactionRecord.ACH_TRANSACTION_FEES,
             category=TransactionRecord.THIRD_PARTY_FEE,
-            targets=ref_for_instance(record),
+            **targeting(record),
         ).first()
         if not fee_record:
             fee_record = TransactionRecord(
@@ -442,7 +443,7 @@ def annotate_connect_fees_for_year_month(*, year: int, month: int) -> None:
         user_fees_map[record.payer].append(fee_record)
         fee_record.targets.add(*record.targets.all())
         cross_border = TransactionRecord.objects.filter(
-            targets=ref_for_instance(record),
+            **targeting(record),
             source=TransactionRecord.PAYOUT_MIRROR_SOURCE,
             destination=TransactionRecord.PAYOUT_MIRROR_DESTINATION,
         ).exclude(amount_currency='USD').exists()
@@ -497,3 +498,20 @@ def clear_cancelled_deliverables():
     to_destroy = Deliverable.objects.filter(status=CANCELLED, cancelled_on__lte=timezone.now() - relativedelta(weeks=2))
     for deliverable in to_destroy:
         clear_deliverable(deliverable.id)
+
+
+@celery_app.task
+def take_ledger_snapshot():
+    """
+    Snapshots account balances as they stood at the start of today, so that historical balance queries only need to
+    sum the records since.
+    """
+    snapshot_ledger()
+
+
+@celery_app.task
+def fold_account_balances():
+    """
+    Folds together the rows recording changes to Artconomy's balances, so reading them stays cheap.
+    """
+    compact_account_balances()
@@ -21,6 +21,7 @@ from apps.sales.tasks import run_billing, update_transfer_status, remind_sales,
     clear_deliverable, annotate_connect_fees_for_year_month, annotate_connect_fees
 from apps.sales.tests.factories import TransactionRecordFactory, DeliverableFactory, \
     StripeAccountFactory, ServicePlanFactory
+from apps.sales.utils import account_balance, PENDING
 
 
 class TestAutoRenewal(TestCase):
@@ -92,6 +93,26 @@ class TestUpdateTransaction(TestCase):
         self.deliverable.refresh_from_db()
         self.assertFalse(self.deliverable.payout_sent)
 
+    def test_check_transaction_status_failed_fees(self, mock_api):
+        fee = TransactionRecordFactory.create(
+            payer=self.record.payer,
+            payee=None,
+            status=TransactionRecord.PENDING,
+            category=TransactionRecord.THIRD_PARTY_FEE,
+            source=TransactionRecord.HOLDINGS,
+            destination=TransactionRecord.ACH_MISC_FEES,
+        )
+        fee.targets.add(ref_for_instance(self.record))
+        mock_api.return_value.get.return_value.body = {'status': 'failed'}
+        update_transfer_status(self.record.id)
+        fee.refresh_from_db()
+        self.assertEqual(fee.status, TransactionRecord.FAILURE)
+        self.assertTrue(fee.finalized_on)
+        # Records only count as settled in past balances once they have a finalized_on date.
+        self.assertEqual(
+            account_balance(fee.payer, TransactionRecord.HOLDINGS, PENDING, as_of=timezone.now()), Decimal('0.00'),
+        )
+
     def test_check_transaction_status_processed(self, mock_api):
         mock_api.return_value.get.return_value.body = {'status': 'processed'}
         update_transfer_status(self.record.id)
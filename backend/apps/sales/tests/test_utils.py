@@ -1,26 +1,32 @@
 import uuid
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal
 from unittest.mock import patch
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.db.models import Sum
 from django.test import TestCase
 from freezegun import freeze_time
 from moneyed import Money
+from pytz import UTC
 
-from apps.lib.models import Notification, ORDER_UPDATE, Subscription, COMMISSIONS_OPEN
+from apps.lib.models import Notification, ORDER_UPDATE, Subscription, COMMISSIONS_OPEN, ref_for_instance
 from apps.lib.test_resources import SignalsDisabledMixin
 from apps.lib.tests.test_utils import EnsurePlansMixin
+from apps.lib.utils import notify, unread_counts
 from apps.profiles.models import User
 from apps.profiles.tests.factories import UserFactory
-from apps.sales.models import TransactionRecord, LineItemSim, CANCELLED, IN_PROGRESS, SHIELD
+from apps.sales.models import TransactionRecord, LineItemSim, CANCELLED, IN_PROGRESS, SHIELD, AccountBalance, \
+    AccountBalanceSnapshot, TransactionTarget, Deliverable, buyer_subscriptions
+from apps.sales.serializers import HoldingsSummarySerializer
 from apps.sales.tests.factories import TransactionRecordFactory, OrderFactory, ProductFactory, DeliverableFactory, \
     RevisionFactory, ReferenceFactory, InvoiceFactory, LineItemFactory
 from apps.sales.utils import claim_order_by_token, \
     check_charge_required, available_products, set_premium, account_balance, POSTED_ONLY, PENDING, lines_by_priority, \
-    get_totals, reckon_lines, destroy_deliverable, divide_amount, freeze_line_items
+    get_totals, reckon_lines, destroy_deliverable, divide_amount, freeze_line_items, account_balance_drift, \
+    rebuild_account_balances, account_balances, AVAILABLE, snapshot_ledger, AccountMutex, lock_wait_histogram, \
+    record_targets, targeting, backfill_transaction_targets, compact_account_balances
 
 
 class BalanceTestCase(SignalsDisabledMixin, TestCase):
@@ -91,6 +97,188 @@ class BalanceTestCase(SignalsDisabledMixin, TestCase):
         self.assertEqual(account_balance(None, TransactionRecord.ACH_MISC_FEES, PENDING), Decimal('0.00'))
         self.assertEqual(account_balance(self.user1, TransactionRecord.ACH_MISC_FEES, PENDING), Decimal('3.00'))
 
+    def test_account_balance_follows_ledger(self):
+        TransactionRecord.objects.filter(status=TransactionRecord.PENDING).update(status=TransactionRecord.SUCCESS)
+        self.assertEqual(account_balance(self.user2, TransactionRecord.ESCROW, POSTED_ONLY), Decimal('11.50'))
+        self.assertEqual(account_balance(self.user2, TransactionRecord.ESCROW, PENDING), Decimal('0.00'))
+        TransactionRecord.objects.filter(payee=None).delete()
+        self.assertEqual(account_balance(None, TransactionRecord.ACH_MISC_FEES), Decimal('0.00'))
+        self.assertEqual(account_balance(self.user2, TransactionRecord.ESCROW), Decimal('12.00'))
+        self.assertEqual(account_balance_drift(), [])
+
+    def test_zero_balances_removed(self):
+        user = UserFactory.create()
+        record = TransactionRecordFactory.create(
+            card=None,
+            payer=user,
+            payee=self.user2,
+            source=TransactionRecord.CARD,
+            destination=TransactionRecord.ESCROW,
+            amount=Money('2.00', 'USD'),
+        )
+        self.assertTrue(AccountBalance.objects.filter(user=user).exists())
+        record.delete()
+        self.assertFalse(AccountBalance.objects.filter(user=user).exists())
+        self.assertEqual(account_balance_drift(), [])
+
+    def test_account_balances(self):
+        user3 = UserFactory.create()
+        escrow, reserve = (TransactionRecord.ESCROW, AVAILABLE), (TransactionRecord.RESERVE, POSTED_ONLY)
+        with self.assertNumQueries(1):
+            balances = account_balances(User.objects.filter(id__in=[self.user1.id, self.user2.id]), [escrow, reserve])
+        self.assertEqual(balances[self.user2.id], {escrow: Decimal('11.50'), reserve: Decimal('0.00')})
+        self.assertEqual(balances[self.user1.id], {escrow: Decimal('0.00'), reserve: Decimal('-5.00')})
+        self.assertEqual(balances[user3.id], {escrow: Decimal('0.00'), reserve: Decimal('0.00')})
+
+    def test_holdings_summary_serializer(self):
+        users = User.objects.filter(id__in=[self.user1.id, self.user2.id]).order_by('username')
+        with self.assertNumQueries(2):
+            data = HoldingsSummarySerializer(instance=users, many=True).data
+        self.assertEqual(
+            [(row['username'], row['escrow'], row['holdings']) for row in data],
+            [('Cat', '11.50', '0.00'), ('Fox', '0.00', '0.00')],
+        )
+
+    def test_account_balance_drift(self):
+        AccountBalance.objects.filter(user=self.user2, account=TransactionRecord.ESCROW).update(amount=Decimal('1.00'))
+        self.assertTrue(account_balance_drift())
+        rebuild_account_balances()
+        self.assertEqual(account_balance_drift(), [])
+        self.assertEqual(account_balance(self.user2, TransactionRecord.ESCROW), Decimal('11.50'))
+
+    def test_compact_account_balances(self):
+        TransactionRecordFactory.create(
+            card=None,
+            payer=self.user2,
+            payee=None,
+            source=TransactionRecord.ESCROW,
+            destination=TransactionRecord.ACH_MISC_FEES,
+            amount=Money('0.25', 'USD'),
+            status=TransactionRecord.SUCCESS,
+        )
+        fees = AccountBalance.objects.filter(
+            user__isnull=True, account=TransactionRecord.ACH_MISC_FEES, status=TransactionRecord.SUCCESS,
+        )
+        self.assertEqual(fees.count(), 2)
+        self.assertEqual(account_balance(None, TransactionRecord.ACH_MISC_FEES), Decimal('0.75'))
+        compact_account_balances()
+        self.assertEqual(fees.count(), 1)
+        self.assertEqual(fees.get().amount, Decimal('0.75'))
+        self.assertEqual(account_balance(None, TransactionRecord.ACH_MISC_FEES), Decimal('0.75'))
+        self.assertEqual(account_balance_drift(), [])
+
+
+class TestBalanceSnapshots(SignalsDisabledMixin, TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        for amount, created_on, finalized_on in [
+            ('10.00', datetime(2022, 1, 5, tzinfo=UTC), datetime(2022, 1, 5, tzinfo=UTC)),
+            # Still pending when the snapshot is taken.
+            ('5.00', datetime(2022, 1, 20, tzinfo=UTC), datetime(2022, 2, 10, tzinfo=UTC)),
+            ('3.00', datetime(2022, 2, 15, tzinfo=UTC), datetime(2022, 2, 15, tzinfo=UTC)),
+        ]:
+            TransactionRecordFactory.create(
+                payer=None, payee=self.user, amount=Money(amount, 'USD'), created_on=created_on,
+                finalized_on=finalized_on,
+            )
+        snapshot_ledger(datetime(2022, 2, 1, tzinfo=UTC))
+
+    def balances(self, as_of):
+        return (
+            account_balance(self.user, TransactionRecord.ESCROW, POSTED_ONLY, as_of=as_of),
+            account_balance(self.user, TransactionRecord.ESCROW, PENDING, as_of=as_of),
+        )
+
+    def test_snapshot(self):
+        snapshots = AccountBalanceSnapshot.objects.filter(user=self.user, account=TransactionRecord.ESCROW)
+        self.assertEqual(
+            {(snapshot.status, snapshot.amount) for snapshot in snapshots},
+            {(TransactionRecord.SUCCESS, Decimal('10.00')), (TransactionRecord.PENDING, Decimal('5.00'))},
+        )
+
+    def test_account_balance_as_of(self):
+        self.assertEqual(self.balances(datetime(2022, 1, 10, tzinfo=UTC)), (Decimal('10.00'), Decimal('0.00')))
+        self.assertEqual(self.balances(datetime(2022, 2, 1, tzinfo=UTC)), (Decimal('10.00'), Decimal('5.00')))
+        self.assertEqual(self.balances(datetime(2022, 2, 12, tzinfo=UTC)), (Decimal('15.00'), Decimal('0.00')))
+        self.assertEqual(self.balances(datetime(2022, 3, 1, tzinfo=UTC)), (Decimal('18.00'), Decimal('0.00')))
+        self.assertEqual(
+            account_balance(None, TransactionRecord.CARD, as_of=datetime(2022, 3, 1, tzinfo=UTC)), Decimal('-18.00'),
+        )
+
+    def test_account_balances_as_of(self):
+        key = (TransactionRecord.ESCROW, AVAILABLE)
+        balances = account_balances([self.user], [key], as_of=datetime(2022, 2, 12, tzinfo=UTC))
+        self.assertEqual(balances[self.user.id][key], Decimal('15.00'))
+
+
+class TestAccountMutex(TestCase):
+    def held_locks(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT classid, objid FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid() "
+                "ORDER BY classid, objid",
+            )
+            return cursor.fetchall()
+
+    def test_locks_accounts(self):
+        user = UserFactory.create()
+        before = sum(lock_wait_histogram().values())
+        with AccountMutex([(user, TransactionRecord.HOLDINGS), (None, TransactionRecord.CARD)]):
+            self.assertEqual(
+                self.held_locks(), [(TransactionRecord.CARD, 0), (TransactionRecord.HOLDINGS, user.id)],
+            )
+        self.assertEqual(sum(lock_wait_histogram().values()), before + 1)
+
+    @patch('apps.sales.utils.perf_counter')
+    def test_logs_slow_waits(self, mock_perf_counter):
+        user = UserFactory.create()
+        mock_perf_counter.side_effect = [0, 5]
+        with self.assertLogs('apps.sales.utils', level='WARNING') as logs:
+            with AccountMutex([(user, TransactionRecord.HOLDINGS)]):
+                pass
+        self.assertIn('Waited 5.00s to lock accounts', logs.output[0])
+
+
+class TestRecordTargets(TestCase):
+    def setUp(self):
+        self.deliverable = DeliverableFactory.create()
+        self.record = TransactionRecordFactory.create()
+        self.other_record = TransactionRecordFactory.create()
+        self.record.targets.add(ref_for_instance(self.deliverable), ref_for_instance(self.deliverable.invoice))
+        self.other_record.targets.add(ref_for_instance(self.record))
+
+    def test_record_targets(self):
+        targets = record_targets([self.record, self.other_record])
+        self.assertCountEqual(targets[self.record.id], [self.deliverable, self.deliverable.invoice])
+        self.assertEqual(targets[self.other_record.id], [self.record])
+
+    def test_record_targets_models(self):
+        targets = record_targets([self.record, self.other_record], [Deliverable])
+        self.assertEqual(targets[self.record.id], [self.deliverable])
+        self.assertEqual(targets[self.other_record.id], [])
+
+    def test_with_targets(self):
+        records = {record.id: record for record in TransactionRecord.objects.with_targets()}
+        self.assertCountEqual(records[self.record.id].resolved_targets, [self.deliverable, self.deliverable.invoice])
+        self.assertEqual(records[self.other_record.id].resolved_targets, [self.record])
+        with patch('apps.sales.models.record_targets') as mock_record_targets:
+            self.assertTrue(records[self.record.id].target_string.endswith(' and 1 other(s).'))
+        mock_record_targets.assert_not_called()
+
+    def test_targeting(self):
+        self.assertEqual(list(TransactionRecord.objects.filter(**targeting(self.deliverable))), [self.record])
+        self.record.targets.remove(ref_for_instance(self.deliverable))
+        self.assertFalse(TransactionRecord.objects.filter(**targeting(self.deliverable)).exists())
+
+    def test_backfill(self):
+        TransactionTarget.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT MAX(id) FROM sales_transactionrecord_targets')
+            last_id = cursor.fetchone()[0]
+        self.assertEqual(backfill_transaction_targets(0, last_id), 3)
+        self.assertEqual(backfill_transaction_targets(0, last_id), 0)
+        self.assertEqual(list(TransactionRecord.objects.filter(**targeting(self.record))), [self.other_record])
+
 
 class TestClaim(TestCase):
     def test_order_claim(self):
@@ -143,6 +331,21 @@ class TestClaim(TestCase):
         self.assertEqual(notification.user, user)
         self.assertEqual(notification.event.target, deliverable)
 
+    def test_order_claim_notifications_counted(self):
+        old_buyer = UserFactory.create(guest=True)
+        user = UserFactory.create()
+        deliverable = DeliverableFactory.create(order__buyer=old_buyer)
+        other = DeliverableFactory.create(order__buyer=old_buyer)
+        for target in (deliverable, other):
+            Subscription.objects.bulk_create(buyer_subscriptions(target), ignore_conflicts=True)
+            notify(ORDER_UPDATE, target, unique=True, mark_unread=True)
+        self.assertEqual(unread_counts(old_buyer)['count'], 2)
+        claim_order_by_token(str(deliverable.order.claim_token), user)
+        self.assertEqual(Notification.objects.filter(user=user).count(), 2)
+        self.assertEqual(unread_counts(user)['count'], 2)
+        self.assertFalse(Notification.objects.filter(user=old_buyer).exists())
+        self.assertEqual(unread_counts(old_buyer)['count'], 0)
+
 
 class TestCheckChargeRequired(EnsurePlansMixin, TestCase):
     @freeze_time('2018-02-10 12:00:00')
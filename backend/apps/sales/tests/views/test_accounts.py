@@ -1,3 +1,4 @@
+from collections import defaultdict
 from decimal import Decimal
 from unittest.mock import patch
 
@@ -152,22 +153,22 @@ class TestBankManager(APITestCase):
 
 
 class TestAccountBalance(APITestCase):
-    @patch('apps.sales.serializers.account_balance')
-    def test_account_balance(self, mock_account_balance):
+    @patch('apps.sales.serializers.account_balances')
+    def test_account_balance(self, mock_account_balances):
         user = UserFactory.create()
         self.login(user)
-        mock_account_balance.side_effect = mock_balance
+        mock_account_balances.side_effect = mock_balances
         response = self.client.get('/api/sales/v1/account/{}/balance/'.format(user.username))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['available'], '100.00')
         self.assertEqual(response.data['escrow'], '50.00')
 
-    @patch('apps.sales.serializers.account_balance')
-    def test_account_balance_staff(self, mock_account_balance):
+    @patch('apps.sales.serializers.account_balances')
+    def test_account_balance_staff(self, mock_account_balances):
         user = UserFactory.create()
         staffer = UserFactory.create(is_staff=True)
         self.login(staffer)
-        mock_account_balance.side_effect = mock_balance
+        mock_account_balances.side_effect = mock_balances
         response = self.client.get('/api/sales/v1/account/{}/balance/'.format(user.username))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['available'], '100.00')
@@ -193,3 +194,7 @@ def mock_balance(obj, account_type, status_filter=None):
     if account_type == TransactionRecord.HOLDINGS:
         return Decimal('100.00')
     return Decimal('50.00')
+
+
+def mock_balances(users, accounts):
+    return defaultdict(lambda: {key: mock_balance(None, *key) for key in accounts})
@@ -332,6 +332,46 @@ class TestDeliverableStateChange(SignalsDisabledMixin, APITestCase):
         self.assertEqual(refund_transaction.category, TransactionRecord.ESCROW_REFUND)
         self.assertEqual(refund_transaction.remote_ids, ['pi_1234'])
 
+    @patch('apps.sales.utils.refund_payment_intent')
+    def test_refund_card_failure(self, mock_refund_transaction, _mock_notify):
+        record = TransactionRecordFactory.create(
+            card=CreditCardTokenFactory.create(),
+            payee=self.deliverable.order.seller,
+            payer=self.deliverable.order.buyer,
+            remote_ids=['pi_1234'],
+        )
+        record.targets.add(ref_for_instance(self.deliverable))
+        mock_refund_transaction.side_effect = ValueError('Card declined.')
+        self.state_assertion(
+            'seller', 'refund/', status.HTTP_400_BAD_REQUEST, initial_status=DISPUTED, target_status=DISPUTED,
+        )
+        refund_transaction = TransactionRecord.objects.get(category=TransactionRecord.ESCROW_REFUND)
+        self.assertEqual(refund_transaction.status, TransactionRecord.FAILURE)
+        self.assertEqual(refund_transaction.response_message, 'Card declined.')
+
+    @patch('apps.sales.utils.refund_payment_intent')
+    def test_refund_already_pending(self, mock_refund_transaction, _mock_notify):
+        record = TransactionRecordFactory.create(
+            payee=self.deliverable.order.seller,
+            payer=self.deliverable.order.buyer,
+            remote_ids=['pi_1234'],
+        )
+        record.targets.add(ref_for_instance(self.deliverable))
+        pending = TransactionRecordFactory.create(
+            payee=self.deliverable.order.buyer,
+            payer=self.deliverable.order.seller,
+            source=TransactionRecord.ESCROW,
+            destination=TransactionRecord.CARD,
+            category=TransactionRecord.ESCROW_REFUND,
+            status=TransactionRecord.PENDING,
+        )
+        pending.targets.add(ref_for_instance(self.deliverable))
+        self.state_assertion(
+            'seller', 'refund/', status.HTTP_400_BAD_REQUEST, initial_status=DISPUTED, target_status=DISPUTED,
+        )
+        mock_refund_transaction.assert_not_called()
+        self.assertEqual(TransactionRecord.objects.filter(category=TransactionRecord.ESCROW_REFUND).count(), 1)
+
     def test_refund_card_buyer(self, _mock_notify):
         self.state_assertion('buyer', 'refund/', status.HTTP_403_FORBIDDEN, initial_status=DISPUTED)
 
@@ -5,41 +5,45 @@ If enough code has to be repeated between the two bases it may be worth looking
 """
 import json
 import logging
-from collections import defaultdict
+import sys
+from collections import defaultdict, Counter
 from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN, localcontext, ROUND_FLOOR, ROUND_CEILING
 from functools import reduce
 from itertools import chain
+from time import perf_counter
 from urllib.parse import quote
+from uuid import UUID
 
 from django.utils.module_loading import import_string
 from math import ceil
-from typing import Union, Type, TYPE_CHECKING, List, Dict, Iterator, Callable, Tuple, TypedDict, Optional, Any
+from typing import Union, Type, TYPE_CHECKING, List, Dict, Iterator, Callable, Tuple, TypedDict, Optional, Any, \
+    DefaultDict, Iterable
 
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import IntegrityError, transaction
-from django.db.models import Sum, Q, IntegerField, Case, When, F, Model
+from django.db.models import Sum, Q, IntegerField, Case, When, F, Model, UUIDField
 from django.db.transaction import atomic
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.utils.datetime_safe import date
+from django.utils.datetime_safe import date, datetime
 from moneyed import Money, Currency
 from pandas.tseries.offsets import BDay
 from rest_framework.exceptions import ValidationError
-from short_stuff import gen_shortcode
+from short_stuff import gen_shortcode, unslugify
 
 from apps.lib.models import Subscription, COMMISSIONS_OPEN, Event, DISPUTE, SALE_UPDATE, Notification, \
     Comment, ORDER_UPDATE, COMMENT, ref_for_instance
-from apps.lib.utils import notify, recall_notification
+from apps.lib.utils import notify, recall_notification, adjust_unread_counts
 from apps.profiles.models import User, VERIFIED
 from apps.sales.apis import STRIPE
 from apps.sales.stripe import refund_payment_intent, stripe
 
 if TYPE_CHECKING:
+    from django.db.models import QuerySet
     from apps.sales.models import LineItemSim, LineItem, TransactionRecord, Deliverable, Revision, CreditCardToken, \
     Invoice, ServicePlan, VOID
 
@@ -63,19 +67,89 @@ POSTED_ONLY = 1
 PENDING = 2
 
 
-def account_balance(
-        user: Union[User, None, Type[ALL]], account_type: int, balance_type: int = AVAILABLE, qs_kwargs: dict = None,
-) -> Decimal:
-    qs_kwargs = qs_kwargs or {}
+def balance_statuses(balance_type: int) -> List[int]:
     from apps.sales.models import TransactionRecord
     if balance_type == PENDING:
-        statuses = [TransactionRecord.PENDING]
+        return [TransactionRecord.PENDING]
     elif balance_type == POSTED_ONLY:
-        statuses = [TransactionRecord.SUCCESS]
+        return [TransactionRecord.SUCCESS]
     elif balance_type == AVAILABLE:
-        statuses = [TransactionRecord.SUCCESS, TransactionRecord.PENDING]
-    else:
-        raise TypeError(f'Invalid balance type: {balance_type}')
+        return [TransactionRecord.SUCCESS, TransactionRecord.PENDING]
+    raise TypeError(f'Invalid balance type: {balance_type}')
+
+
+def account_balance(
+        user: Union[User, None, Type[ALL]], account_type: int, balance_type: int = AVAILABLE, qs_kwargs: dict = None,
+        as_of: Optional[datetime] = None,
+) -> Decimal:
+    """
+    Gets the balance of an account, read from the AccountBalance table. If qs_kwargs are given to narrow down the
+    transactions considered, the balance has to be summed from the ledger instead. If as_of is given, the balance is
+    the one which stood at that time, worked out from the ledger snapshot before it.
+    """
+    statuses = balance_statuses(balance_type)
+    if qs_kwargs:
+        if as_of is not None:
+            qs_kwargs = {**qs_kwargs, 'created_on__lte': as_of}
+        return ledger_balance(user, account_type, statuses, qs_kwargs)
+    if as_of is not None:
+        users = user if user is ALL or user is None else [user.id]
+        rows = balances_as_of(as_of, [account_type], statuses, users)
+        return Decimal(sum((amount for _user_id, _account, _status, amount in rows), Decimal('0.00')))
+    from apps.sales.models import AccountBalance
+    balances = AccountBalance.objects.filter(account=account_type, status__in=statuses)
+    if user is not ALL:
+        balances = balances.filter(user=user)
+    total = balances.aggregate(total=Sum('amount'))['total']
+    if total is None:
+        return Decimal('0.00')
+    return Decimal(total)
+
+
+BalanceKey = Tuple[int, int]
+
+
+def account_balances(
+        users: Union['QuerySet', List[User]], accounts: List[BalanceKey], as_of: Optional[datetime] = None,
+) -> DefaultDict[int, Dict[BalanceKey, Decimal]]:
+    """
+    Gets the balances of several accounts for many users at once, in a single grouped query. Accounts are given as
+    (account type, balance type) pairs. Returns a mapping of user IDs to the balance of each pair. Users with nothing
+    in an account, including users who were not asked about, come back with a balance of zero. If as_of is given, the
+    balances are those which stood at that time.
+    """
+    from apps.sales.models import AccountBalance
+    accounts = list(dict.fromkeys(accounts))
+    aggregates = {
+        f'balance_{index}': Sum('amount', filter=Q(account=account_type, status__in=balance_statuses(balance_type)))
+        for index, (account_type, balance_type) in enumerate(accounts)
+    }
+    balances = defaultdict(lambda: {key: Decimal('0.00') for key in accounts})
+    if not accounts:
+        return balances
+    if as_of is not None:
+        user_ids = [user.id for user in users] if isinstance(users, list) else list(users.values_list('id', flat=True))
+        statuses = {status for _account, balance_type in accounts for status in balance_statuses(balance_type)}
+        rows = balances_as_of(as_of, [account_type for account_type, _ in accounts], list(statuses), user_ids)
+        for user_id, account_type, status, amount in rows:
+            for key in accounts:
+                if key[0] == account_type and status in balance_statuses(key[1]):
+                    balances[user_id][key] += amount
+        return balances
+    rows = AccountBalance.objects.filter(
+        user__in=users, account__in={account_type for account_type, _balance_type in accounts},
+    ).values('user_id').annotate(**aggregates).order_by()
+    for row in rows:
+        balances[row['user_id']] = {
+            key: Decimal(row[f'balance_{index}'] or '0.00') for index, key in enumerate(accounts)
+        }
+    return balances
+
+
+def ledger_balance(
+        user: Union[User, None, Type[ALL]], account_type: int, statuses: List[int], qs_kwargs: dict,
+) -> Decimal:
+    from apps.sales.models import TransactionRecord
     kwargs = {
         'status__in': statuses,
         'source': account_type,
@@ -110,6 +184,253 @@ def account_balance(
     return Decimal(credit - debit)
 
 
+# Balances per (user, account, currency, status), summed from the ledger. Mirrors the triggers which maintain the
+# AccountBalance table.
+LEDGER_BALANCES_SQL = """
+    SELECT entries.user_id, entries.account, entries.currency, entries.status, SUM(entries.amount) AS amount
+    FROM (
+        SELECT payer_id AS user_id, source AS account, amount_currency AS currency, status, -amount AS amount
+        FROM sales_transactionrecord
+        UNION ALL
+        SELECT payee_id, destination, amount_currency, status, amount
+        FROM sales_transactionrecord
+    ) AS entries
+    GROUP BY entries.user_id, entries.account, entries.currency, entries.status
+    HAVING SUM(entries.amount) != 0
+"""
+
+
+def account_balance_drift() -> List[Tuple[Optional[int], int, str, int, Decimal, Decimal]]:
+    """
+    Compares the AccountBalance table against the ledger. Returns (user_id, account, currency, status, ledger amount,
+    recorded amount) for each balance that differs.
+    """
+    from django.db import connection
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                COALESCE(ledger.user_id, balance.user_id),
+                COALESCE(ledger.account, balance.account),
+                COALESCE(ledger.currency, balance.currency),
+                COALESCE(ledger.status, balance.status),
+                COALESCE(ledger.amount, 0),
+                COALESCE(balance.amount, 0)
+            FROM ({LEDGER_BALANCES_SQL}) AS ledger
+            FULL OUTER JOIN (
+                SELECT user_id, account, currency, status, SUM(amount) AS amount FROM sales_accountbalance
+                GROUP BY user_id, account, currency, status
+            ) AS balance
+            ON ledger.user_id IS NOT DISTINCT FROM balance.user_id
+            AND ledger.account = balance.account
+            AND ledger.currency = balance.currency
+            AND ledger.status = balance.status
+            WHERE COALESCE(ledger.amount, 0) != COALESCE(balance.amount, 0)
+            ORDER BY 1, 2, 3, 4
+        """)
+        return cursor.fetchall()
+
+
+def ledger_entries_sql(condition: str, at: str, factor: int = 1) -> str:
+    """
+    Builds SQL listing the effect of each TransactionRecord matching condition on its payer's and payee's accounts,
+    multiplied by factor. Each record is given the status it had at the time in `at`: records which weren't finalized
+    by then were still pending.
+    """
+    from apps.sales.models import TransactionRecord
+    status = f'CASE WHEN finalized_on <= {at} THEN status ELSE {TransactionRecord.PENDING} END'
+    return f"""
+        SELECT payer_id AS user_id, source AS account, amount_currency AS currency, {status} AS status,
+            {-factor} * amount AS amount
+        FROM sales_transactionrecord WHERE {condition}
+        UNION ALL
+        SELECT payee_id, destination, amount_currency, {status}, {factor} * amount
+        FROM sales_transactionrecord WHERE {condition}
+    """
+
+
+def balances_as_of_sql(as_of: datetime) -> Tuple[str, dict]:
+    """
+    Builds SQL listing entries which add up to every balance as it stood at as_of. These are the rows of the latest
+    snapshot taken by then, plus the change made since by records created or finalized in between. With no snapshot,
+    the whole ledger up to as_of is used.
+    """
+    from apps.sales.models import AccountBalanceSnapshot
+    since = AccountBalanceSnapshot.objects.filter(
+        taken_at__lte=as_of,
+    ).order_by('-taken_at').values_list('taken_at', flat=True).first()
+    params = {'as_of': as_of, 'since': since}
+    if since is None:
+        return ledger_entries_sql('created_on <= %(as_of)s', '%(as_of)s'), params
+    window = (
+        '((created_on > %(since)s AND created_on <= %(as_of)s) '
+        'OR (finalized_on > %(since)s AND finalized_on <= %(as_of)s))'
+    )
+    return f"""
+        SELECT user_id, account, currency, status, amount
+        FROM sales_accountbalancesnapshot WHERE taken_at = %(since)s
+        UNION ALL {ledger_entries_sql(f'{window} AND created_on <= %(as_of)s', '%(as_of)s')}
+        UNION ALL {ledger_entries_sql(f'{window} AND created_on <= %(since)s', '%(since)s', factor=-1)}
+    """, params
+
+
+def balances_as_of(
+        as_of: datetime, accounts: List[int], statuses: List[int], users: Union[List[int], None, Type[ALL]],
+) -> List[Tuple[Optional[int], int, int, Decimal]]:
+    """
+    Gets (user ID, account type, status, amount) for the given accounts and statuses as they stood at as_of. users is
+    a list of user IDs, None for Artconomy's own accounts, or ALL.
+    """
+    from django.db import connection
+    sql, params = balances_as_of_sql(as_of)
+    params = {**params, 'accounts': list(accounts), 'statuses': list(statuses)}
+    conditions = ['account = ANY(%(accounts)s)', 'status = ANY(%(statuses)s)']
+    if users is None:
+        conditions.append('user_id IS NULL')
+    elif users is not ALL:
+        params['users'] = list(users)
+        conditions.append('user_id = ANY(%(users)s)')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT user_id, account, status, SUM(amount) FROM ({sql}) AS entries
+            WHERE {' AND '.join(conditions)}
+            GROUP BY user_id, account, status
+            """,
+            params,
+        )
+        return cursor.fetchall()
+
+
+def snapshot_ledger(taken_at: Optional[datetime] = None):
+    """
+    Records every nonzero balance as it stood at taken_at, which defaults to the start of today. Does nothing if a
+    snapshot was already taken at that time.
+    """
+    from django.db import connection
+    from apps.sales.models import AccountBalanceSnapshot
+    taken_at = taken_at or timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    with atomic(), connection.cursor() as cursor:
+        if AccountBalanceSnapshot.objects.filter(taken_at=taken_at).exists():
+            return
+        sql, params = balances_as_of_sql(taken_at)
+        cursor.execute(
+            f"""
+            INSERT INTO sales_accountbalancesnapshot (taken_at, user_id, account, currency, status, amount)
+            SELECT %(as_of)s, user_id, account, currency, status, SUM(amount) FROM ({sql}) AS entries
+            GROUP BY user_id, account, currency, status
+            HAVING SUM(amount) != 0
+            """,
+            params,
+        )
+
+
+def rebuild_account_balances():
+    """
+    Replaces the contents of the AccountBalance table with balances summed from the ledger.
+    """
+    from django.db import connection
+    with atomic(), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE sales_transactionrecord IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute('DELETE FROM sales_accountbalance')
+        cursor.execute(
+            f'INSERT INTO sales_accountbalance (user_id, account, currency, status, amount) {LEDGER_BALANCES_SQL}',
+        )
+
+
+def compact_account_balances():
+    """
+    Folds the rows recording changes to Artconomy's balances into one row per balance. Only the rows committed when
+    it starts are folded, and appending more never waits on it, so it's safe to run at any time.
+    """
+    from django.db import connection
+    with atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH removed AS (
+                DELETE FROM sales_accountbalance WHERE user_id IS NULL RETURNING account, currency, status, amount
+            )
+            INSERT INTO sales_accountbalance (user_id, account, currency, status, amount)
+            SELECT NULL, account, currency, status, SUM(amount) FROM removed GROUP BY account, currency, status
+            """,
+        )
+
+
+def reference_id(pk: Union[int, str, UUID]) -> UUID:
+    """
+    The object ID that a GenericReference, or a TransactionTarget, stores for a primary key.
+    """
+    if isinstance(pk, str):
+        return unslugify(pk)
+    if isinstance(pk, int):
+        return UUID(int=pk)
+    return pk
+
+
+def targeting(instance: Model) -> Dict[str, Any]:
+    """
+    Filter arguments for the TransactionRecords targeting an instance. Unlike filtering on targets with
+    ref_for_instance, this doesn't need to look up or create a GenericReference first.
+    """
+    return {
+        'target_links__content_type': ContentType.objects.get_for_model(instance),
+        'target_links__object_id': reference_id(instance.pk),
+    }
+
+
+def record_targets(
+        records: Iterable['TransactionRecord'], models: Optional[List[Type[Model]]] = None,
+) -> DefaultDict[str, List[Model]]:
+    """
+    Resolves the targets of many records at once, by record ID. Takes one query for the links, and one per model
+    targeted. If models are given, only targets of those models are included. Targets which have since been deleted
+    are left out.
+    """
+    from apps.sales.models import TransactionTarget
+    links = TransactionTarget.objects.filter(record__in=records)
+    if models is not None:
+        links = links.filter(content_type__in=ContentType.objects.get_for_models(*models).values())
+    links = list(links.order_by('content_type_id', 'id'))
+    object_ids = defaultdict(set)
+    for link in links:
+        object_ids[link.content_type_id].add(link.object_id)
+    targets = {}
+    for content_type_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        if not isinstance(model._meta.pk, UUIDField):
+            ids = [object_id.int for object_id in ids]
+        for target in model.objects.filter(pk__in=ids):
+            targets[content_type_id, reference_id(target.pk)] = target
+    result = defaultdict(list)
+    for link in links:
+        target = targets.get((link.content_type_id, link.object_id))
+        if target is not None:
+            result[link.record_id].append(target)
+    return result
+
+
+def backfill_transaction_targets(start: int, stop: int) -> int:
+    """
+    Copies the TransactionRecord targets with link IDs in (start, stop] into the TransactionTarget table, skipping any
+    already there. Returns how many were copied.
+    """
+    from django.db import connection
+    with atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO sales_transactiontarget (record_id, content_type_id, object_id)
+            SELECT link.transactionrecord_id, ref.content_type_id, ref.object_id
+            FROM sales_transactionrecord_targets link
+            INNER JOIN lib_genericreference ref ON ref.id = link.genericreference_id
+            WHERE link.id > %s AND link.id <= %s AND ref.content_type_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """,
+            [start, stop],
+        )
+        return cursor.rowcount
+
+
 def product_ordering(qs, query=''):
     return qs.annotate(
         matches=Case(
@@ -306,7 +627,8 @@ def finalize_table_fees(deliverable: 'Deliverable'):
 def finalize_deliverable(deliverable, user=None):
     from apps.sales.models import TransactionRecord, COMPLETED, DISPUTED, ref_for_instance
     from apps.sales.tasks import withdraw_all
-    with atomic():
+    seller = deliverable.order.seller
+    with AccountMutex([(seller, TransactionRecord.ESCROW), (seller, TransactionRecord.HOLDINGS)]):
         if deliverable.status == DISPUTED and user == deliverable.order.buyer:
             # User is rescinding dispute.
             recall_notification(DISPUTE, deliverable)
@@ -390,7 +712,15 @@ def transfer_order(order, old_buyer, new_buyer, force=False):
     if old_buyer == new_buyer:
         return
     Subscription.objects.filter(subscriber=old_buyer).delete()
-    Notification.objects.filter(user=old_buyer).update(user=new_buyer)
+    # Only one notification per event and user is allowed, so the old buyer's copies of notifications the new buyer
+    # already has are dropped. The counters are adjusted for these by the database as they're deleted.
+    Notification.objects.filter(
+        user=old_buyer, event_id__in=Notification.objects.filter(user=new_buyer).values('event_id'),
+    ).delete()
+    moved = list(Notification.objects.filter(user=old_buyer).values_list('id', flat=True))
+    adjust_unread_counts(Notification.objects.filter(id__in=moved), -1)
+    Notification.objects.filter(id__in=moved).update(user=new_buyer)
+    adjust_unread_counts(Notification.objects.filter(id__in=moved), 1)
     Comment.objects.filter(user=old_buyer).update(user=new_buyer)
     CreditCardToken.objects.filter(user=old_buyer).update(user=new_buyer)
 
@@ -627,18 +957,22 @@ def verify_total(deliverable: 'Deliverable'):
         raise ValidationError({'amount': [f'Total cannot end up less than ${settings.MINIMUM_PRICE}.']})
 
 
-def issue_refund(transaction_set: Iterator['TransactionRecord'], category: int, processor: str) -> List['TransactionRecord']:
+def start_refund(
+        transactions: List['TransactionRecord'], category: int, processor: str,
+) -> List['TransactionRecord']:
+    """
+    Writes pending reversals of a set of transactions. While pending, they count against the accounts they draw
+    from, and mark the transactions as being refunded, so callers should write them under an AccountMutex after
+    checking there are no refunds pending already. They should be committed before complete_refund contacts the
+    payment processor, so that a refund which was sent but never confirmed still shows up in the ledger.
+    """
     from apps.sales.models import TransactionRecord
-    last_four = None
-    transactions = [*transaction_set]
+    card_transactions = [transaction for transaction in transactions if transaction.source == TransactionRecord.CARD]
     cash_transactions = [
-        transaction for transaction in transaction_set if transaction.source == TransactionRecord.CASH_DEPOSIT
+        transaction for transaction in transactions if transaction.source == TransactionRecord.CASH_DEPOSIT
     ]
-    card_transactions = [transaction for transaction in transaction_set if transaction.source == TransactionRecord.CARD]
-    for transaction in card_transactions:
-        remote_ids = transaction.remote_ids
-        last_four = transaction.card and transaction.card.last_four
-        break
+    remote_ids = card_transactions and card_transactions[0].remote_ids
+    last_four = card_transactions and card_transactions[0].card and card_transactions[0].card.last_four
     if not len(cash_transactions) == len(transactions):
         assert remote_ids, 'Could not find a remote transaction ID to refund.'
         assert (processor == STRIPE) or last_four, 'Could not determine the last four digits of the relevant card.'
@@ -647,46 +981,60 @@ def issue_refund(transaction_set: Iterator['TransactionRecord'], category: int,
         record = TransactionRecord.objects.create(
             source=transaction.destination,
             destination=transaction.source,
-            status=TransactionRecord.FAILURE,
+            status=TransactionRecord.PENDING,
             category=category,
             payer=transaction.payee,
             payee=transaction.payer,
             card=transaction.card,
             amount=transaction.amount,
             remote_ids=transaction.remote_ids,
-            response_message="Failed when contacting payment processor.",
+            response_message='Refund started, but not confirmed by the payment processor.',
         )
         record.targets.set(transaction.targets.all())
         refund_transactions.append(record)
+    return refund_transactions
+
+
+def complete_refund(
+        transactions: List['TransactionRecord'], refund_transactions: List['TransactionRecord'],
+) -> List['TransactionRecord']:
+    """
+    Sends the refunds written by start_refund to the payment processor, and marks them successful or failed. Must be
+    called outside of any transaction, since it waits on the payment processor.
+    """
+    from apps.sales.models import TransactionRecord
+    card_transactions = [transaction for transaction in transactions if transaction.source == TransactionRecord.CARD]
+    if not card_transactions:
+        for transaction in refund_transactions:
+            transaction.status = TransactionRecord.SUCCESS
+            transaction.response_message = ''
+            transaction.save()
+        return refund_transactions
+    remote_ids = card_transactions[0].remote_ids
     amount = sum(transaction.amount for transaction in card_transactions)
-    if card_transactions:
+    try:
+        auth_code = '******'
         try:
-            auth_code = '******'
-            try:
-                intent_token = fetch_prefixed('pi_', remote_ids)
-            except ValueError:
-                raise ValueError('Invalid Stripe payment ID. Please contact support!')
-            with stripe as stripe_api:
-                # Note: We will assume success here. If there is a refund failure we'll have to dive into it
-                # manually anyway and will find it during the accounting rounds.
-                # TODO: Fix this.
-                refund_payment_intent(amount=amount, api=stripe_api, intent_token=intent_token)['id']
-            for transaction in refund_transactions:
-                transaction.status = TransactionRecord.SUCCESS
-                if transaction.destination == TransactionRecord.CARD:
-                    transaction.remote_ids = remote_ids
-                    transaction.auth_code = auth_code
-                transaction.response_message = ''
-        except Exception as err:
-            for transaction in refund_transactions:
-                transaction.response_message = str(err)
-        finally:
-            for transaction in refund_transactions:
-                transaction.save()
-    else:
+            intent_token = fetch_prefixed('pi_', remote_ids)
+        except ValueError:
+            raise ValueError('Invalid Stripe payment ID. Please contact support!')
+        with stripe as stripe_api:
+            # Note: We will assume success here. If there is a refund failure we'll have to dive into it
+            # manually anyway and will find it during the accounting rounds.
+            # TODO: Fix this.
+            refund_payment_intent(amount=amount, api=stripe_api, intent_token=intent_token)['id']
         for transaction in refund_transactions:
             transaction.status = TransactionRecord.SUCCESS
+            if transaction.destination == TransactionRecord.CARD:
+                transaction.remote_ids = remote_ids
+                transaction.auth_code = auth_code
             transaction.response_message = ''
+    except Exception as err:
+        for transaction in refund_transactions:
+            transaction.status = TransactionRecord.FAILURE
+            transaction.response_message = str(err)
+    finally:
+        for transaction in refund_transactions:
             transaction.save()
     return refund_transactions
 
@@ -1288,27 +1636,70 @@ def invoice_post_payment(invoice: 'Invoice', context: dict) -> List['Transaction
     return records
 
 
+# Waits, in seconds, for an AccountMutex that are long enough to log.
+SLOW_LOCK_WAIT = 1
+# Upper bounds, in seconds, of the buckets that AccountMutex lock waits are counted in.
+LOCK_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+LOCK_WAITS = Counter()
+
+AccountKey = Tuple[int, int]
+
+
+def lock_wait_bucket(seconds: float) -> str:
+    for bound in LOCK_WAIT_BUCKETS:
+        if seconds <= bound:
+            return f'<={bound}s'
+    return f'>{LOCK_WAIT_BUCKETS[-1]}s'
+
+
+def lock_wait_histogram() -> Dict[str, int]:
+    """
+    Reports how many times this process has waited to acquire an AccountMutex, bucketed by how long the wait took.
+    Reported by the realtime stats endpoint.
+    """
+    buckets = [f'<={bound}s' for bound in LOCK_WAIT_BUCKETS] + [f'>{LOCK_WAIT_BUCKETS[-1]}s']
+    return {bucket: LOCK_WAITS[bucket] for bucket in buckets}
+
+
 class AccountMutex:
-    def __init__(self, users: List[User]):
-        # Not 100% sure on this, but I think we can avoid deadlocks if we always lock users in the same order, even if
-        # there are multiple, since one thread will always be ahead of the other.
-        self.users = sorted(list(set(users)))
-        self.mutexes = []
-        self.acquired = []
+    """
+    Serializes ledger writes against particular accounts. Takes a Postgres transaction-level advisory lock for each
+    (user, account) pair, so checks against an account's balance can't race each other. The locks are held until the
+    outermost transaction ends, and taking one that this transaction already holds returns immediately.
+
+    Locks are always taken in the same order, so two transactions locking overlapping sets of accounts can't
+    deadlock. Artconomy's own accounts have no user, and are keyed as user 0, so everything locking one of them
+    waits on everything else that does.
+
+    Holding the mutex doesn't mean a transaction never waits on another. Records' triggers update AccountBalance
+    rows, and two transactions changing the same user's balance on an account wait on each other there until one
+    commits, whether or not either locked it here. See AccountBalance.
+
+    Every wait is counted in lock_wait_histogram, and waits longer than SLOW_LOCK_WAIT are logged as warnings.
+    """
+    def __init__(self, accounts: Iterable[Tuple[Optional[User], int]]):
+        self.keys: List[AccountKey] = sorted({(user.id if user else 0, account) for user, account in accounts})
+        self.atomic = atomic()
 
     def __enter__(self):
-        for user in self.users:
-            lock_name = f'account_mutex__{user.id}'
-            self.mutexes.append(cache.lock(lock_name))
-        for lock in self.mutexes:
-            lock.__enter__()
-            self.acquired.append(lock)
+        from django.db import connection
+        self.atomic.__enter__()
+        start = perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                for user_id, account in self.keys:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [account, user_id])
+        except BaseException:
+            self.atomic.__exit__(*sys.exc_info())
+            raise
+        waited = perf_counter() - start
+        LOCK_WAITS[lock_wait_bucket(waited)] += 1
+        if waited > SLOW_LOCK_WAIT:
+            logger.warning('Waited %.2fs to lock accounts %s', waited, self.keys)
+        return self
 
     def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
-        result = []
-        for lock in self.acquired:
-            result.append(lock.__exit__(exc_type, exc_val, exc_tb))
-        return all(result)
+        return self.atomic.__exit__(exc_type, exc_val, exc_tb)
 
 
 def reverse_record(record: 'TransactionRecord') -> (bool, 'TransactionRecord'):
@@ -71,11 +71,12 @@ from apps.sales.serializers import (
     PayoutTransactionSerializer, OrderViewSerializer, ReferenceSerializer, DeliverableReferenceSerializer,
     NewDeliverableSerializer, PinSerializer, UserPayoutTransactionSerializer, InvoiceSerializer, UnaffiliatedInvoiceSerializer)
 from apps.sales.utils import available_products, set_premium, \
-    check_charge_required, available_products_by_load, finalize_deliverable, account_balance, \
+    check_charge_required, available_products_by_load, finalize_deliverable, \
     POSTED_ONLY, PENDING, transfer_order, early_finalize, cancel_deliverable, \
-    verify_total, issue_refund, ensure_buyer, perform_charge, premium_post_success, premium_initiate_transactions, \
+    verify_total, start_refund, complete_refund, ensure_buyer, perform_charge, premium_post_success, \
+    premium_initiate_transactions, \
     UserPaymentException, pay_deliverable, get_term_invoice, premium_post_save, \
-    invoice_post_payment
+    invoice_post_payment, account_balances, AVAILABLE, AccountMutex
 from shortcuts import make_url
 
 
@@ -1067,22 +1068,36 @@ class DeliverableRefund(GenericAPIView):
             notify(ORDER_UPDATE, deliverable, unique=True, mark_unread=True)
             serializer = self.get_serializer(instance=deliverable, context=self.get_serializer_context())
             return Response(status=status.HTTP_200_OK, data=serializer.data)
-        target = ref_for_instance(deliverable)
-        # Sanity check. Should only return one transaction.
-        TransactionRecord.objects.get(
-            source__in=[TransactionRecord.CARD, TransactionRecord.CASH_DEPOSIT],
-            targets=target,
-            payer=deliverable.order.buyer,
-            payee=deliverable.order.seller,
-            destination=TransactionRecord.ESCROW,
-            status=TransactionRecord.SUCCESS,
-        )
-        transaction_set = TransactionRecord.objects.filter(
-            source__in=[TransactionRecord.CARD, TransactionRecord.CASH_DEPOSIT],
-            targets=target,
-            status=TransactionRecord.SUCCESS,
-        ).exclude(category=TransactionRecord.SHIELD_FEE)
-        record = issue_refund(transaction_set, TransactionRecord.ESCROW_REFUND, processor=deliverable.processor)[0]
+        # Finalization and other refunds take the same lock, so once it's held, the order's state and records can be
+        # checked again without them changing underneath us.
+        with AccountMutex([(deliverable.order.seller, TransactionRecord.ESCROW)]):
+            deliverable = self.get_object()
+            self.check_object_permissions(self.request, deliverable)
+            target = ref_for_instance(deliverable)
+            if TransactionRecord.objects.filter(
+                targets=target,
+                category=TransactionRecord.ESCROW_REFUND,
+                status__in=[TransactionRecord.SUCCESS, TransactionRecord.PENDING],
+            ).exists():
+                return Response(
+                    status=status.HTTP_400_BAD_REQUEST, data={'detail': 'This order is already being refunded.'},
+                )
+            # Sanity check. Should only return one transaction.
+            TransactionRecord.objects.get(
+                source__in=[TransactionRecord.CARD, TransactionRecord.CASH_DEPOSIT],
+                targets=target,
+                payer=deliverable.order.buyer,
+                payee=deliverable.order.seller,
+                destination=TransactionRecord.ESCROW,
+                status=TransactionRecord.SUCCESS,
+            )
+            transactions = list(TransactionRecord.objects.filter(
+                source__in=[TransactionRecord.CARD, TransactionRecord.CASH_DEPOSIT],
+                targets=target,
+                status=TransactionRecord.SUCCESS,
+            ).exclude(category=TransactionRecord.SHIELD_FEE))
+            refunds = start_refund(transactions, TransactionRecord.ESCROW_REFUND, processor=deliverable.processor)
+        record = complete_refund(transactions, refunds)[0]
         if record.status == TransactionRecord.FAILURE:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'detail': record.response_message})
         deliverable.status = REFUNDED
@@ -1530,11 +1545,9 @@ class AccountStatus(GenericAPIView):
         query = AccountQuerySerializer(data=request.GET)
         query.is_valid(raise_exception=True)
         account = query.validated_data['account']
-        return Response(status=status.HTTP_200_OK, data={
-            'available': float(account_balance(request.subject, account)),
-            'posted': float(account_balance(request.subject, account, POSTED_ONLY)),
-            'pending': float(account_balance(request.subject, account, PENDING)),
-        })
+        keys = {'available': (account, AVAILABLE), 'posted': (account, POSTED_ONLY), 'pending': (account, PENDING)}
+        balances = account_balances([request.subject], list(keys.values()))[request.subject.id]
+        return Response(status=status.HTTP_200_OK, data={name: float(balances[key]) for name, key in keys.items()})
 
 
 class AccountHistory(ListAPIView):
@@ -10,6 +10,8 @@ from django.conf import settings
 
 from django.db import transaction
 from django.db.transaction import atomic
+from django.db.models import F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from moneyed import Money, get_currency
 from requests.auth import HTTPBasicAuth
@@ -203,7 +205,7 @@ def transfer_failed(event):
     records = TransactionRecord.objects.filter(
         remote_ids=transfer,
     )
-    records.update(status=TransactionRecord.FAILURE)
+    records.update(status=TransactionRecord.FAILURE, finalized_on=Coalesce(F('finalized_on'), timezone.now()))
     record = records.order_by('created_on')[0]
     notify(
         TRANSFER_FAILED,
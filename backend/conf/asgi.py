@@ -14,6 +14,10 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 from apps.lib.routing import websocket_urlpatterns
+from apps.lib.version import current_version
+
+# Resolve the version up front, rather than when the first client asks for it.
+current_version()
 
 
 application = ProtocolTypeRouter({
@@ -163,6 +163,16 @@ CHANNEL_LAYERS = {
     }
 }
 
+# When enabled, channel layer messages sent from synchronous code are queued for a background publisher thread
+# instead of being sent inline. Tests send inline so that messages arrive in order with the code that sent them.
+CHANNEL_PUBLISHER = bool(int(get_env('CHANNEL_PUBLISHER', '0' if TESTING else '1')))
+# Messages beyond this many waiting to be published are dropped.
+CHANNEL_PUBLISHER_QUEUE_SIZE = int(get_env('CHANNEL_PUBLISHER_QUEUE_SIZE', '10000'))
+# Most messages the publisher sends concurrently.
+CHANNEL_PUBLISHER_BATCH_SIZE = int(get_env('CHANNEL_PUBLISHER_BATCH_SIZE', '100'))
+# Longest a process waits on exit for the publisher to send what's still queued, in seconds.
+CHANNEL_PUBLISHER_FLUSH_TIMEOUT = float(get_env('CHANNEL_PUBLISHER_FLUSH_TIMEOUT', '5'))
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -322,6 +332,15 @@ CELERY_EMAIL_TASK_CONFIG = {
 
 SENDGRID_API_KEY = get_env('SENDGRID_API_KEY', '')
 
+# When enabled, notify() only records the event and in-app notifications. Emails and Telegram messages are rendered
+# and sent by celery workers once the transaction commits. Tests use the inline path so the outbox is filled
+# synchronously.
+NOTIFICATION_FANOUT = bool(int(get_env('NOTIFICATION_FANOUT', '0' if TESTING else '1')))
+# Number of subscriptions handled by each notification delivery task.
+NOTIFICATION_BATCH_SIZE = int(get_env('NOTIFICATION_BATCH_SIZE', '100'))
+# Seconds that rendered payloads for viewer-independent notification types are shared between readers. 0 disables.
+NOTIFICATION_PAYLOAD_TTL = int(get_env('NOTIFICATION_PAYLOAD_TTL', '0' if TESTING else '600'))
+
 SANDBOX_APIS = bool(int(get_env('SANDBOX_APIS', '1')))
 
 SENDGRID_SANDBOX_MODE_IN_DEBUG = SANDBOX_APIS
@@ -509,7 +528,26 @@ CELERYBEAT_SCHEDULE = {
     'annotate_payouts': {
         'task': 'apps.sales.tasks.annotate_connect_fees',
         'schedule': crontab(hour=1, minute=30),
-    }
+    },
+    # Monthly keeps the table small while bounding how much of the ledger a historical balance query has to sum. Run
+    # it daily instead if those queries need to be cheaper.
+    'ledger_snapshot': {
+        'task': 'apps.sales.tasks.take_ledger_snapshot',
+        'schedule': crontab(day_of_month=1, hour=0, minute=20),
+    },
+    # Artconomy's balances gain a row for every record touching them until folded together.
+    'fold_account_balances': {
+        'task': 'apps.sales.tasks.fold_account_balances',
+        'schedule': crontab(minute='*/10'),
+    },
+    'hourly_digests': {
+        'task': 'apps.lib.tasks.send_hourly_digests',
+        'schedule': crontab(minute=5),
+    },
+    'daily_digests': {
+        'task': 'apps.lib.tasks.send_daily_digests',
+        'schedule': crontab(hour=16, minute=0),
+    },
 }
 
 ENV_NAME = get_env('ENV_NAME', 'prod')